@@ -0,0 +1,188 @@
+"""Bounded, exact-match caches, with an optional on-disk tier that survives restarts.
+
+Entries live in memory, up to a number of entries and a number of bytes, and are evicted least recently
+used first. Entries older than the TTL are misses. With a `path`, entries are also written to a SQLite
+file, which serves misses of the memory tier, e.g. after a restart.
+"""
+
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import Callable
+from typing import Any
+
+import app.logconfig
+from app.metrics import REGISTRY
+
+logger = app.logconfig.setup_logger("root")
+
+CACHE_LOOKUPS = REGISTRY.counter("xbot_cache_lookups_total", "Lookups of each cache, by result: hit, disk_hit or miss.")
+
+_CACHES: dict[str, "BoundedCache"] = {}
+
+
+def cache_stats() -> dict[str, dict[str, int]]:
+    """Entries and bytes in memory of each cache, by name."""
+    return {name: {"entries": len(cache), "bytes": cache.bytes} for name, cache in list(_CACHES.items())}
+
+
+def _cache_gauge(stat: str) -> None:
+    REGISTRY.gauge(
+        f"xbot_cache_{stat}",
+        f"{stat.capitalize()} in memory of each cache.",
+        lambda: {(("cache", name),): stats[stat] for name, stats in cache_stats().items()},
+    )
+
+
+for _stat in ("entries", "bytes"):
+    _cache_gauge(_stat)
+
+
+def cache_key(*parts: Any) -> str:
+    """A digest of the parts. Dicts are keyed by their content, whatever their order."""
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class BoundedCache:
+    """A thread-safe LRU cache, bounded by entries and bytes, with a TTL, and an optional SQLite tier.
+
+    Values are stored encoded, as bytes, so their size is known. The default encoding is JSON.
+
+    Args:
+        name (str): Labels the cache's metrics.
+        max_entries (int): Most entries held in memory.
+        max_bytes (int): Most bytes of encoded values held in memory.
+        ttl_seconds (float | None): Age at which entries expire, in both tiers. None for no expiry.
+        path (str | None): SQLite file of the on-disk tier. None for memory only.
+        max_disk_entries (int): Most entries kept on disk. The oldest are removed first.
+        encode (Callable): Value to bytes.
+        decode (Callable): Bytes to value.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        max_entries: int = 1024,
+        max_bytes: int = 64 * 2**20,
+        ttl_seconds: float | None = None,
+        path: str | None = None,
+        max_disk_entries: int = 100_000,
+        encode: Callable[[Any], bytes] = lambda value: json.dumps(value).encode(),
+        decode: Callable[[bytes], Any] = json.loads,
+    ) -> None:
+        self.name = name
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.max_disk_entries = max_disk_entries
+        self.encode = encode
+        self.decode = decode
+        self.bytes = 0
+        # key -> (encoded value, time stored)
+        self._entries: OrderedDict[str, tuple[bytes, float]] = OrderedDict()
+        self._lock = threading.Lock()
+
+        self._db: sqlite3.Connection | None = None
+        self._writes = 0
+        if path is not None:
+            self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value BLOB, stored REAL)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS cache_stored ON cache (stored)")
+            self._db_lock = threading.Lock()
+            self._prune_disk()
+            logger.info(f"Opened the {name} cache at {path}")
+        _CACHES[name] = self
+
+    def get(self, key: str) -> Any | None:
+        """The value stored for the key, or None if there is none, or it has expired."""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self._expired(entry[1], now):
+                self._remove(key)
+                entry = None
+            if entry is not None:
+                self._entries.move_to_end(key)
+                CACHE_LOOKUPS.inc(cache=self.name, result="hit")
+                return self.decode(entry[0])
+
+        entry = self._disk_get(key, now)
+        if entry is None:
+            CACHE_LOOKUPS.inc(cache=self.name, result="miss")
+            return None
+        CACHE_LOOKUPS.inc(cache=self.name, result="disk_hit")
+        with self._lock:
+            self._insert(key, *entry)
+        return self.decode(entry[0])
+
+    def put(self, key: str, value: Any) -> None:
+        """Stores the value in memory, and on disk. Values larger than `max_bytes` are not cached."""
+        encoded = self.encode(value)
+        if len(encoded) > self.max_bytes:
+            return
+        now = time.time()
+        with self._lock:
+            self._insert(key, encoded, now)
+        if self._db is not None:
+            with self._db_lock:
+                self._db.execute("INSERT OR REPLACE INTO cache VALUES (?, ?, ?)", (key, encoded, now))
+                self._writes += 1
+            if self._writes % 1000 == 0:
+                self._prune_disk()
+
+    def clear(self) -> None:
+        """Empties both tiers."""
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+        if self._db is not None:
+            with self._db_lock:
+                self._db.execute("DELETE FROM cache")
+
+    def close(self) -> None:
+        if self._db is not None:
+            with self._db_lock:
+                self._db.close()
+            self._db = None
+        _CACHES.pop(self.name, None)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _insert(self, key: str, encoded: bytes, stored: float) -> None:
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (encoded, stored)
+        self.bytes += len(encoded)
+        while len(self._entries) > self.max_entries or self.bytes > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+
+    def _remove(self, key: str) -> None:
+        encoded, _ = self._entries.pop(key)
+        self.bytes -= len(encoded)
+
+    def _expired(self, stored: float, now: float) -> bool:
+        return self.ttl_seconds is not None and now - stored > self.ttl_seconds
+
+    def _disk_get(self, key: str, now: float) -> tuple[bytes, float] | None:
+        if self._db is None:
+            return None
+        with self._db_lock:
+            row = self._db.execute("SELECT value, stored FROM cache WHERE key = ?", (key,)).fetchone()
+        if row is None or self._expired(row[1], now):
+            return None
+        return row
+
+    def _prune_disk(self) -> None:
+        """Removes expired entries, and the oldest entries past `max_disk_entries`."""
+        with self._db_lock:
+            if self.ttl_seconds is not None:
+                self._db.execute("DELETE FROM cache WHERE stored < ?", (time.time() - self.ttl_seconds,))  # type: ignore
+            self._db.execute(  # type: ignore
+                "DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY stored DESC LIMIT -1 OFFSET ?)",
+                (self.max_disk_entries,),
+            )
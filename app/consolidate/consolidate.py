@@ -14,6 +14,16 @@ class AllDocumentsExceedContextWindowError(Exception):
     pass
 
 
+def format_context(context: ContextWithMetadata | Context, text: str | None = None) -> str:
+    """The context as it is given to the LLM. `text` replaces the context's text."""
+    text = context.text if text is None else text
+    if isinstance(context, ContextWithMetadata):
+        template = "[title: '{title}', url: '{url}']\n{text}\n"
+        return template.format(text=text, title=context.title, url=context.url)
+    template = "{text}\n"
+    return template.format(text=str(text))
+
+
 class SimpleConsolidator(Process):
 
     stage = RAGStage.CONSOLIDATE
@@ -26,34 +36,57 @@ class SimpleConsolidator(Process):
     def simple_consolidate(
         self, contexts: list[ContextWithMetadata | Context], config: dict
     ) -> list[Context] | list[ContextWithMetadata]:
+        new_contexts = self._select(
+            contexts,
+            config,
+            chars=lambda c: len(format_context(c)),
+            tokens=lambda c: len(self._text_to_tokens(format_context(c))),
+        )
+        for context in new_contexts:
+            context.text = format_context(context)
+        return new_contexts
+
+    def select_by_length_hint(
+        self, contexts: list[ContextWithMetadata | Context], config: dict
+    ) -> list[Context] | list[ContextWithMetadata]:
+        """The contexts `simple_consolidate` would keep, estimated from their `text_length`, before their text is
+        fetched. Exact for the default, character, tokens. Other tokenisers are assumed to take a token per character
+        of text, at most, so no more contexts are kept than fit.
+        """
+        return self._select(
+            contexts,
+            config,
+            chars=lambda c: len(format_context(c, "")) + (c.text_length or 0),
+            tokens=lambda c: len(self._text_to_tokens(format_context(c, ""))) + (c.text_length or 0),
+        )
+
+    def _select(
+        self,
+        contexts: list[ContextWithMetadata | Context],
+        config: dict,
+        chars: Callable[[Context], int],
+        tokens: Callable[[Context], int],
+    ) -> list[Any]:
         token_limit = config["token_limit"]
         strategy = config["strategy"]
 
-        def _format(c: ContextWithMetadata | Context) -> str:
-            if isinstance(c, ContextWithMetadata):
-                template = "[title: '{title}', url: '{url}']\n{text}\n"
-                return template.format(text=c.text, title=c.title, url=c.url)
-            template = "{text}\n"
-            return template.format(text=str(c.text))
-
         # limit contexts based on a strategy, and a token limit
         if strategy == "score_weighted":
             contexts = sorted(contexts, key=lambda x: x.score, reverse=True)
         elif strategy == "simple":
-            contexts = sorted(contexts, key=lambda x: len(_format(x)))
+            contexts = sorted(contexts, key=chars)
         else:
             contexts = contexts
 
         new_contexts, token_cost_total = [], 0
         for idx, context in enumerate(contexts):
-            text = str(_format(context))
-            token_length = len(self._text_to_tokens(text))
+            token_length = tokens(context)
 
             # Check if adding the current context exceeds the token limit
             if token_cost_total + token_length > token_limit:
                 # Check if any context exceeds the token limit
                 if idx < len(contexts) - 1:
-                    doc_lengths = [len(self._text_to_tokens(str(_format(c)))) for c in contexts]
+                    doc_lengths = [tokens(c) for c in contexts]
                     doc_ids = [c.doc_id for c in contexts]
                     docs_as_text = ",".join(
                         [f"({i=} {length=})" for i, length in zip(doc_ids, doc_lengths, strict=False)]
@@ -63,16 +96,32 @@ class SimpleConsolidator(Process):
 
                 break
 
-            context.text = text
             new_contexts.append(context)
             token_cost_total += token_length
 
         return new_contexts
 
+    def _load_texts(
+        self, contexts: list[ContextWithMetadata | Context], fetch_texts: Callable[[list[Context]], None]
+    ) -> list[Context] | list[ContextWithMetadata]:
+        """Fetches the text of the contexts retrieved without it, in one call. Only the text of the contexts that
+        would be kept is fetched, if all their lengths are known.
+        """
+        if not any(c.point_id is not None and not c.text for c in contexts):
+            return contexts
+        if any(c.text_length is None for c in contexts):
+            fetch_texts(contexts)
+            return contexts
+        kept = self.select_by_length_hint(contexts, self.config)
+        fetch_texts(kept)
+        return kept
+
     def _process(self, text: Any, data: dict, errors: ErrorStack, *_) -> tuple[Any, dict, ErrorStack, RAGStage]:
         context_items: list[Context] | list[ContextWithMetadata] = text
 
         try:
+            if "fetch_texts" in data:  # Contexts were retrieved without their text
+                context_items = self._load_texts(context_items, data["fetch_texts"])
             consolidated_contexts = self.simple_consolidate(context_items, self.config)
             next_text: list[Context] | list[ContextWithMetadata] = consolidated_contexts
             next_data = {**data, "contexts": consolidated_contexts}
@@ -81,5 +130,11 @@ class SimpleConsolidator(Process):
             logger.error(e)
             next_text = text
             next_data = {**data, "contexts": context_items}
+            if "fetch_texts" in data:  # The contexts are passed on whole, so need all their text
+                try:
+                    data["fetch_texts"](next_text)
+                except Exception as fetch_error:
+                    errors.append((self.stage, fetch_error))
+                    logger.error(fetch_error)
 
         return next_text, next_data, errors, self.next_stage
@@ -1,10 +1,13 @@
+import functools
 import os
 
 import dotenv
-from sqlalchemy import JSON, Column, Integer, String, create_engine
+from sqlalchemy import JSON, Column, Engine, Integer, String, create_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 
+from app.tracing import traced
+
 dotenv.load_dotenv()
 
 MONITOR_DB_URI = os.environ.get("SQLALCHEMY_DATABASE_URI") or "sqlite:///sample.db"
@@ -14,9 +17,6 @@ echo = False
 if LOG_LEVEL == "DEBUG":
     echo = True
 
-print("Creating database for metrics: ", MONITOR_DB_URI)
-engine = create_engine(MONITOR_DB_URI, echo=echo)  # Change the database name if needed
-
 Base = declarative_base()
 
 
@@ -29,15 +29,22 @@ class Eval(Base):
     log = Column(JSON)
 
 
-Base.metadata.create_all(engine)
+@functools.cache
+def get_engine() -> Engine:
+    """The engine of the metrics database. Created, with its tables, on first use rather than at import."""
+    print("Creating database for metrics: ", MONITOR_DB_URI)
+    engine = create_engine(MONITOR_DB_URI, echo=echo)  # Change the database name if needed
+    Base.metadata.create_all(engine)
+    return engine
 
 
+@traced("write_data")
 def write_data(event_id, log):
     """
     Write data to the database using the provided event ID and log.
     """
 
-    Session = sessionmaker(bind=engine)
+    Session = sessionmaker(bind=get_engine())
     with Session() as session:
         new_eval = Eval(event_id=event_id, log=log)
         session.add(new_eval)
@@ -49,7 +56,7 @@ def get_data(event_id: str | None = None) -> list[dict]:
     Function to retrieve data from the evals database based on the provided event ID.
     """
 
-    Session = sessionmaker(bind=engine)
+    Session = sessionmaker(bind=get_engine())
     with Session() as session:
         if event_id:
             evals = session.query(Eval).filter_by(event_id=event_id).all()
@@ -64,7 +71,7 @@ def get_data(event_id: str | None = None) -> list[dict]:
 
 def delete_rows(event_id: str | None = None, table_name: str = "eval") -> None:
     """Delete rows from a table. If no event_id is given, delete all rows."""
-    session = sessionmaker(bind=engine)
+    session = sessionmaker(bind=get_engine())
     with session() as db_session:
         if event_id:
             table_query = db_session.query(eval(table_name)).filter_by(event_id=event_id)
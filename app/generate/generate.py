@@ -1,14 +1,32 @@
-import time
-from typing import Any
+from __future__ import annotations
 
-import torch
-from transformers import GPT2LMHeadModel, GPT2Tokenizer
+import asyncio
+import concurrent.futures
+import copy
+import json
+import math
+import queue
+import threading
+import time
+import weakref
+from collections.abc import AsyncIterator
+from typing import TYPE_CHECKING, Any
 
 import app.logconfig
-from app.pipe import ErrorStack, Process, RAGStage
+from app.cache import BoundedCache, cache_key
+from app.generate.workers import GenerationWorkerPool
+from app.metrics import FALLBACKS, REGISTRY
+from app.pipe import ErrorStack, PipeItem, Process, RAGStage
+from app.registry import MODELS, config_key
 from app.retrieve.retrieve import Context, ContextWithMetadata
 from app.schemas import GenerateRequest
-from app.utils import run_until_timeout
+from app.tracing import span
+from app.utils import DynamicBatcher, ExecutorSaturatedError, arun_until_timeout, get_executor, run_until_timeout
+
+if TYPE_CHECKING:
+    # torch and transformers take seconds to import. They're imported on first use instead.
+    import torch
+    from transformers import GPT2LMHeadModel, GPT2Tokenizer, TextIteratorStreamer
 
 logger = app.logconfig.setup_logger("root")
 
@@ -21,6 +39,10 @@ PROMPT_TEMPLATE = (
 )
 
 
+PREFIX_CACHE = REGISTRY.counter("xbot_prefix_cache_total", "Lookups of the prompt prefix cache, by result.")
+TRUNCATED = REGISTRY.counter("xbot_llm_truncated_total", "Responses cut short by the generation deadline.")
+
+
 class LLMTimeoutError(Exception):
     """Raised when querying the LLM takes too long to respond."""
 
@@ -40,6 +62,24 @@ class GPT2Generator(Process):
         - Initialises model endpoint.
         - If error in LLM service, prepares a response
           containing the context references as fallback strategy
+        - If `batching` is enabled, concurrent requests are generated together, in padded batches. A batch of one
+          is generated as a single request.
+        - If `prefix_cache` is enabled, generation starts from the cached attention state of the
+          static start of the prompt template.
+        - Runs the model with the `backend` in `model_config`: `eager`, `int8` or `onnx` (see `_gpt2model`).
+        - If `workers` is enabled, generation runs on a pool of worker processes instead. Streamed responses
+          still run in this process, which loads the model for the first one.
+        - Generates up to `max_new_tokens`, or to a total of `max_length` tokens if it isn't set, and stops early
+          at any of the `stop_sequences` in `model_config`.
+        - Stops generating `deadline_margin` seconds before the `timeout`, and responds with the text generated
+          so far (see `GenerationDeadline`). Only the worker processes run to the `timeout`, and are restarted
+          if they overrun it.
+        - If `draft_model` is set in `model_config`, requests use speculative decoding: the small draft
+          model proposes tokens, and the model verifies them. The output is the same as without it.
+          Speculative decoding runs one request at a time, so `batching` is off.
+        - If `response_cache` is enabled, responses are cached by prompt and model config. Hits skip the LLM.
+        - The model, tokeniser and draft model are fetched from `app.registry.MODELS` on each use, so one
+          reloaded or evicted there is let go.
     """
 
     stage = RAGStage.GENERATE
@@ -52,21 +92,114 @@ class GPT2Generator(Process):
             self.template = PROMPT_TEMPLATE
         self.eos_token = self.config["model_config"].get("eos_token", "<|endoftext|>")
 
-        self.model, self.device = _gpt2model(config["model_config"])
-        self.tokenizer = _gpt2tokeniser(config["model_config"])
+        if config["model_config"].get("draft_model") and config["model_config"].get("backend", "eager") == "onnx":
+            raise ValueError("Speculative decoding with a draft_model needs the eager or int8 backend")
+        self.model: Any = None
+        self.device: Any = None
+        self.tokenizer: Any = None
+        self.draft_model: Any = None
+        self.prefix_cache: PrefixCache | None = None
+        self._model_lock = threading.Lock()
+
+        # Shared by generators with the same config, like the model
+        batching_config = {**config.get("batching", {})}
+        self.batcher: DynamicBatcher | None = None
+        if batching_config.pop("enabled", False) and not config["model_config"].get("draft_model"):
+            self.batcher = MODELS.get(
+                "gpt2_batcher",
+                config_key(config, "model_config", "batching", "prefix_cache", "prompt_template"),
+                lambda: DynamicBatcher("llm", self._query_llm_batched, **batching_config),
+            )
+
+        cache_config = {**config.get("response_cache", {})}
+        self.response_cache: BoundedCache | None = None
+        if cache_config.pop("enabled", False):
+            self.response_cache = MODELS.get(
+                "response_cache",
+                config_key(config, "response_cache"),
+                lambda: BoundedCache("response", **cache_config),
+            )
+
+        workers_config = {**config.get("workers", {})}
+        self.workers: GenerationWorkerPool | None = None
+        if workers_config.pop("enabled", False):
+            self.workers = MODELS.get(
+                "gpt2_workers",
+                config_key(config, "model_config", "workers"),
+                lambda: GenerationWorkerPool(config["model_config"], **workers_config),
+            )
+        # The worker processes load their own model. This one is only needed to stream, and is loaded then.
+        if self.workers is None:
+            self._load_model()
 
-    def query_llm(self, query: str) -> dict:
+    def _load_model(self) -> None:
+        """Fetches the model, tokeniser, and draft model if set, from the registry, which loads them once.
+        Called on each use, so a model reloaded or evicted in the registry is let go. Safe to call from many threads.
+        """
+        model_config = self.config["model_config"]
+        with self._model_lock:
+            model, device = get_gpt2model(model_config)
+            tokenizer = get_gpt2tokeniser(model_config)
+            draft_model = get_draft_model(model_config) if model_config.get("draft_model") else None
+            if model is self.model and tokenizer is self.tokenizer and draft_model is self.draft_model:
+                return
+            if draft_model is not None:
+                FORWARDS.attach(model)
+                FORWARDS.attach(draft_model)
+            self.prefix_cache = None
+            if self.config.get("prefix_cache") and model_config.get("backend", "eager") != "onnx":
+                # The ONNX Runtime session manages its own cache
+                self.prefix_cache = PrefixCache(model, tokenizer, device)
+            self.model, self.device, self.tokenizer, self.draft_model = model, device, tokenizer, draft_model
+
+    def query_llm(
+        self,
+        query: str,
+        streamer: TextIteratorStreamer | None = None,
+        deadline: GenerationDeadline | None = None,
+    ) -> dict:
         """
         A function that queries a language model to generate text based on a given input query string.
 
         Parameters:
             query (str): The input query string to generate text from.
+            streamer (TextIteratorStreamer): If given, receives the new text as it is generated.
+            deadline (GenerationDeadline): If given, generation stops when it is reached.
+
+        Returns:
+            dict: A dictionary containing the generated text, the token count, whether the deadline
+                cut the text short, the generation speed, and the share of draft tokens accepted,
+                if speculative decoding is enabled.
+        """
+        self._load_model()
+        stats: dict = {}
+        answer, token_count = self._generate_text(query, streamer, deadline, stats)
+        truncated = deadline is not None and deadline.reached
+        return {"text": answer, "token_count": token_count, "truncated": truncated, **generation_speed(stats)}
+
+    def query_llm_batch(self, queries: list[str], deadline: GenerationDeadline | None = None) -> list[dict]:
+        """
+        Batch counterpart of `query_llm`. The queries are padded and generated together in one model call.
+        A single query, or every query with a draft model, is generated with `query_llm` instead.
+
+        Parameters:
+            queries (list[str]): The input query strings to generate text from.
+            deadline (GenerationDeadline): If given, generation of the whole batch stops when it is reached.
 
         Returns:
-            dict: A dictionary containing the generated text and the token count.
+            list[dict]: For each query, a dictionary containing the generated text, the token count, and
+                whether the deadline cut the text short. Queries generated with `query_llm` get its generation
+                speed too.
         """
-        answer, token_count = self._generate_text(query)
-        return {"text": answer, "token_count": token_count}
+        self._load_model()
+        if len(queries) == 1 or self.draft_model is not None:
+            return [self.query_llm(query, None, deadline) for query in queries]
+        responses = self._generate_texts(queries, deadline)
+        # The batch shares the deadline, so it cuts every text short
+        truncated = deadline is not None and deadline.reached
+        return [
+            {"text": answer, "token_count": token_count, "truncated": truncated} for answer, token_count in responses
+        ]
 
     def synthesize_response(
         self, user_query: GenerateRequest, contexts: list[Context] | list[ContextWithMetadata], event_id: str
@@ -74,7 +207,8 @@ class GPT2Generator(Process):
         """
         Synthesizes a response to a user query using a language model.
 
-        Query's the LLM with a timeout limit.
+        Query's the LLM with a timeout limit. Runs on the worker processes, or joins a batch of concurrent
+        requests, if enabled. Cached responses are returned without querying the LLM.
         Captures metics: `query_llm_seconds` `response_token_count` `response_text` `prompt`
 
         Raises:
@@ -89,27 +223,222 @@ class GPT2Generator(Process):
             str: The generated response.
         """
 
-        prompt = self._format_prompt(user_query.user_query, contexts)
-        if self.config["model_config"]["max_length"] - len(prompt) <= 10:
-            logger.error(
-                "Query is too long to fit in the model's context window. {prompt_len}, {max_len}".format(
-                    prompt_len=len(prompt), max_len=self.config["model_config"]["max_length"]
-                )
+        prompt = self._prepare_prompt(user_query, contexts, event_id)
+        cached = self._cached_response(prompt, event_id)
+        if cached is not None:
+            return cached["text"]
+        deadline = self._deadline()
+
+        t0 = time.time()
+        if self.workers is not None or self.batcher is not None:
+            future = self._submit(prompt, deadline)
+            try:
+                response = future.result(timeout=self.config["timeout"])
+            except concurrent.futures.TimeoutError:
+                future.cancel()
+                raise LLMTimeoutError("Function query_llm took too long to respond")
+            except Exception as e:
+                raise LLMTimeoutError(f"Function query_llm failed. {e}") from e
+        else:
+            response = run_until_timeout(
+                self.query_llm, self.config["timeout"], LLMTimeoutError, prompt, None, deadline, resource="llm"
             )
+        t1 = time.time()
+        self._log_response(response, t1 - t0, event_id)
+        self._cache_response(prompt, response)
 
-        logger.debug(f"Prompt: {prompt}\n")
+        return response["text"]
 
-        logger.eval(event_id, {"metric": "prompt", "value": prompt})
+    async def asynthesize_response(
+        self, user_query: GenerateRequest, contexts: list[Context] | list[ContextWithMetadata], event_id: str
+    ) -> str:
+        """Async counterpart of `synthesize_response`. The CPU bound LLM query is offloaded to a worker thread.
+
+        Raises:
+            LLMTimeoutError: If the LLM takes too long to respond.
+        """
+
+        prompt = self._prepare_prompt(user_query, contexts, event_id)
+        cached = self._cached_response(prompt, event_id)
+        if cached is not None:
+            return cached["text"]
+        deadline = self._deadline()
 
         t0 = time.time()
-        response = run_until_timeout(self.query_llm, self.config["timeout"], LLMTimeoutError, prompt)
+        if self.workers is not None or self.batcher is not None:
+            future = self._submit(prompt, deadline)
+            try:
+                response = await asyncio.wait_for(asyncio.wrap_future(future), timeout=self.config["timeout"])
+            except TimeoutError:
+                future.cancel()
+                raise LLMTimeoutError("Function query_llm took too long to respond")
+            except Exception as e:
+                raise LLMTimeoutError(f"Function query_llm failed. {e}") from e
+        else:
+            response = await arun_until_timeout(
+                self.query_llm, self.config["timeout"], LLMTimeoutError, prompt, None, deadline, resource="llm"
+            )
         t1 = time.time()
-        logger.eval(event_id, {"metric": "query_llm_seconds", "value": t1 - t0})
+        self._log_response(response, t1 - t0, event_id)
+        self._cache_response(prompt, response)
+
+        return response["text"]
+
+    async def astream_response(
+        self, user_query: GenerateRequest, contexts: list[Context] | list[ContextWithMetadata], event_id: str
+    ) -> AsyncIterator[str]:
+        """Streaming counterpart of `asynthesize_response`. Yields the new text as the LLM generates it.
+
+        The LLM query runs on the `llm` pool, and stops at the generation deadline. It is abandoned, and
+        stopped, if the stream is closed early, or it isn't finished within the timeout.
+        Captures the same metrics as `synthesize_response`, once the stream finishes.
+
+        Raises:
+            LLMTimeoutError: If the LLM takes too long to respond, or can't be scheduled.
+        """
+
+        from transformers import TextIteratorStreamer
+
+        prompt = self._prepare_prompt(user_query, contexts, event_id)
+        cached = self._cached_response(prompt, event_id)
+        if cached is not None:
+            yield cached["text"]
+            return
+        await asyncio.to_thread(self._load_model)
+        streamer = TextIteratorStreamer(self.tokenizer, skip_prompt=True, skip_special_tokens=True)  # type: ignore
+        executor = get_executor("llm")
+
+        t0 = time.time()
+        deadline = time.monotonic() + self.config["timeout"]
+        generation_deadline = self._deadline()
+        try:
+            future = executor.submit(self.query_llm, prompt, streamer, generation_deadline)
+        except ExecutorSaturatedError as e:
+            raise LLMTimeoutError(f"query_llm could not be scheduled: {e}") from e
+        # `model.generate` only ends the stream when it succeeds
+        future.add_done_callback(lambda f: f.cancelled() or f.exception() is None or streamer.end())
+
+        stop_sequences = self.config["model_config"].get("stop_sequences", [])
+        try:
+            tokens = iter(streamer)
+            pending = ""
+            while True:
+                streamer.timeout = deadline - time.monotonic()
+                if streamer.timeout <= 0:
+                    raise LLMTimeoutError(f"query_llm took longer than {self.config['timeout']} seconds")
+                try:
+                    chunk = await asyncio.to_thread(next, tokens, None)
+                except queue.Empty:
+                    continue
+                if chunk is None:
+                    break
+                if pending is None:  # Past a stop sequence, until generation stops
+                    continue
+                text = cut_at_stop_sequence(pending + chunk, stop_sequences)
+                stopped = len(text) < len(pending + chunk)
+                # Hold back the end of the text if it could be the start of a stop sequence
+                held = 0 if stopped else _partial_stop_length(text, stop_sequences)
+                if text[: len(text) - held]:
+                    yield text[: len(text) - held]
+                pending = None if stopped else text[len(text) - held :]
+            if pending:
+                yield pending
+            response = await asyncio.wait_for(asyncio.wrap_future(future), max(deadline - time.monotonic(), 0))
+        except TimeoutError as e:
+            generation_deadline.cancel()
+            executor.abandon(future)
+            raise LLMTimeoutError(f"query_llm took longer than {self.config['timeout']} seconds") from e
+        except BaseException:
+            if not future.done():
+                generation_deadline.cancel()
+                executor.abandon(future)
+            raise
+        t1 = time.time()
+        self._log_response(response, t1 - t0, event_id)
+        self._cache_response(prompt, response)
+
+    def warmup(self) -> None:
+        """Computes the prefix cache, and generates a few tokens, so the first request doesn't pay for
+        lazy allocations. The worker processes warm up themselves, when they load the model, and this waits for them.
+        """
+        if self.workers is not None:
+            self.workers.wait_until_ready()
+            return
+        self._load_model()
+        prompt = self._format_prompt("warmup", [])
+        # A handful of new tokens is enough to run every kernel of the generation loop
+        model_config = {**self.config["model_config"], "max_new_tokens": 4}
+        with span("warmup.generate"):
+            gpt2_infer(
+                self.model,
+                self.tokenizer,
+                prompt,
+                self.device,  # type: ignore
+                model_config,
+                prefix=self._cached_prefix(),
+            )
+
+    def _cached_response(self, prompt: str, event_id: str) -> dict | None:
+        """The cached response to the prompt, if any. Captures the same metrics as a response from the LLM."""
+        if self.response_cache is None:
+            return None
+        response = self.response_cache.get(self._cache_key(prompt))
+        if response is not None:
+            logger.eval(event_id, {"metric": "response_cache_hit", "value": True})
+            logger.eval(event_id, {"metric": "response_text", "value": response["text"]})
+            logger.eval(event_id, {"metric": "response_token_count", "value": response["token_count"]})
+        return response
+
+    def _cache_response(self, prompt: str, response: dict) -> None:
+        # Responses cut short by the deadline would be served whole next time
+        if self.response_cache is not None and not response.get("truncated"):
+            self.response_cache.put(
+                self._cache_key(prompt), {"text": response["text"], "token_count": response["token_count"]}
+            )
+
+    def _cache_key(self, prompt: str) -> str:
+        return cache_key(prompt, self.config["model_config"])
+
+    def _deadline(self) -> GenerationDeadline:
+        """A generation deadline, far enough inside the timeout to return the text generated so far."""
+        return GenerationDeadline(self.config["timeout"] - self.config.get("deadline_margin", 0.5))
+
+    def _query_llm_batched(self, items: list[tuple[str, GenerationDeadline]]) -> list[dict]:
+        """`query_llm_batch` for the batcher. The batch stops at the earliest deadline of its requests."""
+        prompts = [prompt for prompt, _ in items]
+        return self.query_llm_batch(prompts, min((deadline for _, deadline in items), key=lambda d: d.deadline))
+
+    def _submit(self, prompt: str, deadline: GenerationDeadline) -> concurrent.futures.Future:
+        """Sends the prompt to the worker processes if enabled, otherwise to the batcher."""
+        try:
+            if self.workers is not None:
+                return self.workers.submit(prompt, self.config["timeout"])
+            return self.batcher.submit((prompt, deadline))  # type: ignore
+        except ExecutorSaturatedError as e:
+            raise LLMTimeoutError(f"Function query_llm could not be scheduled. {e}")
+
+    def _prepare_prompt(
+        self, user_query: GenerateRequest, contexts: list[Context] | list[ContextWithMetadata], event_id: str
+    ) -> str:
+        prompt = self._format_prompt(user_query.user_query, contexts)
+        logger.debug(f"Prompt: {prompt}\n")
+
+        logger.eval(event_id, {"metric": "prompt", "value": prompt})
+        return prompt
+
+    @staticmethod
+    def _log_response(response: dict, seconds: float, event_id: str) -> None:
+        logger.eval(event_id, {"metric": "query_llm_seconds", "value": seconds})
 
         logger.eval(event_id, {"metric": "response_text", "value": response["text"]})
         logger.eval(event_id, {"metric": "response_token_count", "value": response["token_count"]})
-
-        return response["text"]
+        if response.get("truncated"):
+            TRUNCATED.inc()
+            logger.eval(event_id, {"metric": "response_truncated", "value": True})
+        if response.get("tokens_per_second") is not None:
+            logger.eval(event_id, {"metric": "response_tokens_per_second", "value": response["tokens_per_second"]})
+        if response.get("acceptance_rate") is not None:
+            logger.eval(event_id, {"metric": "draft_acceptance_rate", "value": response["acceptance_rate"]})
 
     def _process(self, text: Any, data: dict, errors: ErrorStack, *_) -> tuple[Any, dict, ErrorStack, RAGStage]:
         query: GenerateRequest = data["user_query"]
@@ -120,20 +449,86 @@ class GPT2Generator(Process):
             consolidated_contexts = self.synthesize_response(query, contexts, event_id)
             next_text: str = consolidated_contexts
         except Exception as e:
-            if type(e) == LLMTimeoutError:
-                logger.error("Querying the LLM took too long to respond")
-            # Give the user the retrieved references verbatim.
-            response = self._fallback_response(
-                contexts, just_text=self.config["no_llm_fallback_strategy"] == "documents"
-            )
-            errors.append((self.stage, e))
-            logger.error(str(e) + "Applied a no-LLM fallback response.")
-            next_text = response["text"]
+            next_text = self._handle_error(e, contexts, errors)
+
+        return next_text, data, errors, self.next_stage
+
+    async def _aprocess(self, text: Any, data: dict, errors: ErrorStack, *_) -> tuple[Any, dict, ErrorStack, RAGStage]:
+        query: GenerateRequest = data["user_query"]
+        contexts: list[Context | ContextWithMetadata] = text
+        event_id: str = data["event_id"]
+
+        try:
+            next_text: str = await self.asynthesize_response(query, contexts, event_id)
+        except Exception as e:
+            next_text = self._handle_error(e, contexts, errors)
 
         return next_text, data, errors, self.next_stage
 
+    async def _astream(self, text: Any, data: dict, errors: ErrorStack, *_) -> AsyncIterator[str]:
+        query: GenerateRequest = data["user_query"]
+        contexts: list[Context | ContextWithMetadata] = text
+        event_id: str = data["event_id"]
+
+        streamed = False
+        try:
+            async for chunk in self.astream_response(query, contexts, event_id):
+                streamed = True
+                yield chunk
+        except Exception as e:
+            # The user may have seen part of the response. The fallback follows it.
+            yield ("\n\n" if streamed else "") + self._handle_error(e, contexts, errors)
+
+    def _process_batch(self, batch: list[PipeItem]) -> list[PipeItem]:
+        prompts = [self._prepare_prompt(data["user_query"], text, data["event_id"]) for text, data, *_ in batch]
+        outputs: list[PipeItem | None] = [None] * len(batch)
+        for i, (prompt, (_, data, errors, _)) in enumerate(zip(prompts, batch, strict=True)):
+            cached = self._cached_response(prompt, data["event_id"])
+            if cached is not None:
+                outputs[i] = (cached["text"], data, errors, self.next_stage)
+        misses = [i for i, output in enumerate(outputs) if output is None]
+        if not misses:
+            return outputs  # type: ignore
+
+        try:
+            t0 = time.time()
+            responses = run_until_timeout(
+                self.query_llm_batch,
+                self.config["timeout"],
+                LLMTimeoutError,
+                [prompts[i] for i in misses],
+                self._deadline(),
+                resource="llm",
+            )
+            t1 = time.time()
+        except Exception as e:
+            for i in misses:
+                text, data, errors, _ = batch[i]
+                outputs[i] = (self._handle_error(e, text, errors), data, errors, self.next_stage)
+            return outputs  # type: ignore
+
+        for i, response in zip(misses, responses, strict=True):
+            _, data, errors, _ = batch[i]
+            self._log_response(response, t1 - t0, data["event_id"])
+            self._cache_response(prompts[i], response)
+            outputs[i] = (response["text"], data, errors, self.next_stage)
+        return outputs  # type: ignore
+
+    def _handle_error(
+        self, e: Exception, contexts: list[Context] | list[ContextWithMetadata], errors: ErrorStack
+    ) -> str:
+        """Records the error, and returns a no-LLM fallback response."""
+        if type(e) == LLMTimeoutError:
+            logger.error("Querying the LLM took too long to respond")
+        # Give the user the retrieved references verbatim.
+        response = self._fallback_response(contexts, just_text=self.config["no_llm_fallback_strategy"] == "documents")
+        errors.append((self.stage, e))
+        logger.error(str(e) + "Applied a no-LLM fallback response.")
+        return response["text"]
+
     @staticmethod
     def _fallback_response(contexts: list[ContextWithMetadata | Context], just_text: bool = False) -> dict:
+        FALLBACKS.inc(kind="response", stage=RAGStage.GENERATE.name)
         if just_text:
             context_text = "".join([c.text for c in contexts])
             response = {"text": NO_LLM_DOCUMENTS_PROMPT.format(documents=context_text), "token_count": None}
@@ -149,20 +544,229 @@ class GPT2Generator(Process):
             response = {"text": NO_LLM_REFERENCES_PROMPT.format(urls_titles=context_urls_titles), "token_count": None}
         return response
 
-    def _generate_text(self, text: str) -> tuple[str, int]:
+    def _generate_text(
+        self,
+        text: str,
+        streamer: TextIteratorStreamer | None = None,
+        deadline: GenerationDeadline | None = None,
+        stats: dict | None = None,
+    ) -> tuple[str, int]:
         text, tc = gpt2_infer(
-            self.model, self.tokenizer, text, self.device, self.config["model_config"]  # type: ignore
+            self.model,
+            self.tokenizer,
+            text,
+            self.device,  # type: ignore
+            self.config["model_config"],
+            streamer,
+            None if self.draft_model is not None else self._cached_prefix(),
+            deadline,
+            draft_model=self.draft_model,
+            stats=stats,
         )
         return text, tc
 
+    def _generate_texts(self, texts: list[str], deadline: GenerationDeadline | None = None) -> list[tuple[str, int]]:
+        return gpt2_infer_batch(
+            self.model,
+            self.tokenizer,
+            texts,
+            self.device,  # type: ignore
+            self.config["model_config"],
+            self._cached_prefix(),
+            deadline,
+        )
+
+    def _cached_prefix(self) -> tuple[torch.Tensor, Any] | None:
+        if self.prefix_cache is None:
+            return None
+        return self.prefix_cache.get(self._static_prefix(), self.config["model_config"])
+
+    def _static_prefix(self) -> str:
+        """The start of every prompt, up to the last line break before the first field of the template."""
+        static = self.template.partition("{")[0]
+        return static[: static.rfind("\n") + 1]
+
     def _format_prompt(self, user_query: str, contexts: list[Context] | list[ContextWithMetadata]) -> str:
         context_text = "".join([c.text for c in contexts])
         query = self.template.format(user_query=user_query, context=context_text)
         return query + self.eos_token
 
 
+class PrefixCache:
+    """Keeps the attention keys and values (`past_key_values`) of a prompt prefix shared by every request,
+    so generation doesn't recompute them.
+
+    Only the last prefix is kept. It is recomputed when the prefix text or the model config changes.
+    """
+
+    def __init__(self, model: GPT2LMHeadModel, tokeniser: GPT2Tokenizer, device: str) -> None:
+        self.model = model
+        self.tokeniser = tokeniser
+        self.device = device
+        self._key: tuple[str, str] | None = None
+        self._entry: tuple[torch.Tensor, Any] | None = None
+        self._lock = threading.Lock()
+
+    def get(self, prefix: str, config: dict) -> tuple[torch.Tensor, Any] | None:
+        """The token ids of the prefix, and their `past_key_values`. None if the prefix is empty."""
+        import torch
+
+        if not prefix:
+            return None
+        key = (prefix, json.dumps(config, sort_keys=True, default=str))
+        with self._lock:
+            if self._key == key:
+                PREFIX_CACHE.inc(result="hit")
+                return self._entry
+            PREFIX_CACHE.inc(result="miss")
+            with span("prefix_cache.compute"), torch.no_grad():
+                input_ids = self.tokeniser.encode(prefix, return_tensors="pt").to(self.device)  # type: ignore
+                past_key_values = self.model(input_ids, use_cache=True).past_key_values
+            self._key, self._entry = key, (input_ids, past_key_values)
+            return self._entry
+
+    def clear(self) -> None:
+        with self._lock:
+            self._key, self._entry = None, None
+
+
+class ForwardCounter:
+    """Counts the forward passes of models, per thread. `model.generate` runs in the calling thread, so the
+    difference in counts across a call to it is the passes that call made, whatever other threads are doing.
+    """
+
+    def __init__(self) -> None:
+        self._local = threading.local()
+        self._attached: set[int] = set()
+        self._lock = threading.Lock()
+
+    def attach(self, model: torch.nn.Module) -> None:
+        """Starts counting the forward passes of the model. Models are attached once."""
+        with self._lock:
+            if id(model) in self._attached:
+                return
+            self._attached.add(id(model))
+        model.register_forward_hook(lambda module, *_: self._increment(id(module)))
+
+    def count(self, model: torch.nn.Module) -> int:
+        return getattr(self._local, "counts", {}).get(id(model), 0)
+
+    def _increment(self, key: int) -> None:
+        counts = self._local.__dict__.setdefault("counts", {})
+        counts[key] = counts.get(key, 0) + 1
+
+
+FORWARDS = ForwardCounter()
+
+
+class GenerationDeadline:
+    """A wall-clock deadline for `model.generate`, checked after each new token, as a stopping criterion.
+    Generation stops when it is reached, and keeps the tokens generated so far.
+
+    `cancel` stops generation at the next token, e.g. once nobody is waiting for the response, so an
+    abandoned generation doesn't keep using the CPU.
+    """
+
+    def __init__(self, seconds: float) -> None:
+        self.deadline = time.monotonic() + seconds
+        self.reached = False
+
+    def cancel(self) -> None:
+        self.deadline = -math.inf
+
+    def __call__(self, *_: Any, **__: Any) -> bool:
+        self.reached = time.monotonic() >= self.deadline
+        return self.reached
+
+
+class StopSequences:
+    """A stopping criterion for `model.generate`, that stops once every sequence in the batch has generated one
+    of the stop sequences, or the eos token. Only the last few tokens are decoded at each step.
+
+    The stop sequence, and anything generated after it, is cut from the text by `cut_at_stop_sequence`.
+    """
+
+    def __init__(self, tokeniser: GPT2Tokenizer, stop_sequences: list[str], prompt_length: int) -> None:
+        self.tokeniser = tokeniser
+        self.stop_sequences = stop_sequences
+        self.prompt_length = prompt_length
+        # Enough tokens to hold the longest stop sequence, however it is split into tokens
+        self.window = max(len(tokeniser.encode(stop)) for stop in stop_sequences) + 2
+        self.stopped: set[int] = set()
+
+    def __call__(self, input_ids: torch.Tensor, *_: Any, **__: Any) -> bool:
+        start = max(self.prompt_length, input_ids.shape[1] - self.window)
+        for i, ids in enumerate(input_ids):
+            if i in self.stopped:
+                continue
+            new_tokens = ids[start:].tolist()
+            tail = self.tokeniser.decode(new_tokens)
+            if self.tokeniser.eos_token_id in new_tokens or any(stop in tail for stop in self.stop_sequences):
+                self.stopped.add(i)
+        return len(self.stopped) == input_ids.shape[0]
+
+
+def cut_at_stop_sequence(text: str, stop_sequences: list[str]) -> str:
+    """The text up to the first stop sequence in it."""
+    cuts = [i for i in (text.find(stop) for stop in stop_sequences) if i >= 0]
+    return text[: min(cuts)] if cuts else text
+
+
+def generation_speed(stats: dict) -> dict:
+    """The `tokens_per_second` of a generation, from the `stats` of `gpt2_infer`, and with speculative decoding,
+    the `acceptance_rate` of the draft tokens.
+    """
+    speed = {}
+    if stats.get("seconds"):
+        speed["tokens_per_second"] = stats["new_tokens"] / stats["seconds"]
+    if stats.get("draft_tokens"):
+        # Each verification step accepts some draft tokens, and adds one token of the model's own
+        accepted = max(stats["new_tokens"] - stats["steps"], 0)
+        speed["acceptance_rate"] = min(accepted / stats["draft_tokens"], 1.0)
+    return speed
+
+
+def _partial_stop_length(text: str, stop_sequences: list[str]) -> int:
+    """The length of the longest end of the text that is the start of a stop sequence."""
+    return max((k for stop in stop_sequences for k in range(1, len(stop)) if text.endswith(stop[:k])), default=0)
+
+
+def _stopping_criteria(
+    tokeniser: GPT2Tokenizer, config: dict, prompt_length: int, deadline: GenerationDeadline | None
+) -> Any:
+    from transformers import StoppingCriteriaList
+
+    criteria: list = [deadline] if deadline is not None else []
+    if config.get("stop_sequences"):
+        criteria.append(StopSequences(tokeniser, config["stop_sequences"], prompt_length))
+    return StoppingCriteriaList(criteria)
+
+
+def _generation_length(config: dict, prompt_tokens: int, context_length: int) -> dict:
+    """The `max_new_tokens` of the config, or else its `max_length`, as `model.generate` arguments.
+    Logs an error if the prompt leaves little or no room in the model's context window.
+    """
+    new_tokens = config.get("max_new_tokens") or config["max_length"] - prompt_tokens
+    if new_tokens <= 10 or prompt_tokens + new_tokens > context_length:
+        logger.error(
+            f"Query is too long to fit in the model's context window. {prompt_tokens=} {new_tokens=} {context_length=}"
+        )
+    if config.get("max_new_tokens"):
+        return {"max_new_tokens": config["max_new_tokens"]}
+    return {"max_length": config["max_length"]}
+
+
 def gpt2_infer(
-    model: GPT2LMHeadModel, tokeniser: GPT2Tokenizer, input_text: str, device: str = "cpu", config: dict = None
+    model: GPT2LMHeadModel,
+    tokeniser: GPT2Tokenizer,
+    input_text: str,
+    device: str = "cpu",
+    config: dict = None,
+    streamer: TextIteratorStreamer | None = None,
+    prefix: tuple[torch.Tensor, Any] | None = None,
+    deadline: GenerationDeadline | None = None,
+    draft_model: GPT2LMHeadModel | None = None,
+    stats: dict | None = None,
 ) -> tuple[str, int]:  # type: ignore
     """
     Uses a GPT-2 model to generate text based on the input_text provided.
@@ -173,6 +777,18 @@ def gpt2_infer(
         input_text (str): The input text to base the generation on.
         device (str): The device to use for generation, default is 'cpu'.
         config (dict): A dictionary containing configuration parameters for generation.
+        streamer (TextIteratorStreamer): If given, receives the new text as it is generated.
+        prefix (tuple): The token ids of a prefix, and their `past_key_values` (see `PrefixCache`).
+            Used if `input_text` starts with the prefix, so attention over it isn't recomputed.
+        deadline (GenerationDeadline): If given, generation stops when it is reached.
+        draft_model: If given, a smaller model with the same tokeniser, which proposes tokens for the model
+            to verify (speculative decoding). The output is the same as greedy decoding with the model alone.
+            The prefix is not used with a draft model, which keeps its own cache.
+        stats (dict): If given, receives the `prompt_tokens`, `new_tokens` and generation `seconds`, and with a
+            draft model, the `draft_tokens` it proposed and the verification `steps` of the model.
+
+    Generates up to `config['max_new_tokens']` if set, otherwise to a total of `config['max_length']` tokens,
+    and stops early at any of `config['stop_sequences']`.
 
     Returns:
         Tuple[str,int]: A tuple containing the generated response text and the token count.
@@ -189,40 +805,295 @@ def gpt2_infer(
     >>> response = gpt2_infer(m, tk, input_text, d, config)
     """
 
+    import torch
+
     assert isinstance(input_text, str), f"input_text must be a string, got {type(input_text)}"
 
-    input_ids = tokeniser.encode(input_text, return_tensors="pt").to(device)  # type: ignore
+    with span("tokeniser.encode"):
+        input_ids = tokeniser.encode(input_text, return_tensors="pt").to(device)  # type: ignore
+
+    past_key_values = None
+    if prefix is not None and draft_model is None and config["num_return_sequences"] == 1:
+        prefix_ids, prefix_past = prefix
+        n = prefix_ids.shape[1]
+        if input_ids.shape[1] > n and torch.equal(input_ids[:, :n], prefix_ids):
+            past_key_values = _expand_past(prefix_past, 1)
+
+    prompt_tokens = input_ids.shape[1]
+    length = _generation_length(config, prompt_tokens, model.config.n_positions)
+    # Speculative decoding proposes and verifies one sequence at a time
+    assistant = {}
+    if draft_model is not None and config["num_return_sequences"] == 1:
+        assistant = {"assistant_model": draft_model}
 
     # Generate text
-    output = model.generate(
-        input_ids,
-        max_length=config["max_length"],
-        num_return_sequences=config["num_return_sequences"],
-        no_repeat_ngram_size=config["no_repeat_ngram_size"],
-    )
+    steps = FORWARDS.count(model)
+    draft_tokens = FORWARDS.count(draft_model) if assistant else 0
+    t0 = time.perf_counter()
+    with span(
+        "model.generate",
+        prompt_tokens=prompt_tokens,
+        **length,
+        cached_tokens=0 if past_key_values is None else prefix_ids.shape[1],
+        speculative=bool(assistant),
+    ):
+        output = model.generate(
+            input_ids,
+            attention_mask=torch.ones_like(input_ids),
+            past_key_values=past_key_values,
+            **length,
+            num_return_sequences=config["num_return_sequences"],
+            no_repeat_ngram_size=config["no_repeat_ngram_size"],
+            stopping_criteria=_stopping_criteria(tokeniser, config, prompt_tokens, deadline),
+            streamer=streamer,
+            **assistant,
+        )
+    if stats is not None:
+        stats.update(prompt_tokens=prompt_tokens, new_tokens=len(output[0]) - prompt_tokens)
+        stats["seconds"] = time.perf_counter() - t0
+        if assistant:
+            stats["steps"] = FORWARDS.count(model) - steps
+            stats["draft_tokens"] = FORWARDS.count(draft_model) - draft_tokens
 
     # Decode the output
     generated_text = tokeniser.decode(output[0], skip_special_tokens=True)
     token_count = len(output[0])
-    response = generated_text[len(input_text) - 1 :]
+    response = cut_at_stop_sequence(generated_text[len(input_text) - 1 :], config.get("stop_sequences", []))
     return response, token_count
 
 
+# Copies of shared tokenisers, set up to pad batches, see `_batch_tokeniser`
+_BATCH_TOKENISERS: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+_BATCH_TOKENISERS_LOCK = threading.Lock()
+
+
+def _batch_tokeniser(tokeniser: GPT2Tokenizer) -> GPT2Tokenizer:
+    """A copy of the tokeniser that pads on the left, with the eos token, made once per tokeniser.
+
+    GPT-2 has no padding token. Padding on the left keeps the last prompt token adjacent to the generated ones.
+    The shared tokeniser is left as it is, for single requests and streaming.
+    """
+    with _BATCH_TOKENISERS_LOCK:
+        if tokeniser not in _BATCH_TOKENISERS:
+            batch_tokeniser = copy.deepcopy(tokeniser)
+            batch_tokeniser.padding_side = "left"
+            if batch_tokeniser.pad_token is None:
+                batch_tokeniser.pad_token = batch_tokeniser.eos_token
+            _BATCH_TOKENISERS[tokeniser] = batch_tokeniser
+        return _BATCH_TOKENISERS[tokeniser]
+
+
+def gpt2_infer_batch(
+    model: GPT2LMHeadModel,
+    tokeniser: GPT2Tokenizer,
+    input_texts: list[str],
+    device: str = "cpu",
+    config: dict | None = None,
+    prefix: tuple[torch.Tensor, Any] | None = None,
+    deadline: GenerationDeadline | None = None,
+) -> list[tuple[str, int]]:  # type: ignore
+    """
+    Batch counterpart of `gpt2_infer`. Prompts are left-padded to the same length, with an attention mask,
+    and generated together in a single call to `model.generate`.
+
+    Each prompt gets the same number of new tokens as `gpt2_infer`, `config['max_new_tokens']`. Without it, each
+    is limited to the same total length, `config['max_length']`: the batch is generated until the shortest
+    prompt reaches it, and the new tokens of longer prompts are cut to fit. Generation stops early once every
+    prompt has reached one of `config['stop_sequences']`, or the eos token.
+
+    Args:
+        model: The GPT-2 model to use for text generation.
+        tokeniser: The tokeniser to encode and decode text for the model.
+        input_texts (list[str]): The input texts to base each generation on.
+        device (str): The device to use for generation, default is 'cpu'.
+        config (dict): A dictionary containing configuration parameters for generation.
+        prefix (tuple): The token ids of a prefix, and their `past_key_values` (see `PrefixCache`).
+            Used if every input text starts with the prefix. The rest of each prompt is left-padded after it.
+        deadline (GenerationDeadline): If given, generation of the whole batch stops when it is reached.
+
+    Returns:
+        list[Tuple[str,int]]: For each input text, the generated response text and the token count.
+    """
+
+    assert all(isinstance(t, str) for t in input_texts), "input_texts must be a list of strings"
+
+    tokeniser = _batch_tokeniser(tokeniser)
+    with span("tokeniser.encode", batch_size=len(input_texts)):
+        encoded, past_key_values = None, None
+        if prefix is not None and config["num_return_sequences"] == 1:
+            encoded, past_key_values = _encode_after_prefix(tokeniser, input_texts, prefix, device)
+        if encoded is None:
+            encoded = tokeniser(input_texts, return_tensors="pt", padding=True).to(device)  # type: ignore
+    prompt_lengths = encoded["attention_mask"].sum(dim=1).tolist()
+    padded_length = encoded["input_ids"].shape[1]
+    _generation_length(config, max(prompt_lengths), model.config.n_positions)
+    max_new_tokens = config.get("max_new_tokens") or max(config["max_length"] - min(prompt_lengths), 1)
+
+    with span(
+        "model.generate", batch_size=len(input_texts), prompt_tokens=padded_length, cached=past_key_values is not None
+    ):
+        output = model.generate(
+            encoded["input_ids"],
+            attention_mask=encoded["attention_mask"],
+            past_key_values=past_key_values,
+            pad_token_id=tokeniser.pad_token_id,
+            max_new_tokens=max_new_tokens,
+            num_return_sequences=config["num_return_sequences"],
+            no_repeat_ngram_size=config["no_repeat_ngram_size"],
+            stopping_criteria=_stopping_criteria(tokeniser, config, padded_length, deadline),
+        )
+
+    responses = []
+    for i, prompt_length in enumerate(prompt_lengths):
+        new_tokens = output[i * config["num_return_sequences"]][padded_length:].tolist()
+        if not config.get("max_new_tokens"):
+            new_tokens = new_tokens[: max(config["max_length"] - prompt_length, 1)]
+        # Sequences that finished early are right-padded with the eos token. Keep the first eos, as `gpt2_infer` does.
+        if tokeniser.eos_token_id in new_tokens:
+            new_tokens = new_tokens[: new_tokens.index(tokeniser.eos_token_id) + 1]
+        generated_text = cut_at_stop_sequence(
+            tokeniser.decode(new_tokens, skip_special_tokens=True), config.get("stop_sequences", [])
+        )
+        responses.append((generated_text, prompt_length + len(new_tokens)))
+    return responses
+
+
+def _encode_after_prefix(
+    tokeniser: GPT2Tokenizer, input_texts: list[str], prefix: tuple[torch.Tensor, Any], device: str
+) -> tuple[dict | None, Any]:
+    """Encodes the input texts as the prefix, then the rest of each text left-padded to the same length.
+    Returns `(None, None)` unless every text is tokenised starting with the prefix tokens.
+    """
+    import torch
+
+    prefix_ids, prefix_past = prefix
+    n = prefix_ids.shape[1]
+    token_ids = [tokeniser.encode(text) for text in input_texts]
+    if not all(len(ids) > n and ids[:n] == prefix_ids[0].tolist() for ids in token_ids):
+        return None, None
+
+    batch_size = len(input_texts)
+    rest = tokeniser.pad({"input_ids": [ids[n:] for ids in token_ids]}, return_tensors="pt").to(device)  # type: ignore
+    encoded = {
+        "input_ids": torch.cat([prefix_ids.expand(batch_size, -1), rest["input_ids"]], dim=1),
+        "attention_mask": torch.cat(
+            [torch.ones_like(prefix_ids).expand(batch_size, -1), rest["attention_mask"]], dim=1
+        ),
+    }
+    return encoded, _expand_past(prefix_past, batch_size)
+
+
+def _expand_past(past_key_values: Any, batch_size: int) -> Any:
+    """Views of the cached keys and values, for each prompt in a batch.
+
+    GPT-2 extends its cache by concatenating new tensors, so the cached ones are never modified.
+    """
+    return tuple(tuple(t.expand(batch_size, *t.shape[1:]) for t in layer) for layer in past_key_values)
+
+
+def get_gpt2tokeniser(config: dict) -> GPT2Tokenizer:
+    """The tokeniser of the `model` in the model config. Loaded once per model, and shared."""
+    return MODELS.get("gpt2_tokeniser", config_key(config, "model"), lambda: _gpt2tokeniser(config))
+
+
+def get_gpt2model(config: dict) -> tuple[GPT2LMHeadModel, torch.device]:
+    """The `model` in the model config, and its device. Loaded once per model, device and backend, and shared."""
+    return MODELS.get(
+        "gpt2_model", config_key(config, "model", "device", "backend", "onnx_export"), lambda: _gpt2model(config)
+    )
+
+
+def get_draft_model(config: dict) -> GPT2LMHeadModel:
+    """The `draft_model` in the model config, on the same device as the model. Loaded once per model, and shared."""
+    return MODELS.get(
+        "gpt2_draft_model",
+        config_key(config, "draft_model", "draft_tokens", "device", "backend"),
+        lambda: _draft_model(config),
+    )
+
+
 def _gpt2tokeniser(config: dict) -> GPT2Tokenizer:
+    from transformers import GPT2Tokenizer
+
     # Load the pre-trained GPT-2 model and tokenizer
     tokenizer = GPT2Tokenizer.from_pretrained(config["model"])
     return tokenizer
 
 
+BACKENDS = ("eager", "int8", "onnx")
+
+
 def _gpt2model(config: dict):
+    """Loads the model for the `backend` in the model config. Every backend implements `generate`.
+
+    - `eager`: The fp32 PyTorch model (default).
+    - `int8`: The PyTorch model, with its linear layers dynamically quantized to int8. CPU only.
+    - `onnx`: The model exported to ONNX, run by an ONNX Runtime session. CPU only. Needs `optimum[onnxruntime]`.
+    """
+    import torch
+    from transformers import GPT2LMHeadModel
+
+    backend = config.get("backend", "eager")
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown backend {backend!r}. Expected one of {BACKENDS}")
 
-    if config["device"] == "cuda":
+    if config["device"] == "cuda" and backend == "eager":
         device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
     else:
         device = torch.device("cpu")
 
+    if backend == "onnx":
+        return _gpt2onnx(config), device
+
     model = GPT2LMHeadModel.from_pretrained(config["model"])
 
-    if config["device"] == "cuda":
+    if backend == "int8":
+        model = _quantize_int8(model)
+    elif config["device"] == "cuda":
         model.to(device)  # type: ignore
     return model, device
+
+
+def _draft_model(config: dict) -> GPT2LMHeadModel:
+    """Loads the draft model for speculative decoding. It must share the model's tokeniser, e.g. `distilgpt2`
+    for `gpt2`. `draft_tokens` is how many tokens it proposes at first. The number adapts to how many are accepted.
+    """
+    import torch
+    from transformers import GPT2LMHeadModel
+
+    model = GPT2LMHeadModel.from_pretrained(config["draft_model"])
+    model.generation_config.num_assistant_tokens = config.get("draft_tokens", 5)
+    # On the model's device, see `_gpt2model`
+    if config["device"] == "cuda" and config.get("backend", "eager") == "eager" and torch.cuda.is_available():
+        model.to(torch.device("cuda"))  # type: ignore
+    return model
+
+
+def _quantize_int8(model: GPT2LMHeadModel) -> GPT2LMHeadModel:
+    """Dynamically quantizes the weights of the linear layers to int8. Activations are quantized on the fly.
+
+    GPT-2 implements its attention and MLP projections as `Conv1D`, which dynamic quantization skips,
+    so they are converted to the equivalent `nn.Linear` first.
+    """
+    import torch
+    from transformers.pytorch_utils import Conv1D
+
+    for module in list(model.modules()):
+        for name, child in module.named_children():
+            if isinstance(child, Conv1D):
+                in_features, out_features = child.weight.shape
+                linear = torch.nn.Linear(in_features, out_features)
+                linear.weight.data = child.weight.data.T.contiguous()
+                linear.bias.data = child.bias.data
+                setattr(module, name, linear)
+    return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+
+def _gpt2onnx(config: dict) -> Any:
+    try:
+        from optimum.onnxruntime import ORTModelForCausalLM
+    except ImportError as e:
+        raise ImportError("The onnx backend needs optimum[onnxruntime]. `pip install xbot[onnx]`") from e
+
+    # Exports the model to ONNX on first load. Point `model` at an exported model to skip the export.
+    return ORTModelForCausalLM.from_pretrained(config["model"], export=config.get("onnx_export", True))
@@ -0,0 +1,249 @@
+"""A pool of worker processes for model inference, so generation isn't bound by the API process's GIL.
+
+Each worker loads the model once, and takes prompts from its own pipe. A dispatcher thread per worker
+feeds it from a shared queue, enforces deadlines, and restarts workers that crash or overrun.
+"""
+
+import concurrent.futures
+import functools
+import multiprocessing
+import queue
+import threading
+import time
+from collections.abc import Callable
+from multiprocessing.connection import Connection
+from typing import Any
+
+import app.logconfig
+from app.metrics import REGISTRY
+from app.utils import ExecutorSaturatedError
+
+logger = app.logconfig.setup_logger("root")
+
+WORKER_RESTARTS = REGISTRY.counter("xbot_llm_worker_restarts_total", "LLM worker processes restarted, by reason.")
+
+
+class WorkerCrashedError(Exception):
+    """Raised when a worker process exits while generating."""
+
+    pass
+
+
+class WorkerDeadlineError(Exception):
+    """Raised when a worker process overruns its deadline, and is restarted."""
+
+    pass
+
+
+def _load_gpt2(model_config: dict, num_threads: int = 1) -> tuple:
+    import torch
+
+    from app.generate.generate import FORWARDS, get_draft_model, get_gpt2model, get_gpt2tokeniser, gpt2_infer
+
+    torch.set_num_threads(num_threads)
+    model, device = get_gpt2model(model_config)
+    tokeniser = get_gpt2tokeniser(model_config)
+    draft_model = None
+    if model_config.get("draft_model"):
+        draft_model = get_draft_model(model_config)
+        FORWARDS.attach(model)
+        FORWARDS.attach(draft_model)
+    # A handful of new tokens is enough to run every kernel of the generation loop, before the worker is ready
+    gpt2_infer(model, tokeniser, "warmup", device, {**model_config, "max_new_tokens": 4}, draft_model=draft_model)
+    return model, tokeniser, device, draft_model
+
+
+def _infer_gpt2(state: tuple, prompt: str, model_config: dict) -> dict:
+    from app.generate.generate import generation_speed, gpt2_infer
+
+    model, tokeniser, device, draft_model = state
+    stats: dict = {}
+    text, token_count = gpt2_infer(model, tokeniser, prompt, device, model_config, draft_model=draft_model, stats=stats)
+    return {"text": text, "token_count": token_count, **generation_speed(stats)}
+
+
+def _worker_main(conn: Connection, model_config: dict, load: Callable, infer: Callable) -> None:
+    """Entry point of a worker process. Replies `("ok", result)` or `("error", message)` to each prompt."""
+    state = load(model_config)
+    conn.send(("ready", None))
+    while True:
+        prompt = conn.recv()
+        if prompt is None:
+            return
+        try:
+            conn.send(("ok", infer(state, prompt, model_config)))
+        except Exception as e:
+            conn.send(("error", f"{type(e).__name__}: {e}"))
+
+
+class _Worker:
+    def __init__(self, pool: "GenerationWorkerPool", index: int) -> None:
+        self.pool = pool
+        self.name = f"xbot-llm-worker-{index}"
+        self.process: multiprocessing.process.BaseProcess | None = None
+        self.conn: Connection | None = None
+        # Set once the worker has first loaded its model
+        self.ready = threading.Event()
+        self.dispatcher = threading.Thread(target=self._dispatch, name=f"{self.name}-dispatcher", daemon=True)
+
+    def start(self) -> None:
+        self.conn, child_conn = self.pool.context.Pipe()
+        self.process = self.pool.context.Process(
+            target=_worker_main,
+            args=(child_conn, self.pool.model_config, self.pool.load, self.pool.infer),
+            name=self.name,
+            daemon=True,
+        )
+        self.process.start()
+        child_conn.close()
+
+    def restart(self, reason: str) -> None:
+        WORKER_RESTARTS.inc(reason=reason)
+        logger.error(f"Restarting {self.name} after a {reason}")
+        self.stop()
+        self.start()
+
+    def stop(self) -> None:
+        if self.process is not None and self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+        if self.conn is not None:
+            self.conn.close()
+
+    def _wait_until_ready(self) -> None:
+        """Blocks until the worker has loaded the model. Restarts it if it dies while loading, waiting twice as
+        long after each failure, up to `max_backoff_seconds`, so a model that can't be loaded isn't reloaded
+        in a loop.
+        """
+        backoff = 1.0
+        while True:
+            try:
+                self.conn.recv()  # type: ignore
+                return
+            except (EOFError, OSError):
+                if self.pool.closed:
+                    return
+                time.sleep(backoff)
+                backoff = min(backoff * 2, self.pool.max_backoff_seconds)
+                self.restart("crash")
+
+    def _dispatch(self) -> None:
+        self._wait_until_ready()
+        self.ready.set()
+        while not self.pool.closed:
+            item = self.pool.queue.get()
+            if item is None:
+                return
+            prompt, future, deadline = item
+            if not future.set_running_or_notify_cancel():
+                continue
+            sent = time.monotonic()
+            if sent >= deadline:
+                # Expired while queued. The worker is healthy, so it isn't restarted.
+                from app.generate.generate import LLMTimeoutError
+
+                future.set_exception(LLMTimeoutError(f"The prompt waited past its deadline for {self.name}"))
+                continue
+            try:
+                self.conn.send(prompt)  # type: ignore
+                # Give the worker a moment past the deadline before restarting it, the caller has already given up.
+                if not self.conn.poll(deadline - sent + self.pool.grace_seconds):  # type: ignore
+                    future.set_exception(WorkerDeadlineError(f"{self.name} overran its deadline"))
+                    self.restart("deadline")
+                    self._wait_until_ready()
+                    continue
+                status, value = self.conn.recv()  # type: ignore
+            except (EOFError, OSError):
+                future.set_exception(WorkerCrashedError(f"{self.name} exited while generating"))
+                self.restart("crash")
+                self._wait_until_ready()
+                continue
+
+            if status == "ok":
+                future.set_result(value)
+            else:
+                future.set_exception(RuntimeError(value))
+
+
+class GenerationWorkerPool:
+    """Runs model inference on a pool of worker processes. Each loads the model once, at start-up.
+
+    Args:
+        model_config (dict): The `model_config` of the generator, passed to each worker.
+        processes (int): Number of worker processes.
+        threads_per_worker (int): `torch.set_num_threads` in each worker, set by the default `load`. Workers
+            times threads should not exceed the number of cores.
+        max_queue (int): Maximum number of prompts waiting for a worker.
+        grace_seconds (float): How long a worker may overrun a prompt's deadline before it is restarted.
+        max_backoff_seconds (float): Longest wait before restarting a worker that failed to load the model.
+        load (Callable): Loads the model in a worker, from the model config. Must be picklable. Defaults to
+            loading the generator's GPT-2 model, and warming it up with a few tokens.
+        infer (Callable): `(loaded model, prompt, model config) -> response`, where the response is as
+            `GPT2Generator.query_llm`. Must be picklable.
+    """
+
+    def __init__(
+        self,
+        model_config: dict,
+        processes: int = 2,
+        threads_per_worker: int = 1,
+        max_queue: int = 64,
+        grace_seconds: float = 1.0,
+        max_backoff_seconds: float = 60.0,
+        load: Callable | None = None,
+        infer: Callable = _infer_gpt2,
+    ) -> None:
+        self.model_config = model_config
+        self.threads_per_worker = threads_per_worker
+        self.max_queue = max_queue
+        self.grace_seconds = grace_seconds
+        self.max_backoff_seconds = max_backoff_seconds
+        self.load = load or functools.partial(_load_gpt2, num_threads=threads_per_worker)
+        self.infer = infer
+        # Forking a process that has loaded torch, and started threads, is not safe
+        self.context = multiprocessing.get_context("spawn")
+        self.queue: queue.Queue[tuple[str, concurrent.futures.Future, float] | None] = queue.Queue(max_queue)
+        self.closed = False
+
+        self.workers = [_Worker(self, i) for i in range(processes)]
+        for worker in self.workers:
+            worker.start()
+            worker.dispatcher.start()
+
+    def submit(self, prompt: str, timeout: float) -> concurrent.futures.Future:
+        """Queues the prompt for the next free worker. Returns a future for its response.
+
+        The future fails with `LLMTimeoutError` if the timeout passes before a worker is free, with
+        `WorkerDeadlineError` if the worker overruns it, or with `WorkerCrashedError` if the worker exits.
+
+        Raises:
+            ExecutorSaturatedError: If `max_queue` prompts are already waiting.
+        """
+        future: concurrent.futures.Future = concurrent.futures.Future()
+        try:
+            self.queue.put_nowait((prompt, future, time.monotonic() + timeout))
+        except queue.Full:
+            raise ExecutorSaturatedError(f"The LLM worker pool is full ({self.max_queue} waiting)")
+        return future
+
+    def wait_until_ready(self, timeout: float | None = None) -> bool:
+        """Blocks until every worker has loaded, and warmed up, its model. False if the timeout passes first."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for worker in self.workers:
+            if not worker.ready.wait(None if deadline is None else max(deadline - time.monotonic(), 0)):
+                return False
+        return True
+
+    def close(self) -> None:
+        """Stops the workers. Prompts still queued are left unanswered."""
+        self.closed = True
+        for _ in self.workers:
+            self.queue.put(None)
+        for worker in self.workers:
+            worker.stop()
+
+    def __enter__(self) -> "GenerationWorkerPool":
+        return self
+
+    def __exit__(self, *_: Any) -> None:
+        self.close()
@@ -1,60 +1,188 @@
+import asyncio
+import contextlib
 import datetime
+import json
+import time
 import uuid
+from collections.abc import AsyncIterator
 
-from fastapi import FastAPI
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, HTTPException
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 
 import app.logconfig
 from app import runner
 from app.config import get_config
 from app.consolidate.consolidate import SimpleConsolidator
 from app.generate.generate import GPT2Generator
-from app.pipe import create_links
+from app.metrics import REGISTRY
+from app.pipe import CompiledPlan, create_links
 from app.retrieve.retrieve import QDRANTRetriever
+from app.scheduler import MicroBatchScheduler
 from app.schemas import GenerateRequest, GenerateResponse, GetArticleResponse, PatchArticleRequest
 from app.security.security import AccountNumberRedactor
+from app.tracing import configure_tracing, set_exporter
+from app.utils import configure_executors
 
 logger = app.logconfig.setup_logger("root")
 
-app = FastAPI()
+# Set once the models are loaded and warm. See `lifespan`.
+dag: CompiledPlan | None = None
+scheduler: MicroBatchScheduler | None = None
+startup_error: Exception | None = None
 
-privacy_config = get_config("au-privacy")
-logger.debug(f"Privacy config: {privacy_config}")
-retrieval_config = get_config("qdrant-retrieval")
-logger.debug(f"Retrieval config: {retrieval_config}")
-consolidator_config = get_config("basic-consolidator")
-logger.debug(f"Consolidator config: {consolidator_config}")
-generation_config = get_config("gpt2-generation")
-logger.debug(f"Generation config: {generation_config}")
 
-security_cleaner = AccountNumberRedactor(privacy_config)
-document_retriever = QDRANTRetriever(retrieval_config)
-context_consolidator = SimpleConsolidator(consolidator_config)
-prompt_reader = GPT2Generator(generation_config)
+def build_dag() -> CompiledPlan:
+    """Loads the config, and the models of each process, and links the processes into the R.A.G. DAG."""
+    privacy_config = get_config("au-privacy")
+    logger.debug(f"Privacy config: {privacy_config}")
+    retrieval_config = get_config("qdrant-retrieval")
+    logger.debug(f"Retrieval config: {retrieval_config}")
+    consolidator_config = get_config("basic-consolidator")
+    logger.debug(f"Consolidator config: {consolidator_config}")
+    generation_config = get_config("gpt2-generation")
+    logger.debug(f"Generation config: {generation_config}")
 
-dag = [security_cleaner, document_retriever, context_consolidator, prompt_reader]
-logger.info("Initialising R.A.G. DAG: " + " -> ".join([f"{d.stage.name}" for d in dag]))
-create_links(dag)  # type: ignore
+    security_cleaner = AccountNumberRedactor(privacy_config)
+    document_retriever = QDRANTRetriever(retrieval_config)
+    context_consolidator = SimpleConsolidator(consolidator_config)
+    prompt_reader = GPT2Generator(generation_config)
+
+    plan = create_links([security_cleaner, document_retriever, context_consolidator, prompt_reader])  # type: ignore
+    logger.info("Initialising R.A.G. DAG: " + " -> ".join([f"{d.stage.name}" for d in plan]))
+    return plan
+
+
+def start() -> None:
+    """Builds the DAG, and warms up each process with a dummy input. The API is ready once this returns."""
+    global dag, scheduler, startup_error
+
+    try:
+        t0 = time.perf_counter()
+        plan = build_dag()
+        t1 = time.perf_counter()
+        for process in plan:
+            process.warmup()
+        t2 = time.perf_counter()
+    except Exception as e:
+        startup_error = e
+        logger.exception("Xbot failed to start")
+        return
+    logger.info(f"Loaded the DAG in {t1 - t0:.1f}s, warmed up in {t2 - t1:.1f}s")
+
+    batching_config = get_config("micro-batching")
+    logger.debug(f"Micro-batching config: {batching_config}")
+    scheduler = MicroBatchScheduler(plan, batching_config) if batching_config["enabled"] else None
+    dag = plan
+
+
+@contextlib.asynccontextmanager
+async def lifespan(_: FastAPI) -> AsyncIterator[None]:
+    """Serves `/live` straight away, and loads the models in the background. `/ready` reports when they are warm."""
+    executors_config = get_config("executors")
+    logger.debug(f"Executors config: {executors_config}")
+    tracing_config = get_config("tracing")
+    logger.debug(f"Tracing config: {tracing_config}")
+    configure_executors(executors_config)
+    previous_exporter = configure_tracing(tracing_config)
+
+    startup = asyncio.create_task(asyncio.to_thread(start))
+    yield
+    if not startup.done():
+        logger.warning("Shutting down before start-up finished")
+    if scheduler is not None:
+        await scheduler.close()
+    set_exporter(previous_exporter)
+
+
+app = FastAPI(lifespan=lifespan)
+
+
+def _ready_dag() -> CompiledPlan:
+    """The DAG, if the API is ready to serve requests.
+
+    Raises:
+        HTTPException: 503, while the models are loading or if they failed to load.
+    """
+    if dag is None:
+        raise HTTPException(status_code=503, detail="Xbot is starting up" if startup_error is None else "Xbot is down")
+    return dag
 
 
 def rag_runner(request: GenerateRequest, event_id) -> str:
     """Interface to the R.A.G. DAG."""
-    response = runner.run_dag(request, event_id, dag)  # type: ignore
+    response = runner.run_dag(request, event_id, _ready_dag())
     return response
 
 
+async def arag_runner(request: GenerateRequest, event_id: str) -> str:
+    """Async interface to the R.A.G. DAG. Batches concurrent requests together, if configured to."""
+    plan = _ready_dag()
+    if scheduler is not None:
+        response, *_ = await scheduler.submit(request, event_id)
+        return response
+    response = await runner.arun_dag(request, event_id, plan)
+    return response
+
+
+@app.get("/live")
+def live() -> JSONResponse:
+    """Liveness probe. Fails only if start-up failed, as the process can't recover without a restart."""
+    if startup_error is not None:
+        return JSONResponse(content={"status": "failed", "error": str(startup_error)}, status_code=503)
+    return JSONResponse(content={"status": "alive"}, status_code=200)
+
+
+@app.get("/ready")
+def ready() -> JSONResponse:
+    """Readiness probe. Succeeds once the models are loaded and warmed up, so traffic only reaches warm pods."""
+    if dag is None:
+        status = "starting" if startup_error is None else "failed"
+        return JSONResponse(content={"status": status}, status_code=503)
+    return JSONResponse(content={"status": "ready"}, status_code=200)
+
+
 @app.post("/xbot/generate")
-def generate(request: GenerateRequest) -> GenerateResponse:
+async def generate(request: GenerateRequest) -> GenerateResponse:
     """Process a user request through the RAG pipeline and return the response."""
 
     event_id = str(uuid.uuid4()) + str(datetime.datetime.now())
     logger.info(f"Starting app with {event_id=}")
 
-    generated_text = rag_runner(request, event_id)
+    generated_text = await arag_runner(request, event_id)
 
     return GenerateResponse(generated_text=generated_text)
 
 
+@app.post("/xbot/generate/stream")
+async def generate_stream(request: GenerateRequest) -> StreamingResponse:
+    """Process a user request through the RAG pipeline, streaming the response as server-sent events.
+
+    Sends a `references` event with the retrieved documents as soon as they are consolidated, then a `token`
+    event for each chunk of the response as it is generated, then a `done` event with the whole response.
+    Streamed requests are not micro-batched.
+    """
+
+    plan = _ready_dag()
+    event_id = str(uuid.uuid4()) + str(datetime.datetime.now())
+    logger.info(f"Starting app with {event_id=}")
+
+    async def _events() -> AsyncIterator[str]:
+        async for event, value in runner.astream_dag(request, event_id, plan):
+            if event == "references":
+                value = [context.model_dump(exclude={"text"}) for context in value]
+            elif event == "done":
+                value = GenerateResponse(generated_text=value).model_dump()
+            yield f"event: {event}\ndata: {json.dumps(value)}\n\n"
+
+    return StreamingResponse(_events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def metrics() -> PlainTextResponse:
+    """Stage latency histograms, error, fallback and skip counters, and executor pool saturation."""
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4")
+
+
 @app.patch("/xbot/collection/articles")
 def patch_articles(articles: PatchArticleRequest) -> JSONResponse:
     """
@@ -0,0 +1,170 @@
+"""In-process metrics registry, exposed in the Prometheus text format.
+
+Recording is lock free on the hot path: each thread records into its own shard,
+and shards are only summed when the metrics are read.
+"""
+
+import bisect
+import threading
+from collections.abc import Callable
+
+# Upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+Labels = tuple[tuple[str, str], ...]
+
+
+def _labels(labels: dict[str, str]) -> Labels:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _format_labels(labels: Labels, **extra: str) -> str:
+    items = [*labels, *extra.items()]
+    if not items:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in items) + "}"
+
+
+class _Sharded:
+    """Per-thread shards of a list of numbers, keyed by label values."""
+
+    def __init__(self, size: int) -> None:
+        self._size = size
+        self._local = threading.local()
+        self._shards: list[dict[Labels, list]] = []
+        self._lock = threading.Lock()
+
+    def shard(self, labels: Labels) -> list:
+        shards = getattr(self._local, "shards", None)
+        if shards is None:
+            shards = self._local.shards = {}
+            with self._lock:
+                self._shards.append(shards)
+        values = shards.get(labels)
+        if values is None:
+            values = shards[labels] = [0] * self._size
+        return values
+
+    def totals(self) -> dict[Labels, list]:
+        with self._lock:
+            shards = list(self._shards)
+        totals: dict[Labels, list] = {}
+        for shard in shards:
+            for labels, values in list(shard.items()):
+                total = totals.setdefault(labels, [0] * self._size)
+                for i, v in enumerate(values):
+                    total[i] += v
+        return totals
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str) -> None:
+        self.name = name
+        self.documentation = documentation
+        self._values = _Sharded(1)
+
+    def inc(self, amount: int = 1, **labels: str) -> None:
+        self._values.shard(_labels(labels))[0] += amount
+
+    def value(self, **labels: str) -> int:
+        return self._values.totals().get(_labels(labels), [0])[0]
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        for labels, (value,) in sorted(self._values.totals().items()):
+            lines.append(f"{self.name}{_format_labels(labels)} {value}")
+        return lines
+
+
+class Histogram:
+    """A histogram of durations, with fixed buckets. Durations are recorded in nanoseconds."""
+
+    def __init__(self, name: str, documentation: str, buckets: tuple[float, ...] = LATENCY_BUCKETS) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.buckets = buckets
+        self._bounds_ns = [int(b * 1e9) for b in buckets]
+        # A count per bucket, then the overflow bucket, the total count, and the sum of durations
+        self._values = _Sharded(len(buckets) + 3)
+
+    def observe_ns(self, nanoseconds: int, **labels: str) -> None:
+        values = self._values.shard(_labels(labels))
+        values[bisect.bisect_left(self._bounds_ns, nanoseconds)] += 1
+        values[-2] += 1
+        values[-1] += nanoseconds
+
+    def count(self, **labels: str) -> int:
+        return self._values.totals().get(_labels(labels), [0] * (len(self.buckets) + 3))[-2]
+
+    def quantile(self, q: float, **labels: str) -> float:
+        """Estimates the q-th quantile in seconds, as the upper bound of the bucket it falls in."""
+        values = self._values.totals().get(_labels(labels))
+        if not values or not values[-2]:
+            return float("nan")
+        rank, cumulative = q * values[-2], 0
+        for bound, count in zip((*self.buckets, float("inf")), values[:-2], strict=True):
+            cumulative += count
+            if cumulative >= rank:
+                return bound
+        return float("inf")
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for labels, values in sorted(self._values.totals().items()):
+            cumulative = 0
+            for bound, count in zip((*self.buckets, "+Inf"), values[:-2], strict=True):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_format_labels(labels, le=str(bound))} {cumulative}")
+            lines.append(f"{self.name}_count{_format_labels(labels)} {values[-2]}")
+            lines.append(f"{self.name}_sum{_format_labels(labels)} {values[-1] / 1e9}")
+        return lines
+
+
+class Gauge:
+    """A gauge read from a callback when the metrics are rendered. The callback returns `{labels: value}`."""
+
+    def __init__(self, name: str, documentation: str, callback: Callable[[], dict[Labels, float]]) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.callback = callback
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} gauge"]
+        for labels, value in sorted(self.callback().items()):
+            lines.append(f"{self.name}{_format_labels(labels)} {value}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self) -> None:
+        self._metrics: dict[str, Counter | Histogram | Gauge] = {}
+        self._lock = threading.Lock()
+
+    def counter(self, name: str, documentation: str) -> Counter:
+        return self._register(name, lambda: Counter(name, documentation))  # type: ignore
+
+    def histogram(self, name: str, documentation: str, buckets: tuple[float, ...] = LATENCY_BUCKETS) -> Histogram:
+        return self._register(name, lambda: Histogram(name, documentation, buckets))  # type: ignore
+
+    def gauge(self, name: str, documentation: str, callback: Callable[[], dict[Labels, float]]) -> Gauge:
+        return self._register(name, lambda: Gauge(name, documentation, callback))  # type: ignore
+
+    def render(self) -> str:
+        """All metrics in the Prometheus text exposition format."""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return "\n".join(line for metric in metrics for line in metric.render()) + "\n"
+
+    def _register(self, name: str, factory: Callable) -> Counter | Histogram | Gauge:
+        with self._lock:
+            if name not in self._metrics:
+                self._metrics[name] = factory()
+            return self._metrics[name]
+
+
+REGISTRY = MetricsRegistry()
+
+STAGE_LATENCY = REGISTRY.histogram("xbot_stage_latency_seconds", "Latency of each RAG stage.")
+STAGE_ERRORS = REGISTRY.counter("xbot_stage_errors_total", "Errors captured by each RAG stage.")
+FALLBACKS = REGISTRY.counter("xbot_fallbacks_total", "Fallback contexts and responses given to users.")
+SENTINEL_SKIPS = REGISTRY.counter("xbot_sentinel_skips_total", "RAG stages skipped by the sentinel.")
@@ -1,7 +1,12 @@
+import asyncio
 import enum
 from abc import ABC, abstractmethod
+from collections.abc import AsyncIterator, Iterator
+from types import MappingProxyType
 from typing import Any
 
+from app.metrics import SENTINEL_SKIPS
+
 
 class RAGStage(enum.Enum):
     """SECURITY -> RCACHE -> REWRITE -> RETRIEVE -> RERANK -> CONSOLIDATE -> GENERATE -> WCACHE"""
@@ -19,15 +24,24 @@ class RAGStage(enum.Enum):
     END = None
 
     def increment(self):
-        if self.value is None:
-            return RAGStage.END
-        new = self.value + 1
-        if new not in [e.value for e in RAGStage]:
-            return RAGStage.END
-        return RAGStage(new)
+        return _NEXT_STAGES[self]
+
+
+def _next_stage(stage: RAGStage) -> RAGStage:
+    if stage.value is None:
+        return RAGStage.END
+    new = stage.value + 1
+    if new not in [e.value for e in RAGStage]:
+        return RAGStage.END
+    return RAGStage(new)
+
+
+# Precomputed, as `increment` is called on every hop of the pipeline
+_NEXT_STAGES: dict[RAGStage, RAGStage] = {stage: _next_stage(stage) for stage in RAGStage}
 
 
 ErrorStack = list[tuple[RAGStage, Exception]]
+PipeItem = tuple[Any, dict, ErrorStack, RAGStage]  # (`text`, `data`, `errors`, `sentinel`)
 
 
 class Process(ABC):
@@ -49,10 +63,21 @@ class Process(ABC):
                         - Handling raised errors,
                         - indicating what process happens next (or skipped),
                         - Calling the main process function.
+        - `acall`: Async counterpart of `__call__`, used by the async pipeline runner.
+        - `_aprocess`: Async counterpart of `_process`. Optional - by default `_process` is offloaded to a thread.
+        - `batch_call`: Processes many requests at once, used by the micro-batching scheduler.
+        - `_process_batch`: Batch counterpart of `_process`. Optional - by default `_process` is called per request.
+        - `warmup`: Runs a dummy input through the process's models before it serves traffic. Optional.
     """
 
     stage: RAGStage
     _next_stage: RAGStage
+    passthrough: bool = False  # A stub that forwards its inputs. Left out of compiled plans unless enabled.
+
+    @property
+    def enabled(self) -> bool:
+        """Whether the process is part of a compiled plan. Set with the `enabled` config key."""
+        return self.config.get("enabled", not self.passthrough)
 
     @property
     def next_stage(self) -> RAGStage:
@@ -83,17 +108,208 @@ class Process(ABC):
         """
         if not sentinel == self.stage:
             # pass through
+            SENTINEL_SKIPS.inc(stage=self.stage.name)
             next_sentinel = sentinel
             return text, data, errors, next_sentinel
 
         next_text, next_data, next_errors, next_sentinel = self._process(text, data, errors, sentinel)
         return next_text, next_data, next_errors, next_sentinel
 
+    async def _aprocess(
+        self, text: Any, data: dict, errors: ErrorStack, sentinel: RAGStage
+    ) -> tuple[Any, dict, ErrorStack, RAGStage]:
+        """Async counterpart of `_process`.
 
-def create_links(dag: list[Process]) -> None:
+        Override in subclasses that can await I/O, or offload CPU bound work themselves.
+        The default runs the synchronous `_process` in a worker thread, so the event loop is never blocked.
+        """
+        return await asyncio.to_thread(self._process, text, data, errors, sentinel)
+
+    async def acall(
+        self, text: Any, data: dict, errors: ErrorStack, sentinel: RAGStage
+    ) -> tuple[Any, dict, ErrorStack, RAGStage]:
+        """Async counterpart of `__call__`. Awaits `_aprocess` if the sentinel is the current stage.
+
+        No need to override this method in subclasses.
+        """
+        if not sentinel == self.stage:
+            # pass through
+            SENTINEL_SKIPS.inc(stage=self.stage.name)
+            return text, data, errors, sentinel
+
+        next_text, next_data, next_errors, next_sentinel = await self._aprocess(text, data, errors, sentinel)
+        return next_text, next_data, next_errors, next_sentinel
+
+    async def _astream(self, text: Any, data: dict, errors: ErrorStack, sentinel: RAGStage) -> AsyncIterator[str]:
+        """Streams the text output of `_aprocess` in chunks, as it is produced.
+
+        Override in subclasses that produce their output incrementally, e.g. token by token.
+        The default yields the whole output of `_aprocess` as one chunk.
+        """
+        next_text, *_ = await self._aprocess(text, data, errors, sentinel)
+        yield next_text
+
+    def astream(self, text: Any, data: dict, errors: ErrorStack, sentinel: RAGStage) -> AsyncIterator[str]:
+        """Streaming counterpart of `acall`, for the last process that produces text for the user.
+        The chunks joined together are the output text, and the next stage is `next_stage`.
+
+        No need to override this method in subclasses.
+        """
+        return self._astream(text, data, errors, sentinel)
+
+    def warmup(self) -> None:
+        """Runs a dummy input through the process, so the first request doesn't pay for lazy allocations.
+
+        Override in subclasses that run a model. The default does nothing.
+        """
+        return None
+
+    def _process_batch(self, batch: list[PipeItem]) -> list[PipeItem]:
+        """Batch counterpart of `_process`. Returns one output per input, in input order.
+
+        Override in subclasses that can share work across requests, e.g. one model call for many inputs.
+        The default calls `_process` for each request in turn.
+        """
+        return [self._process(*item) for item in batch]
+
+    def batch_call(self, batch: list[PipeItem]) -> list[PipeItem]:
+        """Batch counterpart of `__call__`. Requests whose sentinel is not the current stage pass through,
+        the rest are processed together by `_process_batch`.
+
+        No need to override this method in subclasses.
+        """
+        outputs = list(batch)
+        active = [i for i, (*_, sentinel) in enumerate(batch) if sentinel == self.stage]
+        if len(active) < len(batch):
+            SENTINEL_SKIPS.inc(len(batch) - len(active), stage=self.stage.name)
+        if active:
+            processed = self._process_batch([batch[i] for i in active])
+            for i, item in zip(active, processed, strict=True):
+                outputs[i] = item
+        return outputs
+
+
+class CompiledPlan:
+    """An immutable, linear pipeline, with a table from each stage to its position.
+
+    Runners use `next_index` to jump straight to the process named by the sentinel,
+    instead of calling every process in between to pass through.
+    """
+
+    __slots__ = ("_index", "processes")
+
+    def __init__(self, processes: list[Process]) -> None:
+        self.processes: tuple[Process, ...] = tuple(processes)
+        self._index: MappingProxyType[RAGStage, int] = MappingProxyType(
+            {p.stage: i for i, p in enumerate(self.processes)}
+        )
+
+    def next_index(self, index: int, sentinel: RAGStage) -> int | None:
+        """The position of the next process to run, after the one at `index` returned `sentinel`.
+        None if there is no later process for that stage, i.e. the pipeline has finished.
+        """
+        target = self._index.get(sentinel)
+        if target is None or target <= index:
+            return None
+        return target
+
+    def __iter__(self) -> Iterator[Process]:
+        return iter(self.processes)
+
+    def __len__(self) -> int:
+        return len(self.processes)
+
+    def __getitem__(self, index: int) -> Process:
+        return self.processes[index]
+
+    def __setattr__(self, name: str, value: Any) -> None:
+        if hasattr(self, name):
+            raise AttributeError(f"{type(self).__name__} is immutable")
+        super().__setattr__(name, value)
+
+
+def create_links(dag: list[Process]) -> CompiledPlan:
     """Connects the objects in the DAG, setting the `_next_stage`
     property to the `_stage` of the object that follows it in the list.
+
+    Processes that are not enabled (see `Process.enabled`) are left out, and linked around.
+
+    Returns:
+        CompiledPlan: The enabled processes, ready to run.
     """
+    dag = [p for p in dag if p.enabled]
+    if not dag:
+        raise ValueError("The DAG has no enabled processes")
     for i in range(len(dag) - 1):
         dag[i]._next_stage = dag[i + 1].stage  # ignore: SLF001
     dag[-1]._next_stage = RAGStage.END  # ignore: SLF001
+    return CompiledPlan(dag)
+
+
+class DAG:
+    """A branching pipeline. Processes are the nodes, and each depends on the outputs of zero or more others.
+
+    Processes that don't depend on each other can run concurrently, see `runner.arun_graph`.
+    `depends_on` maps a stage to the stages whose outputs it needs. Processes missing from `depends_on`
+    depend on the process before them in the list, so `DAG(processes)` is the same pipeline as `create_links`.
+
+    Sentinels keep their meaning. A process that returns its successor in `next_stages` (its first dependent,
+    or `END`), or its own `next_stage`, completes normally. The processes themselves are left unchanged, so they
+    can be shared with other plans. Returning the stage of any other process that hasn't started jumps ahead to
+    it, skipping every unfinished process it depends on, including those in parallel branches. The first branch
+    to jump wins, e.g. a cache lookup branch that jumps to GENERATE cancels a slower retrieval branch.
+    Returning `END` skips the rest of the processes that depend on it. Returning a stage that isn't in the DAG
+    ends the run, as it does in a linear plan.
+    """
+
+    def __init__(self, processes: list[Process], depends_on: dict[RAGStage, list[RAGStage]] | None = None) -> None:
+        self.processes: dict[RAGStage, Process] = {p.stage: p for p in processes}
+        if len(self.processes) != len(processes):
+            raise ValueError("Each process in a DAG must have a unique stage")
+
+        depends_on = depends_on or {}
+        unknown = {s for deps in depends_on.values() for s in deps} | set(depends_on)
+        unknown -= set(self.processes)
+        if unknown:
+            raise ValueError(f"Unknown stages in depends_on: {', '.join(s.name for s in unknown)}")
+
+        self.depends_on: dict[RAGStage, tuple[RAGStage, ...]] = {}
+        for i, process in enumerate(processes):
+            default = [processes[i - 1].stage] if i > 0 else []
+            self.depends_on[process.stage] = tuple(depends_on.get(process.stage, default))
+        self.dependents: dict[RAGStage, tuple[RAGStage, ...]] = {
+            stage: tuple(s for s, deps in self.depends_on.items() if stage in deps) for stage in self.processes
+        }
+
+        self.order = self._topological_order()
+        self.ancestors: dict[RAGStage, frozenset[RAGStage]] = {}
+        for stage in self.order:
+            deps = self.depends_on[stage]
+            self.ancestors[stage] = frozenset(deps).union(*(self.ancestors[d] for d in deps))
+        self.descendants: dict[RAGStage, frozenset[RAGStage]] = {
+            stage: frozenset(s for s in self.processes if stage in self.ancestors[s]) for stage in self.processes
+        }
+
+        # Kept on the DAG, rather than set on the processes, which may be shared with other plans
+        self.next_stages: dict[RAGStage, RAGStage] = {
+            stage: dependents[0] if dependents else RAGStage.END for stage, dependents in self.dependents.items()
+        }
+
+    def _topological_order(self) -> list[RAGStage]:
+        """Kahn's algorithm, keeping the order processes were given in where there is a choice."""
+        remaining = dict(self.depends_on)
+        order: list[RAGStage] = []
+        while remaining:
+            ready = [s for s, deps in remaining.items() if all(d in order for d in deps)]
+            if not ready:
+                raise ValueError(f"DAG has a cycle between stages: {', '.join(s.name for s in remaining)}")
+            for stage in ready:
+                order.append(stage)
+                del remaining[stage]
+        return order
+
+    def __repr__(self) -> str:
+        edges = ", ".join(
+            f"{'+'.join(d.name for d in deps) or 'START'} -> {s.name}" for s, deps in self.depends_on.items()
+        )
+        return f"DAG({edges})"
@@ -0,0 +1,104 @@
+"""Process-wide registry of loaded models, tokenisers, encoders and clients.
+
+Each is loaded once per key, e.g. model name, device and options, on first use, and shared by
+every process in the DAG, the API, scripts and tests. Entries can be evicted, or reloaded in place.
+"""
+
+import json
+import threading
+from collections.abc import Callable, Hashable
+from typing import Any, TypeVar
+
+import app.logconfig
+from app.metrics import REGISTRY
+
+logger = app.logconfig.setup_logger("root")
+
+T = TypeVar("T")
+
+REGISTRY_LOADS = REGISTRY.counter("xbot_registry_loads_total", "Models, encoders and clients loaded, by kind.")
+
+
+def config_key(config: dict, *fields: str) -> str:
+    """A registry key from the given fields of a config. Missing fields are part of the key, as null."""
+    return json.dumps({field: config.get(field) for field in fields}, sort_keys=True, default=str)
+
+
+class ModelRegistry:
+    """A thread-safe, lazily loaded cache of shared objects, keyed by `(kind, key)`.
+
+    Reads of loaded entries take no lock. Loads take a lock per entry, so an entry is loaded once,
+    and slow loads don't block other entries.
+    """
+
+    def __init__(self) -> None:
+        self._entries: dict[tuple[str, Hashable], Any] = {}
+        self._loaders: dict[tuple[str, Hashable], Callable[[], Any]] = {}
+        self._locks: dict[tuple[str, Hashable], threading.Lock] = {}
+        self._lock = threading.Lock()
+
+    def get(self, kind: str, key: Hashable, loader: Callable[[], T]) -> T:
+        """The entry for `(kind, key)`. Calls `loader` to load it, if it isn't loaded yet."""
+        entry_key = (kind, key)
+        try:
+            return self._entries[entry_key]
+        except KeyError:
+            pass
+
+        with self._entry_lock(entry_key):
+            if entry_key not in self._entries:
+                self._entries[entry_key] = self._load(entry_key, loader)
+            return self._entries[entry_key]
+
+    def reload(self, kind: str, key: Hashable) -> Any:
+        """Loads the entry again, with the loader it was first loaded with. The old entry is served until
+        the new one is ready.
+
+        Raises:
+            KeyError: If the entry was never loaded.
+        """
+        entry_key = (kind, key)
+        with self._entry_lock(entry_key):
+            self._entries[entry_key] = self._load(entry_key, self._loaders[entry_key])
+            return self._entries[entry_key]
+
+    def evict(self, kind: str | None = None, key: Hashable | None = None) -> list[tuple[str, Hashable]]:
+        """Drops the registry's references to matching entries: all of a kind, or one key of a kind,
+        or everything if no kind is given. Holders of an evicted entry keep using it until they let it go.
+
+        Returns:
+            The `(kind, key)` of each evicted entry.
+        """
+        with self._lock:
+            evicted = [
+                entry_key
+                for entry_key in self._entries
+                if (kind is None or entry_key[0] == kind) and (key is None or entry_key[1] == key)
+            ]
+            for entry_key in evicted:
+                del self._entries[entry_key]
+                self._loaders.pop(entry_key, None)
+        for entry_key in evicted:
+            logger.info(f"Evicted {entry_key}")
+        return evicted
+
+    def keys(self) -> list[tuple[str, Hashable]]:
+        return list(self._entries)
+
+    def __contains__(self, entry_key: tuple[str, Hashable]) -> bool:
+        return entry_key in self._entries
+
+    def _entry_lock(self, entry_key: tuple[str, Hashable]) -> threading.Lock:
+        with self._lock:
+            return self._locks.setdefault(entry_key, threading.Lock())
+
+    def _load(self, entry_key: tuple[str, Hashable], loader: Callable[[], Any]) -> Any:
+        logger.info(f"Loading {entry_key}")
+        entry = loader()
+        with self._lock:
+            self._loaders[entry_key] = loader
+        REGISTRY_LOADS.inc(kind=entry_key[0])
+        return entry
+
+
+MODELS = ModelRegistry()
@@ -7,6 +7,7 @@ class SVMReranker(Process):
     """Uses a support vector machine to predict relevance scores."""
 
     stage = RAGStage.RERANK
+    passthrough = True
 
     def __init__(self, config: dict) -> None:
         super().__init__(config)
@@ -14,5 +15,5 @@ class SVMReranker(Process):
     def _SVM_infer(self, embeddings: list[list[float]]) -> list[float]:
         raise NotImplementedError
 
-    def _process(self, text: Any, data: dict, errors: ErrorStack, sentinel) -> tuple[Any, dict, ErrorStack, RAGStage]:
-        return text, data, errors, sentinel.increment()
+    def _process(self, text: Any, data: dict, errors: ErrorStack, *_) -> tuple[Any, dict, ErrorStack, RAGStage]:
+        return text, data, errors, self.next_stage
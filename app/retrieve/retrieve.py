@@ -1,24 +1,48 @@
 import time
-from typing import Any
+from typing import TYPE_CHECKING, Any
 
 from pydantic import BaseModel
+from qdrant_client.http import models
 
 import app.logconfig
-from app.pipe import ErrorStack, Process, RAGStage
+from app.metrics import FALLBACKS
+from app.pipe import ErrorStack, PipeItem, Process, RAGStage
 from app.schemas import GenerateRequest
-from app.store.qdrant import encode_text, get_client, get_encoder, search_collection
-from app.utils import run_until_timeout
+from app.store.client import ManagedClient
+from app.store.qdrant import (
+    asearch_collection,
+    embedding_cache_key,
+    encode_text,
+    encode_texts,
+    ensure_payload_indexes,
+    get_async_client,
+    get_client,
+    get_embedding_cache,
+    get_encoder,
+    search_collection,
+    search_collection_batch,
+)
+from app.utils import arun_until_timeout, run_until_timeout
+
+if TYPE_CHECKING:
+    from sentence_transformers import SentenceTransformer
 
 logger = app.logconfig.setup_logger("root")
 
+# The payload fields searched for with `lazy_text`. The text is fetched once consolidated.
+PAYLOAD_FIELDS = ["doc_id", "title", "url", "text_length"]
+
 
 class Context(BaseModel):
     """doc_id: str
-    text: str"""
+    text: str
+    Retrieved without its text, `text` is empty until fetched by the point id."""
 
     doc_id: str
     text: str
     score: float | None = None
+    point_id: int | str | None = None
+    text_length: int | None = None
 
 
 class ContextWithMetadata(Context):
@@ -42,6 +66,15 @@ class QDRANTRetriever(Process):
     Behavioiurs:
         - Retrieves documents from vector store, and lables them with any metadata.
         - If no documents are retrieved, returns a helpful message fallback response as context.
+        - `multi_query_retrieve` searches for a query and its variants in one round-trip, and fuses the results.
+        - Search filters are built per request, from its user metadata, and never stored on the retriever.
+        - The payload keys of `payload_indexes` are indexed in the collection, with their schemas, at warm-up.
+        - With `lazy_text`, searches return only `PAYLOAD_FIELDS`, without vectors. The text of the documents
+          that are kept is fetched by the consolidator, with `fetch_texts`, in one call.
+        - If `embedding_cache` is enabled, query embeddings are cached by normalized query and encoder.
+          Hits skip the encoder.
+        - The clients and the encoder are fetched from `app.registry.MODELS` on each use, so one reloaded or
+          evicted there is let go.
 
     Handles Exceptions:
         - QueryEmbeddingTimeoutError: Returns this reason as the context document.
@@ -53,8 +86,28 @@ class QDRANTRetriever(Process):
     def __init__(self, config: dict) -> None:
         super().__init__(config)
         self.config = config
-        self.client = get_client(self.config)
-        self.encoder = get_encoder(self.config)
+        # Loaded now, rather than by the first request
+        get_client(self.config)
+        get_async_client(self.config)
+        get_encoder(self.config)
+        self.embedding_cache = get_embedding_cache(self.config)
+
+    @property
+    def client(self) -> ManagedClient:
+        return get_client(self.config)
+
+    @property
+    def aclient(self) -> ManagedClient:
+        return get_async_client(self.config)
+
+    @property
+    def encoder(self) -> "SentenceTransformer":
+        return get_encoder(self.config)
+
+    def warmup(self) -> None:
+        """Embeds a dummy query, and creates the configured payload indexes."""
+        encode_text(self.encoder, "warmup")
+        ensure_payload_indexes(self.client, self.config["collection_name"], self.config.get("payload_indexes", {}))
 
     def simple_retrieve(self, request: GenerateRequest, event_id: str) -> list[Context]:
         """
@@ -70,22 +123,188 @@ class QDRANTRetriever(Process):
 
         logger.info("Retrieving...")
         t0 = time.time()
-        embedding = run_until_timeout(
-            encode_text, self.config["embedding_timeout"], QueryEmbeddingTimeoutError, self.encoder, request.user_query
-        )
+        embedding = self._cached_embedding(request.user_query, event_id)
+        if embedding is None:
+            embedding = run_until_timeout(
+                encode_text,
+                self.config["embedding_timeout"],
+                QueryEmbeddingTimeoutError,
+                self.encoder,
+                request.user_query,
+                resource="embedding",
+            )
+            self._cache_embedding(request.user_query, embedding)
         t1 = time.time()
 
         logger.eval(event_id, {"metric": "embed_seconds", "value": t1 - t0})
         logger.eval(event_id, {"metric": "user_query_embedding", "value": ",".join(map(str, embedding))})
 
-        if self.config["filter_on_user_metadata"]:
-            if hasattr(request, "metadata") and request.metadata:
-                self.config["search_filters"] = self._create_must_filter(request.metadata)
+        t0 = time.time()
+        documents, scores, doc_ids, metadatas = self.retrieve_from_vector(
+            embedding, n=self.config["top_k"], search_filters=self._search_filters(request)
+        )
+        t1 = time.time()
+        logger.eval(event_id, {"metric": "retrieve_seconds", "value": t1 - t0})
+        return self._to_contexts(documents, scores, doc_ids, metadatas, event_id)
 
+    async def asimple_retrieve(self, request: GenerateRequest, event_id: str) -> list[Context]:
+        """Async counterpart of `simple_retrieve`.
+
+        The CPU bound embedding is offloaded to a worker thread, and the vector store search is awaited,
+        with the async client.
+        """
+
+        logger.info("Retrieving...")
         t0 = time.time()
-        documents, scores, doc_ids, metadatas = self.retrieve_from_vector(embedding, n=self.config["top_k"])
+        embedding = self._cached_embedding(request.user_query, event_id)
+        if embedding is None:
+            embedding = await arun_until_timeout(
+                encode_text,
+                self.config["embedding_timeout"],
+                QueryEmbeddingTimeoutError,
+                self.encoder,
+                request.user_query,
+                resource="embedding",
+            )
+            self._cache_embedding(request.user_query, embedding)
+        t1 = time.time()
+
+        logger.eval(event_id, {"metric": "embed_seconds", "value": t1 - t0})
+        logger.eval(event_id, {"metric": "user_query_embedding", "value": ",".join(map(str, embedding))})
+
+        t0 = time.time()
+        documents, scores, doc_ids, metadatas = await self.aretrieve_from_vector(
+            embedding, n=self.config["top_k"], search_filters=self._search_filters(request)
+        )
         t1 = time.time()
         logger.eval(event_id, {"metric": "retrieve_seconds", "value": t1 - t0})
+        return self._to_contexts(documents, scores, doc_ids, metadatas, event_id)
+
+    def batch_retrieve(self, requests: list[GenerateRequest], event_ids: list[str]) -> list[list[Context] | Exception]:
+        """
+        Retrieves information for many user queries, with one call to the encoder
+        and one round-trip to the vector store.
+
+        Args:
+            requests (List[GenerateRequest]): The request objects containing the user queries.
+            event_ids (List[str]): The unique identifier for each request's event.
+
+        Raises:
+            QueryEmbeddingTimeoutError: If embedding the batch of queries takes too long.
+
+        Returns:
+            List: For each request, its contexts, or the error raised while labelling them.
+        """
+
+        logger.info(f"Retrieving a batch of {len(requests)}...")
+        embeddings = self._embed_queries([r.user_query for r in requests], event_ids)
+
+        t0 = time.time()
+        retrieved = self.retrieve_from_vectors(
+            embeddings, n=self.config["top_k"], search_filters=[self._search_filters(r) for r in requests]
+        )
+        t1 = time.time()
+
+        contexts: list[list[Context] | Exception] = []
+        for event_id, (documents, scores, doc_ids, metadatas) in zip(event_ids, retrieved, strict=True):
+            logger.eval(event_id, {"metric": "retrieve_seconds", "value": t1 - t0})
+            try:
+                contexts.append(self._to_contexts(documents, scores, doc_ids, metadatas, event_id))
+            except NoDcoumentsRetrievedError as e:
+                contexts.append(e)
+        return contexts
+
+    def multi_query_retrieve(self, request: GenerateRequest, variants: list[str], event_id: str) -> list[Context]:
+        """
+        Retrieves information for a user query and variants of it, e.g. rewrites or expansions, with one
+        call to the encoder and one round-trip to the vector store.
+
+        Each query is searched with the request's filters. Documents retrieved by several queries are kept
+        once, with their best score, and the `top_k` best are returned.
+
+        Args:
+            request (GenerateRequest): The request object containing the user query.
+            variants (List[str]): Other phrasings of the user query.
+            event_id (str): The unique identifier for the event.
+
+        Raises:
+            QueryEmbeddingTimeoutError: If embedding the queries takes too long.
+            NoDcoumentsRetrievedError: If no query retrieved any documents.
+
+        Returns:
+            List[Context]: A list of contexts containing the retrieved information.
+        """
+
+        queries = [request.user_query, *variants]
+        logger.info(f"Retrieving for {len(queries)} query variants...")
+        embeddings = self._embed_queries(queries, [event_id] * len(queries))
+
+        t0 = time.time()
+        search_filters = self._search_filters(request)
+        retrieved = self.retrieve_from_vectors(
+            embeddings, n=self.config["top_k"], search_filters=[search_filters] * len(queries)
+        )
+        logger.eval(event_id, {"metric": "retrieve_seconds", "value": time.time() - t0})
+
+        best: dict[Any, tuple[str, float, Any, dict]] = {}
+        for documents, scores, doc_ids, metadatas in retrieved:
+            for document, score, doc_id, metadata in zip(documents, scores, doc_ids, metadatas, strict=True):
+                if doc_id not in best or score > best[doc_id][1]:
+                    best[doc_id] = (document, score, doc_id, metadata)
+        fused = sorted(best.values(), key=lambda hit: hit[1], reverse=True)[: self.config["top_k"]]
+        documents, scores, doc_ids, metadatas = ([hit[i] for hit in fused] for i in range(4))
+        return self._to_contexts(documents, scores, doc_ids, metadatas, event_id)
+
+    def _embed_queries(self, queries: list[str], event_ids: list[str]) -> list[list[float]]:
+        """Embeds the queries with one call to the encoder, for those not in the embedding cache."""
+        t0 = time.time()
+        embeddings = [self._cached_embedding(q, e) for q, e in zip(queries, event_ids, strict=True)]
+        misses = [i for i, embedding in enumerate(embeddings) if embedding is None]
+        if misses:
+            encoded = run_until_timeout(
+                encode_texts,
+                self.config["embedding_timeout"],
+                QueryEmbeddingTimeoutError,
+                self.encoder,
+                [queries[i] for i in misses],
+                resource="embedding",
+            )
+            for i, embedding in zip(misses, encoded, strict=True):
+                embeddings[i] = embedding
+                self._cache_embedding(queries[i], embedding)
+        t1 = time.time()
+
+        for event_id, embedding in zip(event_ids, embeddings, strict=True):
+            logger.eval(event_id, {"metric": "embed_seconds", "value": t1 - t0})
+            logger.eval(event_id, {"metric": "user_query_embedding", "value": ",".join(map(str, embedding))})
+        return embeddings  # type: ignore
+
+    def _cached_embedding(self, query: str, event_id: str) -> list[float] | None:
+        if self.embedding_cache is None:
+            return None
+        vector = self.embedding_cache.get(embedding_cache_key(query, self.config["encoder"]))
+        if vector is None:
+            return None
+        logger.eval(event_id, {"metric": "embedding_cache_hit", "value": True})
+        return vector.tolist()
+
+    def _cache_embedding(self, query: str, embedding: list[float]) -> None:
+        if self.embedding_cache is not None:
+            self.embedding_cache.put(embedding_cache_key(query, self.config["encoder"]), embedding)
+
+    def _search_filters(self, request: GenerateRequest) -> dict:
+        """The search filters for this request's user metadata, if configured to filter on it, else those of the
+        config. Built per request, and never stored on the retriever, which is shared by concurrent requests."""
+        if self.config["filter_on_user_metadata"]:
+            if hasattr(request, "metadata") and request.metadata:
+                return self._create_must_filter(request.metadata)
+        return self.config.get("search_filters", {})
+
+    @staticmethod
+    def _to_contexts(
+        documents: list[str], scores: list[float], doc_ids: list[int], metadatas: list[dict], event_id: str
+    ) -> list[Context]:
+        """Labels the retrieved documents with their metadata. Raises if no documents were retrieved."""
         logger.eval(
             event_id,
             {
@@ -98,80 +317,200 @@ class QDRANTRetriever(Process):
 
         contexts = []
         for doc, id, meta in zip(documents, doc_ids, metadatas, strict=False):
-            if len(meta) > 0:
+            hints = {k: meta[k] for k in ("point_id", "text_length") if k in meta}
+            if len(meta) > len(hints):
                 contexts.append(
-                    ContextWithMetadata(doc_id=str(id), text=doc, url=meta.get("url", ""), title=meta["title"])
+                    ContextWithMetadata(doc_id=str(id), text=doc, url=meta.get("url", ""), title=meta["title"], **hints)
                 )
             else:
-                contexts.append(Context(doc_id=str(id), text=doc))
+                contexts.append(Context(doc_id=str(id), text=doc, **hints))
         return contexts
 
     def retrieve_from_vector(
-        self, query_vector: list[float], n: int
+        self, query_vector: list[float], n: int, search_filters: dict | None = None
     ) -> tuple[list[str], list[float], list[int], list[dict]]:
         """
         Retrieves documents, scores, document ids, and metadata from a vector search.
 
-        Uses search filters and parameters from the instantiated classes config.
+        Uses search parameters from the instantiated classes config.
 
         Args:
             query_vector (List[float]): Vector representing the query for search.
             n (int): Number of results to retrieve.
+            search_filters (Optional[Dict]): Search filters for this query. Defaults to those of the config.
 
         Returns:
             Tuple: A tuple containing lists of documents, scores, document ids, and metadata.
         """
 
+        if search_filters is None:
+            search_filters = self.config.get("search_filters", {})
         results = search_collection(
             self.client,
             query_vector,
             limit=n,
             collection_name=self.config["collection_name"],
-            search_kwargs=self.config.get("search_params", {}),
-            search_filters=self.config.get("search_filters", {}),
+            search_kwargs=self._search_kwargs(),
+            search_filters=search_filters,
+        )
+        return self._unpack_results(results)
+
+    async def aretrieve_from_vector(
+        self, query_vector: list[float], n: int, search_filters: dict | None = None
+    ) -> tuple[list[str], list[float], list[int], list[dict]]:
+        """Async counterpart of `retrieve_from_vector`."""
+
+        if search_filters is None:
+            search_filters = self.config.get("search_filters", {})
+        results = await asearch_collection(
+            self.aclient,
+            query_vector,
+            limit=n,
+            collection_name=self.config["collection_name"],
+            search_kwargs=self._search_kwargs(),
+            search_filters=search_filters,
         )
+        return self._unpack_results(results)
+
+    def retrieve_from_vectors(
+        self, query_vectors: list[list[float]], n: int | list[int], search_filters: list[dict]
+    ) -> list[tuple[list[str], list[float], list[int], list[dict]]]:
+        """
+        Batch counterpart of `retrieve_from_vector`. All queries are sent in one round-trip to the vector store.
 
+        Args:
+            query_vectors (List[List[float]]): Vectors representing each query.
+            n (int | List[int]): Number of results to retrieve per query, or for each query.
+            search_filters (List[Dict]): Search filters for each query.
+
+        Returns:
+            List[Tuple]: For each query, lists of documents, scores, document ids, and metadata.
+        """
+
+        results = search_collection_batch(
+            self.client,
+            query_vectors,
+            limit=n,
+            collection_name=self.config["collection_name"],
+            search_kwargs=self._search_kwargs(),
+            search_filters=search_filters,
+        )
+        return [self._unpack_results(r) for r in results]
+
+    def fetch_texts(self, contexts: list[Context]) -> None:
+        """Fills in the text of contexts retrieved without it, with one round-trip to the vector store."""
+        point_ids = [c.point_id for c in contexts if c.point_id is not None and not c.text]
+        if not point_ids:
+            return
+        records = self.client.retrieve(
+            self.config["collection_name"],
+            point_ids,
+            with_payload=models.PayloadSelectorInclude(include=["text"]),
+            with_vectors=False,
+        )
+        texts = {record.id: record.payload["text"] for record in records}
+        for context in contexts:
+            if context.point_id in texts and not context.text:
+                context.text = texts[context.point_id]
+
+    def _pass_on(self, request: GenerateRequest, data: dict) -> None:
+        """Shares the request, and the means to fetch the text of documents retrieved without it, with later
+        processes."""
+        data["user_query"] = request
+        if self.config.get("lazy_text", False):
+            data["fetch_texts"] = self.fetch_texts
+
+    def _search_kwargs(self) -> dict[str, Any]:
+        search_kwargs = self.config.get("search_params", {})
+        if self.config.get("lazy_text", False):
+            search_kwargs = {
+                "with_payload": models.PayloadSelectorInclude(include=PAYLOAD_FIELDS),
+                "with_vectors": False,
+                **search_kwargs,
+            }
+        return search_kwargs
+
+    @staticmethod
+    def _unpack_results(results: list) -> tuple[list[str], list[float], list[int], list[dict]]:
         payloads = [d.payload for d in results]
         scores = [d.score for d in results]
         doc_ids = [d["doc_id"] for d in payloads]
-        documents = [d["text"] for d in payloads]
+        documents = [d.get("text", "") for d in payloads]
 
         metadata = [{k: v for k, v in payload.items() if k not in {"scores", "doc_id", "text"}} for payload in payloads]
+        # Documents retrieved without their text keep their point id, to fetch it
+        for result, meta in zip(results, metadata, strict=True):
+            if "text" not in result.payload:
+                meta["point_id"] = result.id
 
         return documents, scores, doc_ids, metadata
 
     def _process(self, text: Any, data: dict, errors: ErrorStack, *_) -> tuple[Any, dict, ErrorStack, RAGStage]:
         request: GenerateRequest = text
-        data["user_query"] = request  # For use by later processes
+        self._pass_on(request, data)
         event_id: str = data["event_id"]
 
         next_sentinel = self.next_stage
         try:
             contexts = self.simple_retrieve(request, event_id)
             next_text: list[Context | ContextWithMetadata] = contexts
+        except Exception as e:
+            next_text, next_sentinel = self._handle_error(e, errors)
 
-        except (NoDcoumentsRetrievedError, QueryEmbeddingTimeoutError) as e:
+        return next_text, data, errors, next_sentinel
+
+    async def _aprocess(self, text: Any, data: dict, errors: ErrorStack, *_) -> tuple[Any, dict, ErrorStack, RAGStage]:
+        request: GenerateRequest = text
+        self._pass_on(request, data)
+        event_id: str = data["event_id"]
+
+        next_sentinel = self.next_stage
+        try:
+            contexts = await self.asimple_retrieve(request, event_id)
+            next_text: list[Context | ContextWithMetadata] = contexts
+        except Exception as e:
+            next_text, next_sentinel = self._handle_error(e, errors)
+
+        return next_text, data, errors, next_sentinel
+
+    def _process_batch(self, batch: list[PipeItem]) -> list[PipeItem]:
+        requests: list[GenerateRequest] = [text for text, *_ in batch]
+        for request, (_, data, *_) in zip(requests, batch, strict=True):
+            self._pass_on(request, data)
+
+        try:
+            retrieved = self.batch_retrieve(requests, [data["event_id"] for _, data, *_ in batch])
+        except Exception as e:
+            retrieved = [e] * len(batch)
+
+        outputs = []
+        for contexts, (_, data, errors, _) in zip(retrieved, batch, strict=True):
+            next_sentinel = self.next_stage
+            if isinstance(contexts, Exception):
+                contexts, next_sentinel = self._handle_error(contexts, errors)
+            outputs.append((contexts, data, errors, next_sentinel))
+        return outputs
+
+    def _handle_error(self, e: Exception, errors: ErrorStack) -> tuple[list[Context], RAGStage]:
+        """Records the error, and returns a fallback context and the stage to continue from."""
+        errors.append((self.stage, e))
+        if isinstance(e, NoDcoumentsRetrievedError | QueryEmbeddingTimeoutError):
             if type(e) == QueryEmbeddingTimeoutError:
                 logger.error("Query embedding took too long to respond")
                 msg = "Sorry, something went wrong. "
             else:
                 msg = "No relevant documents found. Perhaps reframe your query. "
             logger.error(str(e) + "Zero documents retrieved.")
-            errors.append((self.stage, e))
-            next_text = self._fallback_context(msg)
-            next_sentinel = RAGStage.GENERATE
+            return self._fallback_context(msg), RAGStage.GENERATE
 
-        except Exception as e:
-            # Give the user the retrieved references verbatim.
-            errors.append((self.stage, e))
-            logger.error(str(e) + "Applied a no-VectorStore fallback document.")
-            next_text = self._fallback_context("Sorry something went wrong. ")
-
-        return next_text, data, errors, next_sentinel
+        # Give the user the retrieved references verbatim.
+        logger.error(str(e) + "Applied a no-VectorStore fallback document.")
+        return self._fallback_context("Sorry something went wrong. "), self.next_stage
 
     @staticmethod
     def _create_must_filter(user_metadata: dict) -> dict:
         return {"must": [{"key": k, "match": {"value": v}} for k, v in user_metadata.items()]}
 
     def _fallback_context(self, msg: str = "") -> list[Context]:
+        FALLBACKS.inc(kind="context", stage=self.stage.name)
         return [Context(doc_id="", text=f"{msg}The website" "is an excellent resource for many related questions.")]
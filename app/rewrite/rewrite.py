@@ -9,11 +9,10 @@ logger = app.logconfig.setup_logger("root")
 class Rewriter(Process):
 
     stage = RAGStage.REWRITE
+    passthrough = True
 
     def __init__(self, config: dict) -> None:
         super().__init__(config)
 
-    def _process(
-        self, text: Any, data: dict, errors: ErrorStack, sentinel: RAGStage
-    ) -> tuple[Any, dict, ErrorStack, RAGStage]:
-        return text, data, errors, sentinel.increment()
+    def _process(self, text: Any, data: dict, errors: ErrorStack, *_) -> tuple[Any, dict, ErrorStack, RAGStage]:
+        return text, data, errors, self.next_stage
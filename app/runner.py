@@ -1,21 +1,26 @@
+import asyncio
 import datetime
 import time
 import uuid
+from collections.abc import AsyncIterator
+from typing import Any
 
 import app.logconfig
 from app.config import get_config
 from app.consolidate.consolidate import SimpleConsolidator
 from app.generate.generate import GPT2Generator
-from app.pipe import Process, create_links
+from app.metrics import SENTINEL_SKIPS, STAGE_ERRORS, STAGE_LATENCY
+from app.pipe import DAG, CompiledPlan, ErrorStack, PipeItem, Process, RAGStage, create_links
 from app.retrieve.retrieve import QDRANTRetriever
 from app.schemas import GenerateRequest
 from app.security.security import AccountNumberRedactor
+from app.tracing import batch_trace, span, trace
 
 logger = app.logconfig.setup_logger("root")
 logger.debug("runner.py is running...")
 
 
-def run_dag(request: GenerateRequest, event_id: str, processes: list[Process]) -> str:
+def run_dag(request: GenerateRequest, event_id: str, processes: CompiledPlan | list[Process]) -> str:
     """
     Runs the directed acyclic graph (DAG) defined by the given request, event ID, and list of processes,
     and returns the next text after processing all stages.
@@ -27,33 +32,313 @@ def run_dag(request: GenerateRequest, event_id: str, processes: list[Process]) -
     Args:
         request (GenerateRequest): The request to be processed.
         event_id (str): The ID of the event triggering the DAG run, used to align metrics.
-        processes (List[Process]): The list of processes to be executed in the DAG.
+        processes (CompiledPlan | List[Process]): The processes to be executed in the DAG.
+            Stages that the sentinel skips over are not called.
 
     Returns:
         str: The next text after processing the entire DAG.
     """
-    next_text, data, errors, sentinel = request, {"event_id": event_id}, [], processes[0].stage
+    plan = _compiled(processes)
+    next_text, data, errors, sentinel = request, {"event_id": event_id}, [], plan[0].stage
     _err_counter = len(errors)
-    for process in processes:
-        t0 = time.time()
-        logger.info(f"Running {process.stage=}")
-        next_text, data, errors, sentinel = process(next_text, data, errors, sentinel)
-        t1 = time.time()
-        if len(errors) > _err_counter:
-            logger.error(f"Error in {process.stage=}. Attempting to Continue...")
-            for error in errors:
-                logger.error(error)
-            _err_counter = len(errors)
-        logger.info(f"Completed {process.stage=} in {t1 - t0} seconds")
+    with trace(event_id):
+        i: int | None = 0
+        while i is not None:
+            process = plan[i]
+            t0 = time.perf_counter_ns()
+            logger.info(f"Running {process.stage=}")
+            with span(process.stage.name, process=type(process).__name__):
+                next_text, data, errors, sentinel = process(next_text, data, errors, sentinel)
+            t1 = time.perf_counter_ns()
+            _err_counter = _log_stage(process, errors, _err_counter, t1 - t0)
+            i = _next_index(plan, i, sentinel)
 
     return next_text
 
 
+async def arun_dag(request: GenerateRequest, event_id: str, processes: CompiledPlan | list[Process]) -> str:
+    """
+    Async counterpart of `run_dag`. Each process is awaited with `Process.acall`, so a request doesn't
+    pin a thread for the whole pipeline. Processes without an async implementation are offloaded to a thread.
+
+    Args:
+        request (GenerateRequest): The request to be processed.
+        event_id (str): The ID of the event triggering the DAG run, used to align metrics.
+        processes (CompiledPlan | List[Process]): The processes to be executed in the DAG.
+            Stages that the sentinel skips over are not called.
+
+    Returns:
+        str: The next text after processing the entire DAG.
+    """
+    plan = _compiled(processes)
+    next_text, data, errors, sentinel = request, {"event_id": event_id}, [], plan[0].stage
+    _err_counter = len(errors)
+    with trace(event_id):
+        i: int | None = 0
+        while i is not None:
+            process = plan[i]
+            t0 = time.perf_counter_ns()
+            logger.info(f"Running {process.stage=}")
+            with span(process.stage.name, process=type(process).__name__):
+                next_text, data, errors, sentinel = await process.acall(next_text, data, errors, sentinel)
+            t1 = time.perf_counter_ns()
+            _err_counter = _log_stage(process, errors, _err_counter, t1 - t0)
+            i = _next_index(plan, i, sentinel)
+
+    return next_text
+
+
+async def astream_dag(
+    request: GenerateRequest,
+    event_id: str,
+    processes: CompiledPlan | list[Process],
+    stream_stage: RAGStage = RAGStage.GENERATE,
+) -> AsyncIterator[tuple[str, Any]]:
+    """
+    Streaming counterpart of `arun_dag`. Yields events as the DAG runs:
+
+        - `("references", contexts)`: The input of the `stream_stage` process, before it starts.
+        - `("token", chunk)`: Each chunk of text, as the `stream_stage` process produces it (`Process.astream`).
+        - `("done", text)`: The text after processing the entire DAG.
+
+    If the sentinel skips `stream_stage`, e.g. on a cache hit, only the `done` event is sent.
+
+    Args:
+        request (GenerateRequest): The request to be processed.
+        event_id (str): The ID of the event triggering the DAG run, used to align metrics.
+        processes (CompiledPlan | List[Process]): The processes to be executed in the DAG.
+        stream_stage (RAGStage): The stage to stream the output of.
+    """
+    plan = _compiled(processes)
+    next_text, data, errors, sentinel = request, {"event_id": event_id}, [], plan[0].stage
+    _err_counter = len(errors)
+    with trace(event_id, streamed=True):
+        i: int | None = 0
+        while i is not None:
+            process = plan[i]
+            t0 = time.perf_counter_ns()
+            logger.info(f"Running {process.stage=}")
+            with span(process.stage.name, process=type(process).__name__):
+                if process.stage == stream_stage:
+                    yield "references", next_text
+                    chunks = []
+                    async for chunk in process.astream(next_text, data, errors, sentinel):
+                        chunks.append(chunk)
+                        yield "token", chunk
+                    next_text, sentinel = "".join(chunks), process.next_stage
+                else:
+                    next_text, data, errors, sentinel = await process.acall(next_text, data, errors, sentinel)
+            t1 = time.perf_counter_ns()
+            _err_counter = _log_stage(process, errors, _err_counter, t1 - t0)
+            i = _next_index(plan, i, sentinel)
+
+    yield "done", next_text
+
+
+async def arun_graph(request: GenerateRequest, event_id: str, graph: DAG) -> str:
+    """
+    Runs a branching DAG. Each process starts as soon as all the processes it depends on have finished,
+    so independent branches run concurrently. Where branches join, the `data` dicts of the dependencies
+    are merged, and the `text` is taken from the first dependency listed.
+
+    When a process jumps ahead (see `DAG`), unfinished processes before the jump target are skipped, and
+    any that are running are cancelled. The latency of each stage, the latency of cancelled stages,
+    and the time saved by running branches concurrently are reported to the info logger.
+
+    Args:
+        request (GenerateRequest): The request to be processed.
+        event_id (str): The ID of the event triggering the DAG run, used to align metrics.
+        graph (DAG): The processes, and their dependencies.
+
+    Returns:
+        str: The text of the last process to run, in topological order.
+    """
+    errors: ErrorStack = []
+    outputs: dict[RAGStage, PipeItem] = {}
+    skipped: set[RAGStage] = set()
+    jumps: dict[RAGStage, RAGStage] = {}  # jump target -> the stage that jumped to it
+    running: dict[asyncio.Task, RAGStage] = {}
+    started: dict[RAGStage, int] = {}
+    durations: dict[RAGStage, int] = {}  # nanoseconds
+    _err_counter = 0
+
+    def _inputs(stage: RAGStage) -> PipeItem:
+        deps = [d for d in graph.depends_on[stage] if d in outputs]
+        if stage in jumps:
+            deps = [jumps[stage]] + [d for d in deps if d != jumps[stage]]
+        if not deps:
+            return request, {"event_id": event_id}, errors, stage
+        data: dict = {}
+        for dep in reversed(deps):
+            data.update(outputs[dep][1])
+        return outputs[deps[0]][0], data, errors, stage
+
+    def _skip(stages: set[RAGStage], reason: RAGStage) -> None:
+        for task, stage in list(running.items()):
+            if stage in stages:
+                task.cancel()
+                del running[task]
+                durations[stage] = time.perf_counter_ns() - started[stage]
+                logger.info(f"Cancelled {stage=} after {durations[stage] / 1e9} seconds. {reason=} finished first")
+        for stage in stages - skipped:
+            SENTINEL_SKIPS.inc(stage=stage.name)
+        skipped.update(stages)
+
+    t_start = time.perf_counter_ns()
+    with trace(event_id):
+        try:
+            while True:
+                for stage in graph.order:
+                    if stage in outputs or stage in skipped or stage in started:
+                        continue
+                    deps = graph.depends_on[stage]
+                    if not all(d in outputs or d in skipped for d in deps):
+                        continue
+                    if deps and all(d in skipped for d in deps) and stage not in jumps:
+                        SENTINEL_SKIPS.inc(stage=stage.name)
+                        skipped.add(stage)
+                        continue
+                    logger.info(f"Running {stage=}")
+                    started[stage] = time.perf_counter_ns()
+                    running[asyncio.create_task(_traced_acall(graph.processes[stage], _inputs(stage)))] = stage
+
+                if not running:
+                    break
+                done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task not in running:  # Cancelled by a branch that finished in the same step
+                        continue
+                    stage = running.pop(task)
+                    outputs[stage] = task.result()
+                    durations[stage] = time.perf_counter_ns() - started[stage]
+                    _err_counter = _log_stage(graph.processes[stage], errors, _err_counter, durations[stage])
+
+                    sentinel = outputs[stage][3]
+                    if sentinel in (graph.next_stages[stage], graph.processes[stage].next_stage):
+                        continue
+                    if sentinel == RAGStage.END:
+                        _skip(set(graph.descendants[stage]) - set(outputs), reason=stage)
+                    elif sentinel not in graph.processes:
+                        # There is no later process for that stage, so the run has finished, as in `run_dag`
+                        _skip(set(graph.processes) - set(outputs), reason=stage)
+                    elif sentinel not in started and sentinel not in skipped:
+                        if sentinel in jumps:
+                            continue  # Another branch jumped there first
+                        jumps[sentinel] = stage
+                        _skip(set(graph.ancestors[sentinel]) - set(outputs), reason=stage)
+        finally:
+            for task in running:
+                task.cancel()
+
+    wall_ns = time.perf_counter_ns() - t_start
+    # Cancelled stages didn't finish their work, so they saved nothing by running in parallel
+    completed_ns = sum(durations[stage] for stage in outputs)
+    logger.info(
+        f"Ran {len(outputs)} stages in {wall_ns / 1e9} seconds. "
+        f"Parallel branches saved {(completed_ns - wall_ns) / 1e9} seconds"
+    )
+    final_stage = [s for s in graph.order if s in outputs][-1]
+    return outputs[final_stage][0]
+
+
+async def _traced_acall(process: Process, item: PipeItem) -> PipeItem:
+    with span(process.stage.name, process=type(process).__name__):
+        return await process.acall(*item)
+
+
+def run_dag_batch(
+    requests: list[tuple[GenerateRequest, str]], processes: CompiledPlan | list[Process]
+) -> list[PipeItem | Exception]:
+    """
+    Runs many requests through the DAG together. Each stage is called once with every request
+    that reached it, so stages that support batching (`Process._process_batch`) share their work.
+
+    A request that raises is dropped from the remaining stages, without affecting the rest of the batch.
+
+    Args:
+        requests (List[Tuple[GenerateRequest, str]]): The requests to be processed, with their event IDs.
+        processes (CompiledPlan | List[Process]): The processes to be executed in the DAG.
+
+    Returns:
+        List: For each request, in input order, its final `(text, data, errors, sentinel)`, or the raised exception.
+    """
+    outputs: list[PipeItem | Exception] = [
+        (request, {"event_id": event_id}, [], processes[0].stage) for request, event_id in requests
+    ]
+    err_counters = [0] * len(outputs)
+    # A batch shares its stages, so is traced as one. Each event's own trace links to it.
+    with batch_trace([event_id for _, event_id in requests], batch_size=len(requests)):
+        for process in processes:
+            live = [i for i, item in enumerate(outputs) if not isinstance(item, Exception)]
+            if not live:
+                break
+            t0 = time.perf_counter_ns()
+            logger.info(f"Running {process.stage=} for a batch of {len(live)}")
+            with span(process.stage.name, process=type(process).__name__, batch_size=len(live)):
+                processed = _batch_call(process, [outputs[i] for i in live])  # type: ignore
+            t1 = time.perf_counter_ns()
+            for i, item in zip(live, processed, strict=True):
+                outputs[i] = item
+                if not isinstance(item, Exception):
+                    err_counters[i] = _log_stage(process, item[2], err_counters[i], t1 - t0)
+
+    return outputs
+
+
+def _batch_call(process: Process, batch: list[PipeItem]) -> list[PipeItem | Exception]:
+    """Calls the process on the whole batch. If that raises, calls it per request to isolate the failure."""
+    try:
+        return process.batch_call(batch)  # type: ignore
+    except Exception:
+        logger.error(f"Batch failed in {process.stage=}. Retrying requests individually...")
+
+    outputs: list[PipeItem | Exception] = []
+    for item in batch:
+        try:
+            outputs.append(process(*item))
+        except Exception as e:
+            outputs.append(e)
+    return outputs
+
+
+def _log_stage(process: Process, errors: list, err_counter: int, nanoseconds: int) -> int:
+    """Logs any new errors captured by the process, and its latency, and records them as metrics.
+    Returns the updated error count.
+    """
+    STAGE_LATENCY.observe_ns(nanoseconds, stage=process.stage.name)
+    if len(errors) > err_counter:
+        STAGE_ERRORS.inc(len(errors) - err_counter, stage=process.stage.name)
+        logger.error(f"Error in {process.stage=}. Attempting to Continue...")
+        for error in errors:
+            logger.error(error)
+        err_counter = len(errors)
+    logger.info(f"Completed {process.stage=} in {nanoseconds / 1e9} seconds")
+    return err_counter
+
+
+def _compiled(processes: CompiledPlan | list[Process]) -> CompiledPlan:
+    """The processes as a plan. A list is run as given, including any disabled processes."""
+    if isinstance(processes, CompiledPlan):
+        return processes
+    return CompiledPlan(processes)
+
+
+def _next_index(plan: CompiledPlan, index: int, sentinel: RAGStage) -> int | None:
+    """The position of the process named by the sentinel. Counts the processes jumped over as skipped."""
+    next_index = plan.next_index(index, sentinel)
+    for process in plan[index + 1 : len(plan) if next_index is None else next_index]:
+        SENTINEL_SKIPS.inc(stage=process.stage.name)
+    return next_index
+
+
 def rag_runner(request: GenerateRequest) -> tuple[str, str]:
     """
     This function runs the R.A.G. (Retrieval, Augmented, Generation) process.
     It retrieves configuration settings, initializes several components, creates
     a DAG, and then runs the DAG to generate a response.
+
+    The components share their models, encoders and clients through `app.registry.MODELS`,
+    so only the first call loads them.
     """
 
     privacy_config = get_config("au-privacy")
@@ -73,8 +358,7 @@ def rag_runner(request: GenerateRequest) -> tuple[str, str]:
     event_id = str(uuid.uuid4()) + str(datetime.datetime.now())
     logger.info(f"Starting Xbot with {event_id=}")
 
-    dag = [security_cleaner, document_retriever, context_consolidator, prompt_reader]
-    create_links(dag)
+    dag = create_links([security_cleaner, document_retriever, context_consolidator, prompt_reader])
 
     logger.info("Initialising R.A.G. DAG: " + " -> ".join([f"{d.stage.name}" for d in dag]))
     response = run_dag(request, event_id, dag)
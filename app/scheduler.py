@@ -0,0 +1,114 @@
+import asyncio
+
+import app.logconfig
+from app.pipe import CompiledPlan, PipeItem, Process
+from app.runner import run_dag_batch
+from app.schemas import GenerateRequest
+
+logger = app.logconfig.setup_logger("root")
+
+
+class MicroBatchScheduler:
+    """Collects concurrent requests over a short window, and runs them through the DAG as one batch.
+
+    A batch is dispatched when `max_batch_size` requests have arrived, or `max_wait_ms` after its first
+    request arrived, whichever is first. Batches run in a worker thread, with at most `max_concurrent_batches`
+    in flight. Each caller gets back their own `(text, data, errors, sentinel)`.
+
+    Config:
+        - `max_batch_size`: Maximum number of requests in a batch.
+        - `max_wait_ms`: Longest time the first request of a batch waits for others to join it.
+        - `max_concurrent_batches`: Maximum number of batches running through the DAG at once.
+    """
+
+    def __init__(self, processes: CompiledPlan | list[Process], config: dict) -> None:
+        self.processes = processes
+        self.max_batch_size: int = config.get("max_batch_size", 8)
+        self.max_wait: float = config.get("max_wait_ms", 10.0) / 1000
+        self.max_concurrent_batches: int = config.get("max_concurrent_batches", 1)
+
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._queue: asyncio.Queue | None = None
+        self._semaphore: asyncio.Semaphore | None = None
+        self._worker: asyncio.Task | None = None
+        self._batches: set[asyncio.Task] = set()
+
+    async def submit(self, request: GenerateRequest, event_id: str) -> PipeItem:
+        """Queues the request for the next batch, and waits for its result.
+
+        Raises:
+            Exception: Whatever the DAG raised while processing this request.
+        """
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            # The queue and semaphore belong to the event loop they are first used in
+            self._loop = loop
+            self._queue = asyncio.Queue()
+            self._semaphore = asyncio.Semaphore(self.max_concurrent_batches)
+            self._worker = None
+        if self._worker is None or self._worker.done():
+            # Restarted on the same queue, so requests already waiting in it are collected
+            self._worker = asyncio.create_task(self._collect())
+            self._worker.add_done_callback(self._collector_done)
+
+        future = loop.create_future()
+        await self._queue.put((request, event_id, future))  # type: ignore
+        return await future
+
+    async def close(self) -> None:
+        """Stops collecting requests, and waits for in-flight batches to finish. Requests collected for the next
+        batch fail. Those still queued wait for the next request to restart the collector."""
+        if self._worker is not None:
+            self._worker.cancel()
+        await asyncio.gather(*self._batches, return_exceptions=True)
+
+    async def _collect(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]  # type: ignore
+            try:
+                deadline = loop.time() + self.max_wait
+                while len(batch) < self.max_batch_size:
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        batch.append(await asyncio.wait_for(self._queue.get(), timeout))  # type: ignore
+                    except TimeoutError:
+                        break
+
+                # Wait for a free slot before dispatching, so requests keep joining the next batch meanwhile.
+                await self._semaphore.acquire()  # type: ignore
+            except BaseException as e:
+                # The requests taken off the queue would otherwise never be answered
+                for *_, future in batch:
+                    if not future.done():
+                        future.set_exception(RuntimeError(f"The scheduler stopped before dispatching the batch. {e!r}"))
+                raise
+            task = asyncio.create_task(self._dispatch(batch))
+            self._batches.add(task)
+            task.add_done_callback(self._batches.discard)
+
+    @staticmethod
+    def _collector_done(task: asyncio.Task) -> None:
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"The batch collector stopped, and is restarted by the next request: {task.exception()!r}")
+
+    async def _dispatch(self, batch: list[tuple[GenerateRequest, str, asyncio.Future]]) -> None:
+        logger.info(f"Dispatching a batch of {len(batch)} requests")
+        try:
+            outputs = await asyncio.to_thread(
+                run_dag_batch, [(request, event_id) for request, event_id, _ in batch], self.processes
+            )
+        except Exception as e:
+            outputs = [e] * len(batch)
+        finally:
+            self._semaphore.release()  # type: ignore
+
+        for output, (*_, future) in zip(outputs, batch, strict=True):
+            if future.done():  # The caller went away
+                continue
+            if isinstance(output, Exception):
+                future.set_exception(output)
+            else:
+                future.set_result(output)
@@ -0,0 +1,159 @@
+"""Managed clients of the vector store, shared by the process.
+
+The transport (REST, or gRPC with `prefer_grpc`), the connection pool and the timeouts are set by the
+`client` section of the retrieval config. Every call is timed, and its errors counted, by method.
+Searches are given `search_timeout`, unless the caller sets their own `timeout`.
+
+Both Qdrant and the local index (`backend: local`) are wrapped the same way. The async variant of the
+local index runs its calls on the `io` pool.
+"""
+
+import functools
+import inspect
+import time
+from collections.abc import Callable
+from typing import Any
+
+import httpx
+from qdrant_client import AsyncQdrantClient, QdrantClient
+
+from app.metrics import REGISTRY
+from app.store.local import LocalIndex
+from app.utils import get_executor
+
+CLIENT_LATENCY = REGISTRY.histogram("xbot_vectorstore_request_seconds", "Latency of vector store calls, by method.")
+CLIENT_ERRORS = REGISTRY.counter(
+    "xbot_vectorstore_errors_total", "Vector store calls that raised, by method and error."
+)
+
+# Defaults of the `client` section of the retrieval config
+CLIENT_DEFAULTS = {
+    "prefer_grpc": False,
+    "grpc_port": 6334,
+    "timeout": 10,
+    "search_timeout": None,
+    "pool_size": 16,
+    "keepalive_seconds": 30.0,
+}
+
+# Methods that take a `timeout`, in seconds
+_TIMEOUT_METHODS = {"search", "search_batch"}
+
+
+def client_options(params: dict) -> dict:
+    """The `client` section of the config, with defaults."""
+    return {**CLIENT_DEFAULTS, **params.get("client", {})}
+
+
+def qdrant_kwargs(params: dict) -> dict:
+    """Keyword arguments of `QdrantClient` and `AsyncQdrantClient`, from the retrieval config.
+
+    Keep-alive connections are pooled, also to `localhost`, where the Qdrant client disables them by default.
+    """
+    options = client_options(params)
+    return {
+        "host": params["host"],
+        "port": params["port"],
+        "grpc_port": options["grpc_port"],
+        "prefer_grpc": options["prefer_grpc"],
+        "timeout": options["timeout"],
+        "limits": httpx.Limits(
+            max_connections=options["pool_size"],
+            max_keepalive_connections=options["pool_size"],
+            keepalive_expiry=options["keepalive_seconds"],
+        ),
+    }
+
+
+def make_client(params: dict) -> "ManagedClient":
+    """A new client of the backend of the config."""
+    if params.get("backend", "qdrant") == "local":
+        client: Any = LocalIndex(params["local_path"], **params.get("local_ann", {}))
+    else:
+        client = QdrantClient(**qdrant_kwargs(params))
+    return ManagedClient(client, params.get("backend", "qdrant"), client_options(params)["search_timeout"])
+
+
+def make_async_client(params: dict) -> "ManagedClient":
+    """A new async client of the backend of the config. Its methods are coroutines."""
+    if params.get("backend", "qdrant") == "local":
+        client: Any = OffloadedClient(LocalIndex(params["local_path"], **params.get("local_ann", {})))
+    else:
+        client = AsyncQdrantClient(**qdrant_kwargs(params))
+    return ManagedClient(client, params.get("backend", "qdrant"), client_options(params)["search_timeout"])
+
+
+class ManagedClient:
+    """Wraps a client of the vector store. Calls of its methods are timed, and their errors counted.
+
+    Args:
+        client: A `QdrantClient`, `AsyncQdrantClient` or `LocalIndex`.
+        backend (str): Labels the metrics.
+        search_timeout (int | None): Default `timeout` of searches, in seconds.
+    """
+
+    def __init__(self, client: Any, backend: str, search_timeout: int | None = None) -> None:
+        self.client = client
+        self.backend = backend
+        self.search_timeout = search_timeout
+
+    def __getattr__(self, name: str) -> Any:
+        attr = getattr(self.client, name)
+        if name.startswith("_") or not callable(attr):
+            return attr
+        if name in _TIMEOUT_METHODS and self.search_timeout is not None:
+            attr = functools.partial(_with_timeout, attr, self.search_timeout)
+        labels = {"backend": self.backend, "method": name}
+        if inspect.iscoroutinefunction(getattr(self.client, name)):
+            return _timed_async(attr, labels)
+        return _timed(attr, labels)
+
+
+class OffloadedClient:
+    """Async methods for a blocking client, run on the `io` pool."""
+
+    def __init__(self, client: Any) -> None:
+        self.client = client
+
+    def __getattr__(self, name: str) -> Any:
+        attr = getattr(self.client, name)
+        if name.startswith("_") or not callable(attr):
+            return attr
+
+        async def offloaded(*args, **kwargs) -> Any:
+            return await get_executor("io").run_async(attr, *args, **kwargs)
+
+        return offloaded
+
+
+def _with_timeout(method: Callable, default_timeout: int, *args, **kwargs) -> Any:
+    kwargs.setdefault("timeout", default_timeout)
+    return method(*args, **kwargs)
+
+
+def _timed(method: Callable, labels: dict[str, str]) -> Callable:
+    def call(*args, **kwargs) -> Any:
+        t0 = time.perf_counter_ns()
+        try:
+            return method(*args, **kwargs)
+        except Exception as e:
+            CLIENT_ERRORS.inc(**labels, error=type(e).__name__)
+            raise
+        finally:
+            CLIENT_LATENCY.observe_ns(time.perf_counter_ns() - t0, **labels)
+
+    return call
+
+
+def _timed_async(method: Callable, labels: dict[str, str]) -> Callable:
+    async def call(*args, **kwargs) -> Any:
+        t0 = time.perf_counter_ns()
+        try:
+            return await method(*args, **kwargs)
+        except Exception as e:
+            CLIENT_ERRORS.inc(**labels, error=type(e).__name__)
+            raise
+        finally:
+            CLIENT_LATENCY.observe_ns(time.perf_counter_ns() - t0, **labels)
+
+    return call
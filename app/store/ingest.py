@@ -0,0 +1,240 @@
+"""Bulk ingestion of documents into a Qdrant collection.
+
+Documents are streamed from JSON or JSONL files, encoded in batches, optionally on a pool of encoder
+processes, and uploaded in chunks by parallel workers. Only a few chunks are held in memory at a time,
+whatever the size of the input.
+
+Point ids are the documents' positions in the input, so uploads are idempotent. With a checkpoint,
+the number of documents stored is saved after each chunk, and an ingestion that failed is resumed
+from there.
+"""
+
+import concurrent.futures
+import itertools
+import json
+import os
+import time
+from collections import deque
+from collections.abc import Iterable, Iterator
+from pathlib import Path
+from typing import TYPE_CHECKING, Any
+
+from qdrant_client import QdrantClient
+from qdrant_client.http import models
+
+import app.logconfig
+
+if TYPE_CHECKING:
+    from sentence_transformers import SentenceTransformer
+
+logger = app.logconfig.setup_logger("root")
+
+
+def read_documents(path: str | Path, chunk_size: int = 2**16) -> Iterator[dict]:
+    """Yields the documents of a JSONL file, one per line, or of a JSON file holding a list, without loading it all."""
+    with open(path) as file:
+        if Path(path).suffix == ".jsonl":
+            for line in file:
+                if line.strip():
+                    yield json.loads(line)
+        else:
+            yield from _iter_json_list(file, chunk_size)
+
+
+def _iter_json_list(file: Any, chunk_size: int) -> Iterator[Any]:
+    """Decodes the items of a JSON list one at a time, reading the file `chunk_size` characters at a time."""
+    decoder = json.JSONDecoder()
+    buffer, eof, started = "", False, False
+    while True:
+        buffer = buffer.lstrip(" \t\r\n,") if started else buffer.lstrip()
+        if not started and buffer:
+            if buffer[0] != "[":
+                raise ValueError("Expected a JSON list of documents")
+            buffer, started = buffer[1:], True
+            continue
+        if started and buffer.startswith("]"):
+            return
+        try:
+            item, end = decoder.raw_decode(buffer)
+            # An item ending the buffer may be cut short, e.g. a number
+            if end < len(buffer) or eof:
+                yield item
+                buffer = buffer[end:]
+                continue
+        except json.JSONDecodeError:
+            if eof and buffer:
+                raise
+        if eof:
+            raise ValueError("Unexpected end of the JSON list")
+        chunk = file.read(chunk_size)
+        eof = not chunk
+        buffer += chunk
+
+
+def batched(items: Iterable[Any], n: int) -> Iterator[list[Any]]:
+    """Lists of `n` items, the last of which may be shorter."""
+    iterator = iter(items)
+    while batch := list(itertools.islice(iterator, n)):
+        yield batch
+
+
+class IngestCheckpoint:
+    """The number of documents of a source stored in a collection, saved in a JSON file.
+
+    Args:
+        path (str | Path): The checkpoint file.
+        source (str): Identifies the input, e.g. its file name. A checkpoint of another source is an error.
+        collection_name (str): The collection being filled.
+    """
+
+    def __init__(self, path: str | Path, source: str, collection_name: str) -> None:
+        self.path = Path(path)
+        self.source = source
+        self.collection_name = collection_name
+
+    def load(self) -> int:
+        """Documents already stored. 0 if there is no checkpoint.
+
+        Raises:
+            ValueError: If the checkpoint is of another source or collection.
+        """
+        if not self.path.exists():
+            return 0
+        state = json.loads(self.path.read_text())
+        if (state["source"], state["collection_name"]) != (self.source, self.collection_name):
+            raise ValueError(
+                f"{self.path} is a checkpoint of {state['source']} into {state['collection_name']}, "
+                f"not of {self.source} into {self.collection_name}"
+            )
+        return state["documents"]
+
+    def save(self, documents: int) -> None:
+        state = {"source": self.source, "collection_name": self.collection_name, "documents": documents}
+        temp = self.path.with_suffix(".tmp")
+        temp.write_text(json.dumps(state))
+        os.replace(temp, self.path)  # Atomic, so a crash never leaves half a checkpoint
+
+    def clear(self) -> None:
+        self.path.unlink(missing_ok=True)
+
+
+def ingest(
+    client: QdrantClient,
+    documents: Iterable[dict],
+    collection_name: str,
+    encoder: "SentenceTransformer",
+    batch_size: int = 64,
+    upload_batch_size: int = 256,
+    parallel: int = 2,
+    encode_processes: int = 0,
+    checkpoint: IngestCheckpoint | None = None,
+    max_retries: int = 3,
+) -> dict[str, float]:
+    """
+    Encodes the documents' `text`, and stores them in the collection, with the documents as payloads,
+    and the length of their text as `text_length`.
+
+    The collection is recreated, unless a checkpoint shows an ingestion into it to resume.
+
+    Args:
+        client (QdrantClient): The client of the vector store.
+        documents (Iterable[dict]): The documents, with at least a `text` key. Read lazily.
+        collection_name (str): The collection to fill.
+        encoder (SentenceTransformer): Encodes the text of the documents.
+        batch_size (int): Texts per call to the encoder model.
+        upload_batch_size (int): Points per upload. Also the number of documents encoded at a time.
+        parallel (int): Uploads in flight at a time.
+        encode_processes (int): Encoder processes, on the CPU. 0 to encode in this process.
+        checkpoint (IngestCheckpoint | None): Saves progress after each upload, and is cleared once done.
+        max_retries (int): Attempts at each upload, after the first, before giving up.
+
+    Returns:
+        dict: `documents` stored, `skipped` as already stored, `seconds` taken, and `docs_per_second`.
+    """
+    start = checkpoint.load() if checkpoint is not None else 0
+    if start:
+        logger.info(f"Resuming ingestion into {collection_name} after {start} documents")
+    else:
+        client.recreate_collection(
+            collection_name=collection_name,
+            vectors_config=models.VectorParams(
+                size=encoder.get_sentence_embedding_dimension(),  # type: ignore
+                distance=models.Distance.DOT,
+            ),
+        )
+
+    pool = encoder.start_multi_process_pool(["cpu"] * encode_processes) if encode_processes else None
+    stored = start
+    t0 = time.perf_counter()
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max(parallel, 1), thread_name_prefix="xbot-ingest") as uploads:
+            in_flight: deque[tuple[concurrent.futures.Future, int]] = deque()
+            position = start
+            for chunk in batched(itertools.islice(documents, start, None), upload_batch_size):
+                texts = [document["text"] for document in chunk]
+                if pool is not None:
+                    vectors = encoder.encode_multi_process(texts, pool, batch_size=batch_size)
+                else:
+                    vectors = encoder.encode(texts, batch_size=batch_size)
+                # The length of the text lets it be fetched only for the documents that are used, see `lazy_text`
+                payloads = [{**document, "text_length": len(document["text"])} for document in chunk]
+                points = models.Batch(
+                    ids=list(range(position, position + len(chunk))), vectors=vectors.tolist(), payloads=payloads
+                )
+                position += len(chunk)
+                in_flight.append((uploads.submit(_upload, client, collection_name, points, max_retries), position))
+                # Encoding the next chunk overlaps with `parallel` uploads. Waiting for the oldest upload first
+                # means progress is only saved once every earlier document is stored.
+                while len(in_flight) > max(parallel, 1):
+                    stored = _wait(in_flight, checkpoint)
+                    _log_progress(collection_name, stored, stored - start, t0)
+            while in_flight:
+                stored = _wait(in_flight, checkpoint)
+    finally:
+        if pool is not None:
+            encoder.stop_multi_process_pool(pool)
+
+    seconds = time.perf_counter() - t0
+    if checkpoint is not None:
+        checkpoint.clear()
+    stats = {
+        "documents": stored - start,
+        "skipped": start,
+        "seconds": seconds,
+        "docs_per_second": (stored - start) / seconds if seconds else 0.0,
+    }
+    logger.info(
+        f"Ingested {stats['documents']} documents into {collection_name} in {seconds:.1f}s "
+        f"({stats['docs_per_second']:.1f} docs/sec), skipped {start} already stored"
+    )
+    return stats
+
+
+def _wait(in_flight: deque[tuple[concurrent.futures.Future, int]], checkpoint: IngestCheckpoint | None) -> int:
+    """Waits for the oldest upload, and saves the checkpoint. Returns the documents stored so far."""
+    future, stored = in_flight.popleft()
+    try:
+        future.result()
+    except Exception:
+        for pending, _ in in_flight:
+            pending.cancel()
+        raise
+    if checkpoint is not None:
+        checkpoint.save(stored)
+    return stored
+
+
+def _log_progress(collection_name: str, stored: int, ingested: int, t0: float) -> None:
+    logger.info(f"{stored} documents in {collection_name}, {ingested / (time.perf_counter() - t0):.1f} docs/sec")
+
+
+def _upload(client: QdrantClient, collection_name: str, points: models.Batch, max_retries: int) -> None:
+    for attempt in range(max_retries + 1):
+        try:
+            client.upsert(collection_name=collection_name, points=points, wait=True)
+            return
+        except Exception as e:
+            if attempt == max_retries:
+                raise
+            logger.warning(f"Upload of points {points.ids[0]}-{points.ids[-1]} failed, retrying: {e}")
+            time.sleep(2**attempt)
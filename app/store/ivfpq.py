@@ -0,0 +1,201 @@
+"""An approximate nearest neighbour index: an inverted file with product quantization (IVF-PQ), in NumPy.
+
+Vectors are clustered into `nlist` lists by k-means. Each vector is stored in the list of its nearest
+centroid, as `m` one-byte codes that quantize its residual from the centroid, one per subspace of
+`dim / m` dimensions. A search scores only the lists of the `nprobe` centroids nearest to the query,
+by a lookup table of the query's dot product with each code. Candidates can be re-scored exactly
+from the original vectors, `refine` times as many as are returned.
+
+`nprobe` and `refine` trade recall for latency. Indexes are saved as `.npy` files, and loaded
+memory-mapped, so an index larger than memory can be searched.
+"""
+
+import json
+import time
+from pathlib import Path
+
+import numpy as np
+
+import app.logconfig
+
+logger = app.logconfig.setup_logger("root")
+
+_FILES = ("centroids", "codebooks", "codes", "ids", "offsets")
+
+
+def kmeans(x: np.ndarray, k: int, iterations: int = 20, seed: int = 0) -> np.ndarray:
+    """`k` centroids of the rows of `x`, by Lloyd's algorithm. Empty clusters are reseeded from random rows."""
+    rng = np.random.default_rng(seed)
+    centroids = x[rng.choice(len(x), k, replace=False)].astype(np.float32)
+    for _ in range(iterations):
+        assign = nearest(x, centroids)
+        counts = np.bincount(assign, minlength=k)
+        order = np.argsort(assign, kind="stable")
+        filled = np.flatnonzero(counts)
+        sums = np.add.reduceat(x[order], np.concatenate([[0], np.cumsum(counts)[:-1]])[filled], axis=0)
+        centroids[filled] = sums / counts[filled, None]
+        empty = np.flatnonzero(counts == 0)
+        centroids[empty] = x[rng.choice(len(x), len(empty), replace=False)]
+    return centroids
+
+
+def nearest(x: np.ndarray, centroids: np.ndarray, chunk_size: int = 65536) -> np.ndarray:
+    """The index of the nearest centroid, by Euclidean distance, of each row of `x`."""
+    norms = (centroids**2).sum(axis=1)
+    return np.concatenate(
+        [np.argmin(norms - 2 * x[i : i + chunk_size] @ centroids.T, axis=1) for i in range(0, len(x), chunk_size)]
+    )
+
+
+class IVFPQIndex:
+    """An IVF-PQ index of vectors by dot product. For cosine similarity, index and query normalized vectors.
+
+    Args:
+        centroids (np.ndarray): `(nlist, dim)` coarse centroids.
+        codebooks (np.ndarray): `(m, 256, dim / m)` product quantizer centroids, of residuals.
+        codes (np.ndarray): `(n, m)` uint8 codes of the vectors, grouped by list.
+        ids (np.ndarray): `(n,)` ids of the vectors, in the same order as `codes`.
+        offsets (np.ndarray): `(nlist + 1,)` start of each list in `codes`.
+    """
+
+    def __init__(
+        self, centroids: np.ndarray, codebooks: np.ndarray, codes: np.ndarray, ids: np.ndarray, offsets: np.ndarray
+    ) -> None:
+        self.centroids = centroids
+        self.codebooks = codebooks
+        self.codes = codes
+        self.ids = ids
+        self.offsets = offsets
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    @property
+    def nlist(self) -> int:
+        return len(self.centroids)
+
+    @property
+    def m(self) -> int:
+        return len(self.codebooks)
+
+    @classmethod
+    def build(
+        cls,
+        vectors: np.ndarray,
+        ids: np.ndarray | None = None,
+        nlist: int | None = None,
+        m: int | None = None,
+        train_size: int = 100_000,
+        iterations: int = 20,
+        seed: int = 0,
+    ) -> "IVFPQIndex":
+        """
+        Trains the quantizers on a sample of the vectors, and encodes all of them.
+
+        Args:
+            vectors (np.ndarray): `(n, dim)` vectors. May be memory-mapped.
+            ids (np.ndarray | None): The id of each vector. Defaults to its row.
+            nlist (int | None): Lists. Defaults to about `4 * sqrt(n)`.
+            m (int | None): Subspaces, and bytes per vector. Must divide `dim`. Defaults to `dim / 4`, or 1.
+            train_size (int): Most vectors the quantizers are trained on.
+            iterations (int): Of k-means.
+            seed (int): Of the training sample, and of k-means.
+
+        Raises:
+            ValueError: If `m` doesn't divide the dimension of the vectors.
+        """
+        n, dim = vectors.shape
+        nlist = nlist or max(1, min(int(4 * np.sqrt(n)), n))
+        m = m or (dim // 4 if dim % 4 == 0 else 1)
+        if dim % m:
+            raise ValueError(f"m={m} must divide the dimension of the vectors, {dim}")
+        ids = np.arange(n, dtype=np.int64) if ids is None else np.asarray(ids, dtype=np.int64)
+
+        t0 = time.perf_counter()
+        rng = np.random.default_rng(seed)
+        sample = np.asarray(vectors[np.sort(rng.choice(n, min(n, train_size), replace=False))], dtype=np.float32)
+        centroids = kmeans(sample, nlist, iterations, seed)
+        residuals = (sample - centroids[nearest(sample, centroids)]).reshape(len(sample), m, dim // m)
+        ks = min(256, len(sample))
+        codebooks = np.stack([kmeans(residuals[:, j], ks, iterations, seed) for j in range(m)])
+
+        assign = np.empty(n, dtype=np.int64)
+        codes = np.empty((n, m), dtype=np.uint8)
+        for i in range(0, n, 65536):
+            chunk = np.asarray(vectors[i : i + 65536], dtype=np.float32)
+            assign[i : i + len(chunk)] = nearest(chunk, centroids)
+            residual = (chunk - centroids[assign[i : i + len(chunk)]]).reshape(len(chunk), m, dim // m)
+            for j in range(m):
+                codes[i : i + len(chunk), j] = nearest(residual[:, j], codebooks[j])
+
+        order = np.argsort(assign, kind="stable")
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(assign, minlength=nlist))]).astype(np.int64)
+        logger.info(f"Built an IVF-PQ index of {n} vectors, nlist={nlist} m={m}, in {time.perf_counter() - t0:.1f}s")
+        return cls(centroids, codebooks, codes[order], ids[order], offsets)
+
+    def search(
+        self,
+        query: np.ndarray,
+        k: int,
+        nprobe: int = 8,
+        refine: int = 1,
+        vectors: np.ndarray | None = None,
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """
+        The ids and scores of the `k` vectors with the highest approximate dot product with the query.
+
+        Args:
+            query (np.ndarray): `(dim,)` query vector.
+            k (int): Results to return.
+            nprobe (int): Lists searched. Higher is slower, with better recall.
+            refine (int): With `vectors`, `refine * k` candidates are re-scored exactly. Higher is slower,
+                with better recall and exact scores.
+            vectors (np.ndarray | None): The original vectors, indexed by id, to re-score candidates with.
+
+        Returns:
+            Tuple: Ids and scores, best first.
+        """
+        query = np.asarray(query, dtype=np.float32)
+        coarse = self.centroids @ query
+        probe = np.argsort(-coarse)[: max(1, min(nprobe, self.nlist))]
+        starts, ends = self.offsets[probe], self.offsets[probe + 1]
+        rows = np.concatenate([np.arange(s, e) for s, e in zip(starts, ends, strict=True)])
+        if len(rows) == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+
+        # The dot product of the query with each code of each subspace
+        table = np.einsum("jcd,jd->jc", self.codebooks, query.reshape(self.m, -1))
+        scores = np.repeat(coarse[probe], ends - starts) + table[np.arange(self.m), self.codes[rows]].sum(axis=1)
+
+        n = k * refine if vectors is not None and refine > 1 else k
+        top = top_k(-scores, n)
+        ids, scores = self.ids[rows[top]], scores[top]
+        if n > k:
+            scores = np.asarray(vectors[np.sort(ids)] @ query)[np.argsort(np.argsort(ids))]  # type: ignore
+            top = top_k(-scores, k)
+            ids, scores = ids[top], scores[top]
+        return ids, scores
+
+    def save(self, path: str | Path) -> None:
+        path = Path(path)
+        path.mkdir(parents=True, exist_ok=True)
+        for name in _FILES:
+            np.save(path / f"{name}.npy", getattr(self, name))
+        (path / "meta.json").write_text(json.dumps({"vectors": len(self), "nlist": self.nlist, "m": self.m}))
+
+    @classmethod
+    def load(cls, path: str | Path) -> "IVFPQIndex":
+        """Loads an index saved with `save`. The codes and ids are memory-mapped."""
+        path = Path(path)
+        arrays = {name: np.load(path / f"{name}.npy", mmap_mode="r") for name in _FILES}
+        # The quantizers are small, and read by every search
+        return cls(**{**arrays, "centroids": np.array(arrays["centroids"]), "codebooks": np.array(arrays["codebooks"])})
+
+
+def top_k(order: np.ndarray, k: int) -> np.ndarray:
+    """Indices of the `k` smallest values, sorted. `argpartition` finds them in linear time."""
+    k = min(k, len(order))
+    if k == 0:
+        return np.empty(0, dtype=np.int64)
+    top = np.argpartition(order, k - 1)[:k]
+    return top[np.argsort(order[top], kind="stable")]
@@ -0,0 +1,450 @@
+"""An in-process vector index, for edge deployments, tests and benchmarks, without a Qdrant server.
+
+Each collection is a directory holding a float32 matrix of vectors, memory-mapped for search, and a
+SQLite sidecar of point ids and JSON payloads. Search is an exact top-k, by a NumPy dot product of
+the query with every vector that passes the filter. Collections with an IVF-PQ index, built with
+`build_ann`, are searched approximately instead, unless the search is filtered, or asks to be exact.
+
+`LocalIndex` implements the subset of `QdrantClient` used by this app, so `search_collection`,
+`search_collection_batch` and `ingest` work with either. Select it with `backend: local` in the
+retrieval config.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import threading
+from collections.abc import Sequence
+from pathlib import Path
+from typing import Any
+
+import numpy as np
+from qdrant_client.http import models
+
+import app.logconfig
+from app.store.ivfpq import IVFPQIndex, top_k
+
+# Whether to return payloads, or which of their keys, as in Qdrant
+WithPayload = bool | Sequence[str] | models.PayloadSelectorInclude | models.PayloadSelectorExclude
+
+logger = app.logconfig.setup_logger("root")
+
+
+class LocalIndexError(Exception):
+    """Raised for collections that don't exist, and for requests the local index doesn't support."""
+
+    pass
+
+
+class LocalCollection:
+    """A collection of a `LocalIndex`. Searches are thread-safe, and may run alongside upserts.
+
+    The committed rows of the SQLite sidecar are the points of the collection. Vectors past them are dropped.
+    """
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        meta = json.loads((path / "meta.json").read_text())
+        self.size: int = meta["size"]
+        self.distance = models.Distance(meta["distance"])
+        self._db = sqlite3.connect(path / "points.db", check_same_thread=False, isolation_level=None)
+        self._lock = threading.Lock()
+        rows = self._db.execute("SELECT row, id FROM points ORDER BY row").fetchall()
+        self._truncate_vectors(len(rows))
+        self._ids = np.array([i for _, i in rows], dtype=np.int64)
+        self._rows = {i: row for row, i in rows}
+        self._matrix: np.ndarray | None = None
+        self.ann = IVFPQIndex.load(path / "ivfpq") if (path / "ivfpq" / "meta.json").exists() else None
+
+    @classmethod
+    def create(cls, path: Path, size: int, distance: models.Distance) -> "LocalCollection":
+        path.mkdir(parents=True)
+        (path / "meta.json").write_text(json.dumps({"size": size, "distance": distance.value}))
+        (path / "vectors.f32").touch()
+        with sqlite3.connect(path / "points.db") as db:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("CREATE TABLE points (id INTEGER PRIMARY KEY, row INTEGER UNIQUE, payload TEXT)")
+        return cls(path)
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def vectors(self) -> np.ndarray:
+        """The `(points, size)` matrix of vectors, memory-mapped."""
+        matrix = self._matrix
+        if matrix is None or len(matrix) != len(self._ids):
+            with self._lock:
+                if len(self._ids) == 0:
+                    matrix = np.empty((0, self.size), dtype=np.float32)
+                else:
+                    matrix = np.memmap(self.path / "vectors.f32", np.float32, "r", shape=(len(self._ids), self.size))
+                self._matrix = matrix
+        return matrix
+
+    def upsert(self, ids: Sequence[Any], vectors: Sequence[Sequence[float]], payloads: Sequence[dict | None]) -> None:
+        """Replaces the points with existing ids, and appends the others."""
+        if any(not isinstance(i, int) for i in ids):
+            raise LocalIndexError("The local index only supports integer point ids")
+        matrix = np.asarray(vectors, dtype=np.float32).reshape(len(ids), self.size)
+        if self.distance == models.Distance.COSINE:
+            matrix = _normalized(matrix)
+
+        with self._lock:
+            new = [k for k, i in enumerate(ids) if i not in self._rows]
+            old = [k for k, i in enumerate(ids) if i in self._rows]
+            new_rows = {ids[k]: len(self._ids) + n for n, k in enumerate(new)}
+            rows = {**self._rows, **new_rows}
+            # New vectors are written first, and only count once the rows that point at them are committed. Vectors
+            # past the committed rows, left by a failed upsert, or a crash, are truncated.
+            with open(self.path / "vectors.f32", "ab") as file:
+                file.write(matrix[new].tobytes())
+                file.flush()
+                os.fsync(file.fileno())
+            try:
+                self._db.execute("BEGIN")
+                self._db.executemany(
+                    "INSERT OR REPLACE INTO points VALUES (?, ?, ?)",
+                    [(i, rows[i], json.dumps(payload or {})) for i, payload in zip(ids, payloads, strict=True)],
+                )
+                self._db.execute("COMMIT")
+            except BaseException:
+                if self._db.in_transaction:
+                    self._db.execute("ROLLBACK")
+                self._truncate_vectors(len(self._ids))
+                raise
+            if old:
+                stored = np.memmap(self.path / "vectors.f32", np.float32, "r+", shape=(len(self._ids), self.size))
+                stored[[self._rows[ids[k]] for k in old]] = matrix[old]
+                stored.flush()
+            self._rows = rows
+            self._ids = np.concatenate([self._ids, np.array([ids[k] for k in new], dtype=np.int64)])
+            self._matrix = None
+
+    def search(
+        self,
+        query_vector: Sequence[float],
+        limit: int,
+        query_filter: models.Filter | None = None,
+        offset: int = 0,
+        score_threshold: float | None = None,
+        with_payload: WithPayload = True,
+        with_vectors: bool = False,
+        exact: bool = False,
+        nprobe: int = 8,
+        refine: int = 4,
+    ) -> list[models.ScoredPoint]:
+        """The `limit` points most similar to the query, that pass the filter, by descending score.
+
+        `nprobe` and `refine` are the knobs of the approximate search, see `IVFPQIndex.search`.
+        """
+        matrix = self.vectors()
+        query = np.asarray(query_vector, dtype=np.float32)
+        if self.distance == models.Distance.COSINE:
+            query = _normalized(query)
+
+        if self.ann is not None and query_filter is None and not exact:
+            rows, scores = self.ann.search(query, limit + offset, nprobe, refine, matrix)
+            # Points appended since the index was built are searched exactly
+            rows = np.concatenate([rows, np.arange(len(self.ann), len(matrix))])
+            scores = np.concatenate([scores, matrix[len(self.ann) :] @ query])
+            order = -scores
+        else:
+            rows = None
+            if query_filter is not None:
+                rows = self.filter_rows(query_filter)
+                rows = rows[rows < len(matrix)]  # Points upserted since the matrix was mapped
+            candidates = matrix if rows is None else matrix[rows]
+            if self.distance == models.Distance.EUCLID:
+                scores = np.linalg.norm(candidates - query, axis=1)
+                order = scores
+            else:
+                scores = candidates @ query
+                order = -scores
+        top = top_k(order, limit + offset)[offset:]
+        if score_threshold is not None:
+            # Smaller is better in `order`
+            top = top[order[top] <= (score_threshold if order is scores else -score_threshold)]
+
+        top_rows = top if rows is None else rows[top]
+        return self._points(top_rows, scores[top], with_payload, with_vectors)
+
+    def build_ann(self, **params: Any) -> IVFPQIndex:
+        """Builds and saves an IVF-PQ index of the points, with the params of `IVFPQIndex.build`.
+
+        Points upserted later are searched exactly, alongside the index, until it is built again.
+
+        Raises:
+            LocalIndexError: For collections by Euclidean distance. The index is by dot product.
+        """
+        if self.distance == models.Distance.EUCLID:
+            raise LocalIndexError("Approximate search is by dot product, or cosine similarity, not Euclidean distance")
+        index = IVFPQIndex.build(self.vectors(), **params)
+        index.save(self.path / "ivfpq")
+        self.ann = IVFPQIndex.load(self.path / "ivfpq")
+        return self.ann
+
+    def filter_rows(self, query_filter: models.Filter) -> np.ndarray:
+        """Rows of the points that pass the filter, in ascending order."""
+        mask = np.ones(len(self._ids), dtype=bool)
+        for condition in _conditions(query_filter.must):
+            mask &= self._matches(condition)
+        for condition in _conditions(query_filter.must_not):
+            mask &= ~self._matches(condition)
+        should = _conditions(query_filter.should)
+        if should:
+            mask &= np.logical_or.reduce([self._matches(condition) for condition in should])
+        return np.flatnonzero(mask)
+
+    def retrieve(
+        self, ids: Sequence[Any], with_payload: WithPayload = True, with_vectors: bool = False
+    ) -> list[models.Record]:
+        rows = np.array([self._rows[i] for i in ids if i in self._rows], dtype=np.int64)
+        return [
+            models.Record(id=p.id, payload=p.payload, vector=p.vector)
+            for p in self._points(rows, np.zeros(len(rows)), with_payload, with_vectors)
+        ]
+
+    def create_index(self, key: str) -> None:
+        """Indexes the payload key, so filters on it don't scan every payload."""
+        name = "payload_" + hashlib.sha1(key.encode()).hexdigest()[:16]
+        with self._lock:
+            self._db.execute(f"CREATE INDEX IF NOT EXISTS {name} ON points ({_json_field(key)})")
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.close()
+            self._matrix = None
+
+    def _truncate_vectors(self, points: int) -> None:
+        """Drops the vectors past the first `points`, which have no committed row."""
+        path = self.path / "vectors.f32"
+        length = points * self.size * np.dtype(np.float32).itemsize
+        if path.stat().st_size > length:
+            logger.warning(f"Dropping {path.stat().st_size - length} bytes of uncommitted vectors from {path}")
+            os.truncate(path, length)
+
+    def _matches(self, condition: models.FieldCondition) -> np.ndarray:
+        """A mask of the rows whose payload matches the condition."""
+        if isinstance(condition.match, models.MatchValue):
+            values = [condition.match.value]
+        elif isinstance(condition.match, models.MatchAny):
+            values = list(condition.match.any)
+        else:
+            raise LocalIndexError(f"The local index only supports match conditions, not {condition}")
+        placeholders = ", ".join("?" * len(values))
+        # The path is inlined, rather than bound, so the expression matches that of the key's index, if any
+        with self._lock:
+            rows = self._db.execute(
+                f"SELECT row FROM points WHERE {_json_field(condition.key)} IN ({placeholders})", values
+            ).fetchall()
+        mask = np.zeros(len(self._ids), dtype=bool)
+        mask[[row for (row,) in rows if row < len(mask)]] = True
+        return mask
+
+    def _points(
+        self, rows: np.ndarray, scores: np.ndarray, with_payload: WithPayload, with_vectors: bool
+    ) -> list[models.ScoredPoint]:
+        payloads = {}
+        if with_payload and len(rows):
+            placeholders = ", ".join("?" * len(rows))
+            with self._lock:
+                payloads = dict(
+                    self._db.execute(
+                        f"SELECT row, payload FROM points WHERE row IN ({placeholders})", rows.tolist()
+                    ).fetchall()
+                )
+        matrix = self.vectors() if with_vectors else None
+        return [
+            models.ScoredPoint(
+                id=int(self._ids[row]),
+                version=0,
+                score=float(score),
+                payload=_project(json.loads(payloads[row]), with_payload) if with_payload else None,
+                vector=matrix[row].tolist() if matrix is not None else None,
+            )
+            for row, score in zip(rows.tolist(), scores.tolist(), strict=True)
+        ]
+
+
+class LocalIndex:
+    """Collections of vectors in a directory, searched in process, with the interface of a `QdrantClient`.
+
+    Args:
+        path (str | Path): The directory of the collections. Created if it doesn't exist.
+        nprobe (int): Lists searched by approximate searches.
+        refine (int): Multiple of the results re-scored exactly by approximate searches.
+    """
+
+    def __init__(self, path: str | Path, nprobe: int = 8, refine: int = 4) -> None:
+        self.path = Path(path)
+        self.nprobe = nprobe
+        self.refine = refine
+        self.path.mkdir(parents=True, exist_ok=True)
+        self._collections: dict[str, LocalCollection] = {}
+        self._lock = threading.Lock()
+
+    def collection(self, collection_name: str) -> LocalCollection:
+        """The collection, opened on first use.
+
+        Raises:
+            LocalIndexError: If the collection doesn't exist.
+        """
+        try:
+            return self._collections[collection_name]
+        except KeyError:
+            pass
+        with self._lock:
+            if collection_name not in self._collections:
+                path = self.path / collection_name
+                if not (path / "meta.json").exists():
+                    raise LocalIndexError(f"Collection {collection_name} not found in {self.path}")
+                self._collections[collection_name] = LocalCollection(path)
+            return self._collections[collection_name]
+
+    def create_collection(self, collection_name: str, vectors_config: models.VectorParams, **_: Any) -> bool:
+        with self._lock:
+            self._collections[collection_name] = LocalCollection.create(
+                self.path / collection_name, vectors_config.size, vectors_config.distance
+            )
+        logger.info(f"Created local collection {collection_name} in {self.path}")
+        return True
+
+    def recreate_collection(self, collection_name: str, vectors_config: models.VectorParams, **_: Any) -> bool:
+        self.delete_collection(collection_name)
+        return self.create_collection(collection_name, vectors_config)
+
+    def delete_collection(self, collection_name: str, **_: Any) -> bool:
+        with self._lock:
+            collection = self._collections.pop(collection_name, None)
+            if collection is not None:
+                collection.close()
+            path = self.path / collection_name
+            if not path.exists():
+                return False
+            shutil.rmtree(path)
+            return True
+
+    def upsert(
+        self, collection_name: str, points: models.Batch | Sequence[models.PointStruct], **_: Any
+    ) -> models.UpdateResult:
+        if isinstance(points, models.Batch):
+            ids, vectors, payloads = points.ids, points.vectors, points.payloads or [None] * len(points.ids)
+        else:
+            ids = [p.id for p in points]
+            vectors = [p.vector for p in points]
+            payloads = [p.payload for p in points]
+        self.collection(collection_name).upsert(ids, vectors, payloads)  # type: ignore
+        return models.UpdateResult(operation_id=0, status=models.UpdateStatus.COMPLETED)
+
+    def upload_points(self, collection_name: str, points: Sequence[models.PointStruct], **_: Any) -> None:
+        self.upsert(collection_name, points)
+
+    def search(
+        self,
+        collection_name: str,
+        query_vector: Sequence[float],
+        query_filter: models.Filter | None = None,
+        limit: int = 10,
+        offset: int = 0,
+        with_payload: WithPayload = True,
+        with_vectors: bool = False,
+        score_threshold: float | None = None,
+        search_params: models.SearchParams | dict | None = None,
+        **_: Any,
+    ) -> list[models.ScoredPoint]:
+        """Searches the collection. Of the search params, only `exact` applies. Others, e.g. `hnsw_ef`, are ignored."""
+        if isinstance(search_params, dict):
+            search_params = models.SearchParams(**search_params)
+        exact = bool(search_params and search_params.exact)
+        return self.collection(collection_name).search(
+            query_vector,
+            limit,
+            query_filter,
+            offset,
+            score_threshold,
+            with_payload,
+            with_vectors,
+            exact,
+            self.nprobe,
+            self.refine,
+        )
+
+    def search_batch(
+        self, collection_name: str, requests: Sequence[models.SearchRequest], **_: Any
+    ) -> list[list[models.ScoredPoint]]:
+        return [
+            self.search(
+                collection_name,
+                request.vector,  # type: ignore
+                query_filter=request.filter,
+                limit=request.limit,
+                offset=request.offset or 0,
+                with_payload=request.with_payload or False,
+                with_vectors=bool(request.with_vector),
+                score_threshold=request.score_threshold,
+                search_params=request.params,
+            )
+            for request in requests
+        ]
+
+    def retrieve(
+        self,
+        collection_name: str,
+        ids: Sequence[Any],
+        with_payload: WithPayload = True,
+        with_vectors: bool = False,
+        **_: Any,
+    ) -> list[models.Record]:
+        return self.collection(collection_name).retrieve(ids, with_payload, with_vectors)
+
+    def create_payload_index(self, collection_name: str, field_name: str, **_: Any) -> models.UpdateResult:
+        """Indexes a payload key of the collection. Its schema is ignored, as payloads are JSON."""
+        self.collection(collection_name).create_index(field_name)
+        return models.UpdateResult(operation_id=0, status=models.UpdateStatus.COMPLETED)
+
+    def build_ann(self, collection_name: str, **params: Any) -> IVFPQIndex:
+        """Builds an IVF-PQ index of the collection, so searches of it are approximate."""
+        return self.collection(collection_name).build_ann(**params)
+
+    def count(self, collection_name: str, **_: Any) -> models.CountResult:
+        return models.CountResult(count=len(self.collection(collection_name)))
+
+    def close(self) -> None:
+        with self._lock:
+            for collection in self._collections.values():
+                collection.close()
+            self._collections.clear()
+
+
+def _conditions(conditions: Any) -> list[models.FieldCondition]:
+    if conditions is None:
+        return []
+    conditions = conditions if isinstance(conditions, list) else [conditions]
+    for condition in conditions:
+        if not isinstance(condition, models.FieldCondition):
+            raise LocalIndexError(f"The local index only supports field conditions, not {condition}")
+    return conditions
+
+
+def _project(payload: dict, with_payload: WithPayload) -> dict:
+    """The keys of the payload selected by `with_payload`."""
+    if isinstance(with_payload, models.PayloadSelectorInclude):
+        return {key: payload[key] for key in with_payload.include if key in payload}
+    if isinstance(with_payload, models.PayloadSelectorExclude):
+        return {key: value for key, value in payload.items() if key not in with_payload.exclude}
+    if isinstance(with_payload, bool):
+        return payload
+    return {key: payload[key] for key in with_payload if key in payload}
+
+
+def _json_field(key: str) -> str:
+    """SQL extracting the payload key, with the path as a quoted literal."""
+    path = f"$.{key}".replace("'", "''")
+    return f"json_extract(payload, '{path}')"
+
+
+def _normalized(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.where(norms == 0, 1, norms)
@@ -1,9 +1,31 @@
-from typing import Any
+import functools
+import json
+import unicodedata
+from typing import TYPE_CHECKING, Any
 
-from qdrant_client import QdrantClient
-from qdrant_client.http import models
-from qdrant_client.http.models import FieldCondition, Filter, MatchValue, ScoredPoint
-from sentence_transformers import SentenceTransformer
+import numpy as np
+from qdrant_client import AsyncQdrantClient, QdrantClient
+from qdrant_client.http.models import (
+    FieldCondition,
+    Filter,
+    MatchValue,
+    PayloadSchemaType,
+    ScoredPoint,
+    SearchRequest,
+)
+
+import app.logconfig
+from app.cache import BoundedCache, cache_key
+from app.registry import MODELS, config_key
+from app.store.client import ManagedClient, make_async_client, make_client
+from app.store.ingest import ingest
+from app.tracing import traced
+
+if TYPE_CHECKING:
+    # sentence_transformers imports torch, which takes seconds. It's imported when the encoder is loaded.
+    from sentence_transformers import SentenceTransformer
+
+logger = app.logconfig.setup_logger("root")
 
 
 class QDRANTArgumentsError(Exception):
@@ -12,13 +34,28 @@ class QDRANTArgumentsError(Exception):
     pass
 
 
-def get_client(params: dict) -> QdrantClient:
-    """params expects '`host`' and '`port`' keys"""
-    client = QdrantClient(params["host"], port=params["port"])
-    return client
+def get_client(params: dict) -> ManagedClient:
+    """params expects '`host`' and '`port`' keys. One client is shared per host, port and `client` options.
+
+    The `client` options set the transport, connection pool and timeouts, see `app.store.client`.
+    With `backend: local`, the client is a `LocalIndex` of the collections in the `local_path` directory
+    instead, searched in process. It has the same interface, for the functions of this module. `local_ann`
+    sets the `nprobe` and `refine` of its approximate searches.
+    """
+    return MODELS.get("qdrant_client", _client_key(params), lambda: make_client(params))
+
+
+def get_async_client(params: dict) -> ManagedClient:
+    """The async counterpart of `get_client`, for `asearch_collection` and `asearch_collection_batch`."""
+    return MODELS.get("qdrant_async_client", _client_key(params), lambda: make_async_client(params))
+
+
+def _client_key(params: dict) -> str:
+    return config_key(params, "backend", "host", "port", "client", "local_path", "local_ann")
 
 
-def encode_text(encoder: SentenceTransformer, text: str) -> list[float]:
+@traced("encode_text")
+def encode_text(encoder: "SentenceTransformer", text: str) -> list[float]:
     """
     A function that encodes the input text using a SentenceTransformer and returns a
     list of floats representing the vectorized text and an integer.
@@ -34,12 +71,61 @@ def encode_text(encoder: SentenceTransformer, text: str) -> list[float]:
     return vector.tolist()  # type: ignore
 
 
-def get_encoder(config: dict) -> SentenceTransformer:
+@traced("encode_texts")
+def encode_texts(encoder: "SentenceTransformer", texts: list[str]) -> list[list[float]]:
+    """Encodes many texts in a single call to the encoder. Returns one vector per text, in input order."""
+    vectors = encoder.encode(texts)
+    return vectors.tolist()  # type: ignore
+
+
+def get_encoder(config: dict) -> "SentenceTransformer":
+    """The `encoder` model of the config. Loaded once per model name."""
+    return MODELS.get("encoder", config_key(config, "encoder"), lambda: _encoder(config))
+
+
+def _encoder(config: dict) -> "SentenceTransformer":
+    from sentence_transformers import SentenceTransformer
+
     return SentenceTransformer(config["encoder"])
 
 
+def normalize_query(text: str) -> str:
+    """The query, Unicode (NFKC) normalized and case folded, with runs of whitespace collapsed."""
+    return " ".join(unicodedata.normalize("NFKC", text).casefold().split())
+
+
+def embedding_cache_key(text: str, encoder_name: str) -> str:
+    """Queries that are the same once normalized share a key, for the same encoder."""
+    return cache_key(normalize_query(text), encoder_name)
+
+
+def get_embedding_cache(config: dict) -> BoundedCache | None:
+    """The query embedding cache of the `embedding_cache` config, if enabled. Shared by retrievers with the same config.
+
+    Vectors are stored as float32 bytes. With a `path`, the cache has a SQLite tier, shared by every
+    process that opens it, e.g. the API's workers.
+    """
+    cache_config = {**config.get("embedding_cache", {})}
+    if not cache_config.pop("enabled", False):
+        return None
+    return MODELS.get(
+        "embedding_cache",
+        config_key(config, "embedding_cache"),
+        lambda: BoundedCache("embedding", encode=_float32_bytes, decode=_float32_vector, **cache_config),
+    )
+
+
+def _float32_bytes(vector: list[float]) -> bytes:
+    return np.asarray(vector, dtype=np.float32).tobytes()
+
+
+def _float32_vector(data: bytes) -> np.ndarray:
+    return np.frombuffer(data, dtype=np.float32)
+
+
+@traced("search_collection")
 def search_collection(
-    client: QdrantClient,
+    client: "ManagedClient | QdrantClient",
     query_vector: list[float],
     limit: int,
     collection_name: str,
@@ -63,6 +149,30 @@ def search_collection(
         QDRANTArgumentsError: If conflicting keys are found in `search_kwargs`.
     """
 
+    return client.search(**_search_args(query_vector, limit, collection_name, search_kwargs, search_filters))
+
+
+@traced("asearch_collection")
+async def asearch_collection(
+    client: "ManagedClient | AsyncQdrantClient",
+    query_vector: list[float],
+    limit: int,
+    collection_name: str,
+    search_kwargs: dict[str, Any] | None = None,
+    search_filters: dict | None = None,
+) -> list[ScoredPoint]:
+    """Async counterpart of `search_collection`, with a client of `get_async_client`."""
+    return await client.search(**_search_args(query_vector, limit, collection_name, search_kwargs, search_filters))
+
+
+def _search_args(
+    query_vector: list[float],
+    limit: int,
+    collection_name: str,
+    search_kwargs: dict[str, Any] | None,
+    search_filters: dict | None,
+) -> dict[str, Any]:
+    """Keyword arguments of `client.search`."""
     if search_kwargs is None:
         search_kwargs = {}
 
@@ -70,35 +180,143 @@ def search_collection(
     if conflicting_keys:
         raise QDRANTArgumentsError(f"Conflicting keys found in search_kwargs: {', '.join(conflicting_keys)}")
 
-    if not search_filters:
-        search_result = client.search(
-            collection_name=collection_name, query_vector=query_vector, limit=limit, **search_kwargs
-        )
-    else:
-        must_filters = search_filters.get("must", [])
-        should_filters = search_filters.get("should", [])
-
-        must_conditions = [
-            FieldCondition(key=f["key"], match=MatchValue(value=f["match"]["value"])) for f in must_filters
-        ]
-        should_conditions = [
-            FieldCondition(key=f["key"], match=MatchValue(value=f["match"]["value"])) for f in should_filters
-        ]
-
-        query_filter = Filter(must=must_conditions, should=should_conditions)  # type: ignore
-
-        search_result = client.search(
-            collection_name=collection_name,
-            query_vector=query_vector,
-            query_filter=query_filter,
-            with_payload=True,
-            limit=limit,
-            **search_kwargs,
+    search_args = {"collection_name": collection_name, "query_vector": query_vector, "limit": limit, **search_kwargs}
+    if search_filters:
+        search_args["query_filter"] = compile_filter(search_filters)
+        search_args.setdefault("with_payload", True)
+    return search_args
+
+
+# `client.search` keyword arguments, that are named differently on a `SearchRequest`
+_SEARCH_REQUEST_FIELDS = {"search_params": "params", "with_vectors": "with_vector", "query_filter": "filter"}
+
+
+@traced("search_collection_batch")
+def search_collection_batch(
+    client: "ManagedClient | QdrantClient",
+    query_vectors: list[list[float]],
+    limit: int | list[int],
+    collection_name: str,
+    search_kwargs: dict[str, Any] | None = None,
+    search_filters: list[dict | None] | None = None,
+) -> list[list[ScoredPoint]]:
+    """
+    Query a collection with many query vectors in a single round-trip to the vector store.
+
+    Args:
+        query_vectors (List[List[float]]): The query vectors.
+        limit (int | List[int]): The maximum number of results to return per query, or for each query.
+        collection_name (str): The name of the collection to search.
+        search_kwargs (Optional[Dict[str, Any]]): Additional search parameters, applied to every query.
+        search_filters (Optional[List[Optional[Dict]]]): Filters to apply to each query. Same length as `query_vectors`.
+
+    Returns:
+        List[List[ScoredPoint]]: The search results for each query vector, in input order.
+
+    Raises:
+        QDRANTArgumentsError: If conflicting keys are found in `search_kwargs`.
+    """
+
+    requests = _search_requests(query_vectors, limit, search_kwargs, search_filters)
+    return client.search_batch(collection_name=collection_name, requests=requests)
+
+
+@traced("asearch_collection_batch")
+async def asearch_collection_batch(
+    client: "ManagedClient | AsyncQdrantClient",
+    query_vectors: list[list[float]],
+    limit: int | list[int],
+    collection_name: str,
+    search_kwargs: dict[str, Any] | None = None,
+    search_filters: list[dict | None] | None = None,
+) -> list[list[ScoredPoint]]:
+    """Async counterpart of `search_collection_batch`, with a client of `get_async_client`."""
+    requests = _search_requests(query_vectors, limit, search_kwargs, search_filters)
+    return await client.search_batch(collection_name=collection_name, requests=requests)
+
+
+def _search_requests(
+    query_vectors: list[list[float]],
+    limit: int | list[int],
+    search_kwargs: dict[str, Any] | None,
+    search_filters: list[dict | None] | None,
+) -> list[SearchRequest]:
+    if search_kwargs is None:
+        search_kwargs = {}
+    if search_filters is None:
+        search_filters = [None] * len(query_vectors)
+    limits = [limit] * len(query_vectors) if isinstance(limit, int) else limit
+
+    conflicting_keys = set(search_kwargs.keys()) & {"query_vector", "limit", "collection_name"}
+    if conflicting_keys:
+        raise QDRANTArgumentsError(f"Conflicting keys found in search_kwargs: {', '.join(conflicting_keys)}")
+
+    request_kwargs = {_SEARCH_REQUEST_FIELDS.get(k, k): v for k, v in search_kwargs.items()}
+    request_kwargs.setdefault("with_payload", True)
+    return [
+        SearchRequest(
+            vector=query_vector,
+            filter=compile_filter(search_filter) if search_filter else None,
+            limit=query_limit,
+            **request_kwargs,
         )
-    return search_result
+        for query_vector, search_filter, query_limit in zip(query_vectors, search_filters, limits, strict=True)
+    ]
+
+
+def build_filter(search_filters: dict) -> Filter:
+    """Builds a Qdrant `Filter` from `must` and `should` lists of `{"key": ..., "match": {"value": ...}}` items."""
+    must_filters = search_filters.get("must", [])
+    should_filters = search_filters.get("should", [])
+
+    must_conditions = [FieldCondition(key=f["key"], match=MatchValue(value=f["match"]["value"])) for f in must_filters]
+    should_conditions = [
+        FieldCondition(key=f["key"], match=MatchValue(value=f["match"]["value"])) for f in should_filters
+    ]
+
+    # An empty `should` list matches nothing, rather than everything.
+    return Filter(must=must_conditions or None, should=should_conditions or None)  # type: ignore
+
+
+def canonical_filter(search_filters: dict) -> str:
+    """The filters as JSON, with their conditions sorted, so the same conditions in any order are the same filter."""
+    return json.dumps(
+        {
+            clause: sorted(search_filters[clause], key=lambda c: json.dumps(c, sort_keys=True))
+            for clause in ("must", "should")
+            if search_filters.get(clause)
+        },
+        sort_keys=True,
+    )
+
+
+def compile_filter(search_filters: dict) -> Filter:
+    """`build_filter`, memoized by the canonical form of the filters. The `Filter` is shared, so must not be changed."""
+    return _compiled_filter(canonical_filter(search_filters))
+
 
+@functools.lru_cache(maxsize=4096)
+def _compiled_filter(canonical: str) -> Filter:
+    return build_filter(json.loads(canonical))
 
-def embed_create_collection(client: QdrantClient, data: list[dict], collection_name: str, encoder) -> None:
+
+def ensure_payload_indexes(
+    client: "ManagedClient | QdrantClient", collection_name: str, payload_indexes: dict[str, str]
+) -> None:
+    """Creates the payload indexes that filtered searches need to be fast, from payload keys to their schemas,
+    e.g. `{"country": "keyword"}`. Indexes that exist, with the same schema, are unchanged.
+
+    Run at start-up, or after ingestion, never on the request path, as creating an index rewrites the
+    collection's payload storage.
+    """
+    for key, schema in payload_indexes.items():
+        client.create_payload_index(collection_name, field_name=key, field_schema=PayloadSchemaType(schema))
+        logger.info(f"Created a {schema} payload index of {key} in {collection_name}")
+
+
+def embed_create_collection(
+    client: QdrantClient, data: list[dict], collection_name: str, encoder: "SentenceTransformer", **ingest_kwargs: Any
+) -> None:
     """
     Generate a new collection in Qdrant with the provided data and collection name.
 
@@ -107,29 +325,9 @@ def embed_create_collection(client: QdrantClient, data: list[dict], collection_n
         data (list[dict]): List of dictionaries containing data for the collection.
         collection_name (str): Name of the collection to be created.
         encoder: The encoder object used to encode text into vectors.
+        ingest_kwargs: Batch sizes and parallelism, passed on to `app.store.ingest.ingest`.
 
     Returns:
         None
     """
-
-    size = encoder.get_sentence_embedding_dimension()
-
-    print(f"\nembedding size = {size=}\n")
-    client.recreate_collection(
-        collection_name=collection_name,
-        vectors_config=models.VectorParams(
-            size=size,
-            distance=models.Distance.DOT,
-        ),
-    )
-
-    points = []
-    for idx, item in enumerate(data):
-        vector = encoder.encode(item["text"]).tolist()
-        payload = {k: v for k, v in item.items()}
-        points.append(models.PointStruct(id=idx, vector=vector, payload=payload))
-
-    client.upload_points(
-        collection_name=collection_name,
-        points=points,
-    )
+    ingest(client, data, collection_name, encoder, **ingest_kwargs)
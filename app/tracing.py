@@ -0,0 +1,204 @@
+"""Structured tracing. A trace per `event_id`, with a span per stage and child spans for the work inside it.
+
+Spans are sent to a pluggable exporter. Nothing is recorded until a trace is started, and the
+default exporter discards spans, so untraced code paths pay almost nothing.
+"""
+
+import contextlib
+import contextvars
+import functools
+import inspect
+import json
+import os
+import queue
+import threading
+import time
+from collections.abc import Callable, Iterator
+from typing import Any
+
+
+class Span:
+    """A timed operation in a trace. Serialised by the exporters with `to_dict`."""
+
+    __slots__ = ("attributes", "duration_ns", "error", "name", "parent_id", "span_id", "start_time_ns", "trace_id")
+
+    def __init__(self, trace_id: str, name: str, parent_id: str | None = None, **attributes: Any) -> None:
+        self.trace_id = trace_id
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.name = name
+        self.attributes = attributes
+        self.start_time_ns = time.time_ns()
+        self.duration_ns: int | None = None
+        self.error: str | None = None
+
+    def set(self, **attributes: Any) -> None:
+        self.attributes.update(attributes)
+
+    def to_dict(self) -> dict:
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start_time_ns": self.start_time_ns,
+            "duration_ns": self.duration_ns,
+            "attributes": self.attributes,
+            "error": self.error,
+        }
+
+
+class SpanExporter:
+    """Receives finished spans. Subclass to send spans to a tracing backend. The base class discards them."""
+
+    def export(self, span: Span) -> None:
+        pass
+
+    def flush(self) -> None:
+        pass
+
+
+class InMemoryExporter(SpanExporter):
+    """Keeps finished spans in a list. For tests."""
+
+    def __init__(self) -> None:
+        self.spans: list[Span] = []
+
+    def export(self, span: Span) -> None:
+        self.spans.append(span)
+
+
+class JSONLExporter(SpanExporter):
+    """Appends spans to a local JSON lines file, one span per line.
+
+    Spans are written by a background thread, so the request path doesn't wait on file I/O.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._queue: queue.SimpleQueue[Span] = queue.SimpleQueue()
+        self._flushed = threading.Condition()
+        self._pending = 0
+        self._writer = threading.Thread(target=self._write, name="xbot-span-writer", daemon=True)
+        self._writer.start()
+
+    def export(self, span: Span) -> None:
+        with self._flushed:
+            self._pending += 1
+        self._queue.put(span)
+
+    def flush(self) -> None:
+        """Waits until every exported span has been written."""
+        with self._flushed:
+            self._flushed.wait_for(lambda: self._pending == 0)
+
+    def _write(self) -> None:
+        with open(self.path, "a") as f:
+            while True:
+                spans = [self._queue.get()]
+                while not self._queue.empty():
+                    spans.append(self._queue.get())
+                f.writelines(json.dumps(s.to_dict(), default=str) + "\n" for s in spans)
+                f.flush()
+                with self._flushed:
+                    self._pending -= len(spans)
+                    self._flushed.notify_all()
+
+
+_exporter: SpanExporter = SpanExporter()
+_current_span: contextvars.ContextVar[Span | None] = contextvars.ContextVar("current_span", default=None)
+
+
+def set_exporter(exporter: SpanExporter) -> SpanExporter:
+    """Sets where finished spans are sent. Returns the previous exporter."""
+    global _exporter
+    previous, _exporter = _exporter, exporter
+    return previous
+
+
+def configure_tracing(config: dict) -> SpanExporter:
+    """Sets the exporter from config. `exporter` is `jsonl` (written to `path`), or `none`. Returns the
+    previous exporter.
+    """
+    if config.get("exporter") == "jsonl":
+        return set_exporter(JSONLExporter(config.get("path", "traces.jsonl")))
+    return set_exporter(SpanExporter())
+
+
+def current_span() -> Span | None:
+    return _current_span.get()
+
+
+@contextlib.contextmanager
+def trace(trace_id: str, name: str = "request", **attributes: Any) -> Iterator[Span]:
+    """Starts a trace, with a root span. Spans started within it, in this thread or task, are its children."""
+    with _record(Span(trace_id, name, **attributes)) as root:
+        yield root
+
+
+@contextlib.contextmanager
+def batch_trace(trace_ids: list[str], name: str = "batch", **attributes: Any) -> Iterator[Span]:
+    """Starts a trace for a batch of events that share their work, with a root span that lists them.
+    Spans started within it are its children.
+
+    Each event also gets a trace of its own, so it can be found by its id, with a `request` root span
+    that links to the batch trace by `batch_trace_id`.
+    """
+    batch = Span(os.urandom(8).hex(), name, event_ids=list(trace_ids), **attributes)
+    roots = [Span(trace_id, "request", batch_trace_id=batch.trace_id, **attributes) for trace_id in trace_ids]
+    try:
+        with _record(batch):
+            yield batch
+    finally:
+        for root in roots:
+            root.duration_ns, root.error = batch.duration_ns, batch.error
+            _exporter.export(root)
+
+
+@contextlib.contextmanager
+def span(name: str, **attributes: Any) -> Iterator[Span | None]:
+    """Starts a child span of the current span. Does nothing outside of a trace."""
+    parent = _current_span.get()
+    if parent is None:
+        yield None
+        return
+    with _record(Span(parent.trace_id, name, parent.span_id, **attributes)) as child:
+        yield child
+
+
+def traced(name: str) -> Callable:
+    """Decorator that records each call of the function, or coroutine function, as a span."""
+
+    def decorator(func: Callable) -> Callable:
+        if inspect.iscoroutinefunction(func):
+
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs) -> Any:
+                with span(name):
+                    return await func(*args, **kwargs)
+
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs) -> Any:
+            with span(name):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+@contextlib.contextmanager
+def _record(s: Span) -> Iterator[Span]:
+    token = _current_span.set(s)
+    t0 = time.perf_counter_ns()
+    try:
+        yield s
+    except BaseException as e:
+        s.error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        s.duration_ns = time.perf_counter_ns() - t0
+        _current_span.reset(token)
+        _exporter.export(s)
@@ -1,21 +1,249 @@
+import asyncio
 import concurrent.futures
+import contextvars
 import functools
+import queue
+import threading
+import time
 from collections.abc import Callable
 from typing import Any
 
+from app.metrics import REGISTRY
 
-def run_until_timeout(func: Callable, timeout: float, timeout_error_type: type[Exception], *args, **kwargs) -> Any:
-    """Runs the function in a separate thread and raises a exception if it exceeds the timeout.
+# Default sizes of the process-wide pools, per class of resource. Override with `configure_executors`.
+EXECUTOR_DEFAULTS = {
+    "embedding": {"max_workers": 4, "max_queue": 32},
+    "llm": {"max_workers": 2, "max_queue": 16},
+    "io": {"max_workers": 16, "max_queue": 128},
+}
+
+
+class ExecutorSaturatedError(Exception):
+    """Raised when a pool already has its maximum amount of work queued."""
+
+    pass
+
+
+class BoundedExecutor:
+    """A thread pool for one class of resource, shared by the whole process, with a limit on queued work.
+
+    Tracks how saturated the pool is: work queued and running, and totals of submitted, completed,
+    rejected (queue full) and timed out work.
+    """
+
+    def __init__(self, name: str, max_workers: int, max_queue: int) -> None:
+        self.name = name
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers, thread_name_prefix=f"xbot-{name}")
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._running = 0
+        self._counts = {"submitted": 0, "completed": 0, "rejected": 0, "timed_out": 0}
+
+    def submit(self, fn: Callable, *args, **kwargs) -> concurrent.futures.Future:
+        """Schedules the function on the pool.
+
+        Raises:
+            ExecutorSaturatedError: If all workers are busy, and the queue is full.
+        """
+        with self._lock:
+            if self._in_flight >= self.max_workers + self.max_queue:
+                self._counts["rejected"] += 1
+                raise ExecutorSaturatedError(f"The {self.name} pool is full ({self._in_flight} in flight)")
+            self._in_flight += 1
+            self._counts["submitted"] += 1
+
+        # Run in a copy of the caller's context, so the work is traced under the caller's span
+        future = self._executor.submit(contextvars.copy_context().run, self._run, fn, *args, **kwargs)
+        future.add_done_callback(self._done)
+        return future
+
+    def run_async(self, fn: Callable, *args, **kwargs) -> asyncio.Future:
+        """Schedules the function on the pool, and returns an awaitable for its result."""
+        return asyncio.wrap_future(self.submit(fn, *args, **kwargs))
+
+    def abandon(self, future: concurrent.futures.Future) -> None:
+        """Gives up on late work. It is cancelled if it hasn't started, otherwise its result is discarded."""
+        future.cancel()
+        with self._lock:
+            self._counts["timed_out"] += 1
+
+    def stats(self) -> dict[str, int | float]:
+        with self._lock:
+            return {
+                "max_workers": self.max_workers,
+                "max_queue": self.max_queue,
+                "running": self._running,
+                "queued": self._in_flight - self._running,
+                "saturation": self._running / self.max_workers,
+                **self._counts,
+            }
+
+    def shutdown(self) -> None:
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def _run(self, fn: Callable, *args, **kwargs) -> Any:
+        with self._lock:
+            self._running += 1
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            with self._lock:
+                self._running -= 1
+
+    def _done(self, _: concurrent.futures.Future) -> None:
+        with self._lock:
+            self._in_flight -= 1
+            self._counts["completed"] += 1
+
+
+_executors: dict[str, BoundedExecutor] = {}
+_executors_lock = threading.Lock()
+
+
+def get_executor(resource: str) -> BoundedExecutor:
+    """Returns the process-wide pool for a class of resource (`embedding`, `llm`, `io`), creating it on first use."""
+    with _executors_lock:
+        if resource not in _executors:
+            sizes = EXECUTOR_DEFAULTS.get(resource, EXECUTOR_DEFAULTS["io"])
+            _executors[resource] = BoundedExecutor(resource, **sizes)
+        return _executors[resource]
+
+
+def configure_executors(config: dict[str, dict]) -> None:
+    """Sets the size of each pool, as `{resource: {"max_workers": int, "max_queue": int}}`.
+
+    Pools that already exist are replaced. Work already running on them is left to finish.
+    """
+    with _executors_lock:
+        for resource, sizes in config.items():
+            if resource in _executors:
+                _executors.pop(resource).shutdown()
+            _executors[resource] = BoundedExecutor(resource, **{**EXECUTOR_DEFAULTS.get(resource, {}), **sizes})
+
+
+def executor_stats() -> dict[str, dict[str, int | float]]:
+    """Saturation metrics for each pool."""
+    with _executors_lock:
+        executors = list(_executors.values())
+    return {e.name: e.stats() for e in executors}
+
+
+def _executor_gauge(stat: str) -> None:
+    REGISTRY.gauge(
+        f"xbot_executor_{stat}",
+        f"Executor pool {stat.replace('_', ' ')}.",
+        lambda: {(("pool", name),): stats[stat] for name, stats in executor_stats().items()},
+    )
+
+
+for _stat in ("running", "queued", "saturation", "submitted", "completed", "rejected", "timed_out"):
+    _executor_gauge(_stat)
+
+
+BATCHES = REGISTRY.counter("xbot_dynamic_batches_total", "Batches processed by each dynamic batcher.")
+BATCHED_ITEMS = REGISTRY.counter("xbot_dynamic_batch_items_total", "Items processed by each dynamic batcher.")
+
+
+class DynamicBatcher:
+    """Groups items submitted concurrently, from any thread, and processes them together in one call.
+
+    A batch is processed when `max_batch_size` items are waiting, or `max_wait_ms` after its first item
+    arrived, whichever is first. Batches are processed one at a time, on the batcher's own thread,
+    and items that arrive meanwhile join the next batch. Items whose future was cancelled are left out.
+
+    Args:
+        name (str): Labels the batcher's metrics, and its thread.
+        func (Callable): Processes a list of items, and returns a list of results in the same order.
+        max_batch_size (int): Maximum number of items in a batch.
+        max_wait_ms (float): Longest time the first item of a batch waits for others to join it.
+        max_queue (int): Maximum number of items waiting for a batch.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        func: Callable[[list], list],
+        max_batch_size: int = 8,
+        max_wait_ms: float = 5.0,
+        max_queue: int = 64,
+    ) -> None:
+        self.name = name
+        self.func = func
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.max_queue = max_queue
+        self._queue: queue.Queue[tuple[Any, concurrent.futures.Future, contextvars.Context]] = queue.Queue(max_queue)
+        self._worker: threading.Thread | None = None
+        self._lock = threading.Lock()
+
+    def submit(self, item: Any) -> concurrent.futures.Future:
+        """Queues the item for the next batch. Returns a future for its result.
+
+        Raises:
+            ExecutorSaturatedError: If `max_queue` items are already waiting.
+        """
+        with self._lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._run, name=f"xbot-{self.name}-batcher", daemon=True)
+                self._worker.start()
+
+        future: concurrent.futures.Future = concurrent.futures.Future()
+        try:
+            self._queue.put_nowait((item, future, contextvars.copy_context()))
+        except queue.Full:
+            raise ExecutorSaturatedError(f"The {self.name} batcher is full ({self.max_queue} waiting)")
+        return future
+
+    def _run(self) -> None:
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                try:
+                    batch.append(self._queue.get(timeout=max(deadline - time.monotonic(), 0)))
+                except queue.Empty:
+                    break
+            # Marks the futures as running, so they can no longer be cancelled
+            batch = [entry for entry in batch if entry[1].set_running_or_notify_cancel()]
+            if batch:
+                self._process(batch)
+
+    def _process(self, batch: list[tuple[Any, concurrent.futures.Future, contextvars.Context]]) -> None:
+        BATCHES.inc(batcher=self.name)
+        BATCHED_ITEMS.inc(len(batch), batcher=self.name)
+        try:
+            # Run in the context of the first caller, so the batch is traced under its span
+            results = list(batch[0][2].run(self.func, [item for item, *_ in batch]))
+            if len(results) != len(batch):
+                raise ValueError(f"The {self.name} batcher got {len(results)} results for {len(batch)} items")
+        except Exception as e:
+            for _, future, _ in batch:
+                future.set_exception(e)
+            return
+        for result, (_, future, _) in zip(results, batch, strict=True):
+            future.set_result(result)
+
+
+def run_until_timeout(
+    func: Callable, timeout: float, timeout_error_type: type[Exception], *args, resource: str = "io", **kwargs
+) -> Any:
+    """Runs the function on a shared pool and raises a exception if it exceeds the timeout.
+
+    Returns as soon as the timeout passes. The late work is cancelled if it hasn't started yet,
+    otherwise it is abandoned and its result discarded.
 
     Args:
         func (Callable): The function to be executed.
         timeout (float): The maximum time the function is allowed to run.
         timeout_error_type (Type[Exception]): The type of exception to raise in case of a timeout.
         *args: Variable length argument list to pass to the function.
+        resource (str): The pool to run on, by the resource the function is bound by. `embedding`, `llm` or `io`.
         **kwargs: Arbitrary keyword arguments to pass to the function.
 
     Raises:
-        timeout_error_type: If the function exceeds the specified timeout.
+        timeout_error_type: If the function exceeds the specified timeout, or the pool is full.
 
     Returns:
         The result of the function.
@@ -31,12 +259,47 @@ def run_until_timeout(func: Callable, timeout: float, timeout_error_type: type[E
     # Create a partial function with the provided arguments
     wrapped_func = functools.partial(func_with_timeout, *args, **kwargs)
 
-    # Run the function in a separate thread
-    with concurrent.futures.ThreadPoolExecutor() as executor:
+    executor = get_executor(resource)
+    try:
         future = executor.submit(wrapped_func)
-        try:
-            # Wait for the function to complete, raise a timeout error if it exceeds the specified timeout
-            result = future.result(timeout=timeout)
-        except (Exception, timeout_error_type):
-            raise timeout_error_type(f"Function {func.__name__} took too long to respond")
+    except ExecutorSaturatedError as e:
+        raise timeout_error_type(f"Function {func.__name__} could not be scheduled. {e}")
+
+    try:
+        # Wait for the function to complete, raise a timeout error if it exceeds the specified timeout
+        result = future.result(timeout=timeout)
+    except concurrent.futures.TimeoutError:
+        executor.abandon(future)
+        raise timeout_error_type(f"Function {func.__name__} took too long to respond")
+    except (Exception, timeout_error_type):
+        raise timeout_error_type(f"Function {func.__name__} took too long to respond")
     return result
+
+
+async def arun_until_timeout(
+    func: Callable, timeout: float, timeout_error_type: type[Exception], *args, resource: str = "io", **kwargs
+) -> Any:
+    """Async counterpart of `run_until_timeout`.
+
+    The function is offloaded to a shared pool and awaited, so CPU bound work (model inference,
+    embedding) doesn't block the event loop.
+
+    Raises:
+        timeout_error_type: If the function exceeds the specified timeout, raises, or the pool is full.
+
+    Returns:
+        The result of the function.
+    """
+    executor = get_executor(resource)
+    try:
+        future = executor.submit(func, *args, **kwargs)
+    except ExecutorSaturatedError as e:
+        raise timeout_error_type(f"Function {func.__name__} could not be scheduled. {e}")
+
+    try:
+        return await asyncio.wait_for(asyncio.wrap_future(future), timeout=timeout)
+    except TimeoutError:
+        executor.abandon(future)
+        raise timeout_error_type(f"Function {func.__name__} took too long to respond")
+    except (Exception, timeout_error_type):
+        raise timeout_error_type(f"Function {func.__name__} took too long to respond")
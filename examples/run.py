@@ -1,10 +1,9 @@
-from qdrant_client import QdrantClient
-
 from app.database import get_data
 from app.runner import rag_runner
 from app.schemas import GenerateRequest
+from app.store.qdrant import get_client
 
-client = QdrantClient("localhost", port=6333)
+client = get_client({"host": "localhost", "port": 6333})
 
 if __name__ == "__main__":
     response, event_id = rag_runner(GenerateRequest(user_query="Download and print"))
@@ -0,0 +1,76 @@
+"""Compares the recall@k and latency of the IVF-PQ index against exact search.
+
+`python scripts/benchmark_ann.py --n 200000 --dim 384 --nprobe 1,4,16,64 --refine 1,4`
+`python scripts/benchmark_ann.py --local_path data/vectors --collection articles_short_100`
+
+Without a collection, the vectors are random, drawn around clusters, as embeddings are. Queries are
+vectors of the same distribution, not in the index.
+"""
+import statistics
+import time
+
+import click
+import numpy as np
+
+from app.store.ivfpq import IVFPQIndex, top_k
+from app.store.local import LocalIndex
+
+
+def clustered(n: int, dim: int, clusters: int, rng: np.random.Generator) -> np.ndarray:
+    centres = rng.normal(size=(clusters, dim))
+    vectors = centres[rng.integers(clusters, size=n)] + 0.5 * rng.normal(size=(n, dim))
+    return (vectors / np.linalg.norm(vectors, axis=1, keepdims=True)).astype(np.float32)
+
+
+def timed(search, queries):
+    """The results of each query, and the latency of each, in ms."""
+    results, latencies = [], []
+    for query in queries:
+        t0 = time.perf_counter()
+        results.append(search(query))
+        latencies.append((time.perf_counter() - t0) * 1e3)
+    return results, sorted(latencies)
+
+
+def summary(latencies):
+    return f"mean={statistics.mean(latencies):7.2f}ms p95={latencies[int(len(latencies) * 0.95)]:7.2f}ms"
+
+
+@click.command()
+@click.option('--local_path', default=None, help='Directory of a local index, to benchmark one of its collections')
+@click.option('--collection', default=None, help='Collection of the local index')
+@click.option('--n', default=100_000, help='Random vectors, without a collection')
+@click.option('--dim', default=384, help='Dimension of the random vectors')
+@click.option('--queries', 'n_queries', default=200, help='Queries to time')
+@click.option('--k', default=10, help='Results per query')
+@click.option('--nlist', default=None, type=int, help='Lists of the index. Defaults to about 4 * sqrt(n)')
+@click.option('--m', default=None, type=int, help='Subspaces of the index. Defaults to dim / 4')
+@click.option('--nprobe', default='1,4,16,64', help='Comma separated nprobe values to compare')
+@click.option('--refine', default='1,4', help='Comma separated refine values to compare')
+def benchmark(local_path, collection, n, dim, n_queries, k, nlist, m, nprobe, refine):
+    rng = np.random.default_rng(0)
+    if collection is not None:
+        vectors = LocalIndex(local_path).collection(collection).vectors()
+        queries = np.asarray(vectors[rng.choice(len(vectors), n_queries, replace=False)]) + 0.01
+    else:
+        vectors = clustered(n, dim, clusters=max(1, n // 1000), rng=rng)
+        queries = clustered(n_queries, dim, clusters=max(1, n // 1000), rng=np.random.default_rng(1))
+    print(f"{len(vectors)} vectors of {vectors.shape[1]} dimensions, {len(queries)} queries, k={k}")
+
+    exact, latencies = timed(lambda q: top_k(-(vectors @ q), k), queries)
+    print(f"\nexact:                      recall@{k}=1.000  {summary(latencies)}")
+
+    t0 = time.perf_counter()
+    index = IVFPQIndex.build(vectors, nlist=nlist, m=m)
+    print(f"IVF-PQ nlist={index.nlist} m={index.m}: built in {time.perf_counter() - t0:.1f}s, "
+          f"{index.codes.nbytes / 2**20:.1f}MiB of codes vs {vectors.nbytes / 2**20:.1f}MiB of vectors\n")
+
+    for r in (int(r) for r in refine.split(',')):
+        for p in (int(p) for p in nprobe.split(',')):
+            results, latencies = timed(lambda q: index.search(q, k, nprobe=p, refine=r, vectors=vectors)[0], queries)
+            recall = statistics.mean(len(set(a.tolist()) & set(b.tolist())) / k for a, b in zip(exact, results))
+            print(f"nprobe={p:<4} refine={r:<3}          recall@{k}={recall:.3f}  {summary(latencies)}")
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -0,0 +1,82 @@
+"""Compares the latency and output drift of the GPT-2 inference backends.
+
+`python scripts/benchmark_backends.py --backends eager,int8,onnx --repeats 3`
+
+Drift is measured against the first backend listed: the share of responses that are identical,
+and the share of generated tokens that agree before the first divergence.
+"""
+import statistics
+import time
+
+import click
+
+from app.config import get_config
+from app.generate.generate import PROMPT_TEMPLATE, get_gpt2model, get_gpt2tokeniser, gpt2_infer
+from app.registry import MODELS
+
+QUERIES = [
+    "How do I set up a bank feed?",
+    "Why is my invoice showing as overdue?",
+    "How can I reconcile a transaction that was imported twice?",
+    "Where do I change the tax rate on a bill?",
+    "How do I add a new user to my organisation?",
+]
+CONTEXT = "To setup a bank feed, go to Accounting > Bank accounts, and select Add bank account.\n"
+
+
+def agreement(reference: list[int], tokens: list[int]) -> float:
+    """The share of reference tokens matched before the first divergence."""
+    if not reference:
+        return 1.0
+    n = 0
+    for a, b in zip(reference, tokens):
+        if a != b:
+            break
+        n += 1
+    return n / len(reference)
+
+
+@click.command()
+@click.option('--backends', default='eager,int8,onnx', help='Comma separated backends to compare')
+@click.option('--repeats', default=3, help='Runs of each prompt, per backend')
+@click.option('--max_length', default=None, type=int, help='Overrides model_config.max_length')
+def benchmark(backends, repeats, max_length):
+    model_config = {**get_config("gpt2-generation")["model_config"]}
+    if max_length is not None:
+        model_config['max_length'] = max_length
+    prompts = [PROMPT_TEMPLATE.format(user_query=q, context=CONTEXT) + "<|endoftext|>" for q in QUERIES]
+    tokeniser = get_gpt2tokeniser(model_config)
+
+    reference = None
+    for backend in backends.split(','):
+        config = {**model_config, 'backend': backend}
+        t0 = time.perf_counter()
+        model, device = get_gpt2model(config)
+        load_seconds = time.perf_counter() - t0
+
+        gpt2_infer(model, tokeniser, prompts[0], device, config)  # warm up
+        latencies, outputs, token_counts = [], [], []
+        for prompt in prompts:
+            for _ in range(repeats):
+                t0 = time.perf_counter()
+                text, token_count = gpt2_infer(model, tokeniser, prompt, device, config)
+                latencies.append(time.perf_counter() - t0)
+            outputs.append(tokeniser.encode(text))
+            token_counts.append(token_count - len(tokeniser.encode(prompt)))
+
+        latencies.sort()
+        print(f"\n{backend}: loaded in {load_seconds:.1f}s")
+        print(f"  latency mean={statistics.mean(latencies):.3f}s "
+              f"p50={latencies[len(latencies) // 2]:.3f}s p95={latencies[int(len(latencies) * 0.95)]:.3f}s")
+        print(f"  tokens/sec={sum(token_counts) * repeats / sum(latencies):.1f}")
+        MODELS.evict("gpt2_model")  # One backend in memory at a time
+        if reference is None:
+            reference = outputs
+            continue
+        exact = sum(a == b for a, b in zip(reference, outputs)) / len(outputs)
+        agreed = statistics.mean(agreement(a, b) for a, b in zip(reference, outputs))
+        print(f"  drift: identical responses={exact:.0%}, token agreement={agreed:.0%}")
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -2,12 +2,10 @@ import json
 from pathlib import Path
 from typing import List, Dict, Optional, Any
 from app import ROOT_DIR
+from app.config import get_config
 
-from sentence_transformers import SentenceTransformer
-
-from qdrant_client import QdrantClient
-from qdrant_client.http import models
-from qdrant_client.http.models import PointStruct
+from app.store.ingest import IngestCheckpoint, ingest, read_documents
+from app.store.qdrant import ensure_payload_indexes, get_client, get_encoder
 
 import json
 import yaml
@@ -109,37 +107,15 @@ def add_missing_fields(payload):
         payload['title'] = f"Title: {payload['doc_id']}"
     
 
-def create_collection(client, data, collection_name):
+def create_collection(client, data, collection_name, **ingest_kwargs):
     """
-    data: List of dict with keys 'id' (int), 'vector' (List[float]), 'payload' (dict)
+    data: Iterable of dict with at least key = 'text' (str). Read lazily, in batches.
     """
-    encoder = SentenceTransformer("all-MiniLM-L6-v2")
-    size = encoder.get_sentence_embedding_dimension()
-
-    print(f"\nembedding size = {size=}\n")
-    client.recreate_collection(
-        collection_name=collection_name,
-        vectors_config=models.VectorParams(
-            size=size,  # Vector size is defined by used model
-            distance=models.Distance.DOT,
-        ),
-    )
-
-    points = []
-    for idx, item in enumerate(data):
-        vector = encoder.encode(item["text"]).tolist()
-        # vector = [0.1,.43,.5,.6]
-        payload = {k:v for k,v in item.items()} # if k != "text"}
-        points.append(PointStruct(id=idx, vector=vector, payload=payload))
-
-    client.upload_points(
-        collection_name=collection_name,
-        points=points,
-    )
+    encoder = get_encoder({"encoder": "all-MiniLM-L6-v2"})
+    return ingest(client, data, collection_name, encoder, **ingest_kwargs)
 
 import click
 import json
-from qdrant_client import QdrantClient
 
 
 @click.group()
@@ -149,34 +125,50 @@ def cli():
 @cli.command()
 @click.argument('filename')
 @click.option('--collection_name', default=None, help='Name of the collection')
-def fill_collection(filename, collection_name):
-    """Given a json file and a collection name, create a QDRANT client and fill it with the data.
+@click.option('--batch_size', default=64, help='Texts per call to the encoder')
+@click.option('--upload_batch_size', default=256, help='Points per upload')
+@click.option('--parallel', default=2, help='Uploads in flight at a time')
+@click.option('--encode_processes', default=0, help='Encoder processes. 0 to encode in this process')
+@click.option('--checkpoint', default=None, help='Checkpoint file. Defaults to <filename>.checkpoint')
+def fill_collection(filename, collection_name, batch_size, upload_batch_size, parallel, encode_processes, checkpoint):
+    """Given a json or jsonl file and a collection name, create a QDRANT client and fill it with the data.
     If the collection name is not given, a name will be created from the filename.
+    The file is streamed, so it can be larger than memory. If the ingestion fails, running the same
+    command again resumes it from the checkpoint.
+    `python scripts/fillvs.py fill-collection articles.jsonl --parallel 4 --encode_processes 4`
     """
     print("Initializing QDRANT client and populating collection...")
     # Pytest mark qdrant would be used here to indicate that the service was started
-    client = QdrantClient("localhost", port=6333)
+    config = get_config("qdrant-retrieval")
+    client = get_client(config)
 
-    
     filename = Path(filename)
-    collection_name = None
     if collection_name is None:
         collection_name = filename.stem # Creating collection name from the filename
+    if checkpoint is None:
+        checkpoint = filename.with_name(filename.name + '.checkpoint')
+
+    stats = create_collection(
+        client,
+        read_documents(filename),
+        collection_name,
+        batch_size=batch_size,
+        upload_batch_size=upload_batch_size,
+        parallel=parallel,
+        encode_processes=encode_processes,
+        checkpoint=IngestCheckpoint(checkpoint, str(filename.resolve()), collection_name),
+    )
 
-    with open(filename, "r") as file:
-        data = json.load(file)
-
-    create_collection(client, data, collection_name)
-
-    # client.delete_collection(collection_name)
-    print("Created collection '{collection_name}' with {n} records.".format(n=len(data), collection_name=collection_name))
+    ensure_payload_indexes(client, collection_name, config.get("payload_indexes", {}))
+    n = stats['documents'] + stats['skipped']
+    print(f"Created collection '{collection_name}' with {n} records, {stats['docs_per_second']:.1f} docs/sec.")
 
 
 @cli.command()
 @click.argument('collection_name')
 def delete_collection(collection_name):
     """Delete a collection by name"""
-    client = QdrantClient("localhost", port=6333)
+    client = get_client(get_config("qdrant-retrieval"))
     client.delete_collection(collection_name)
     print("Deleted collection: {}".format(collection_name))
     
@@ -189,9 +181,9 @@ def query(query_text, collection_name, limit):
     """Query a collection by text
     `python scripts/fillvs.py query "bank feeds" "articles_short" --limit 2`
     """
-    encoder = SentenceTransformer("all-MiniLM-L6-v2")
+    encoder = get_encoder({"encoder": "all-MiniLM-L6-v2"})
     
-    client = QdrantClient("localhost", port=6333)
+    client = get_client(get_config("qdrant-retrieval"))
     query_vector = encoder.encode(query_text).tolist()
     result = client.search(collection_name=collection_name, 
                            query_vector=query_vector, 
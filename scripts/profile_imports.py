@@ -0,0 +1,47 @@
+"""Profiles the time it takes to import a module, with `python -X importtime`.
+
+`python scripts/profile_imports.py --module app.main --top 15`
+
+Prints the total import time, and the slowest imports by cumulative time, including their own imports.
+Heavy libraries such as torch, transformers and sentence_transformers should not appear for `app.main`,
+they are imported when the models are loaded.
+"""
+import subprocess
+import sys
+
+import click
+
+
+def importtime(module: str) -> list[tuple[int, int, str]]:
+    """`(self us, cumulative us, module)` of each import, in a fresh interpreter."""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"], capture_output=True, text=True, check=True
+    )
+    imports = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        own, cumulative, name = line.removeprefix("import time:").split("|")
+        imports.append((int(own), int(cumulative), name.rstrip()))
+    return imports
+
+
+@click.command()
+@click.option('--module', default='app.main', help='The module to import')
+@click.option('--top', default=15, help='Number of the slowest imports to show')
+def profile(module, top):
+    imports = importtime(module)
+    total = next(cumulative for _, cumulative, name in imports if name.strip() == module)
+    print(f"import {module}: {total / 1e6:.2f}s, {len(imports)} modules")
+    for heavy in ('torch', 'transformers', 'sentence_transformers'):
+        print(f"  {heavy}: {'imported' if any(name.strip() == heavy for *_, name in imports) else 'not imported'}")
+
+    # Top level packages only, so a package isn't counted once per submodule
+    packages = [i for i in imports if '.' not in i[2].strip()]
+    print(f"\nSlowest {top} top level imports (cumulative):")
+    for _, cumulative, name in sorted(packages, key=lambda i: i[1], reverse=True)[:top]:
+        print(f"  {cumulative / 1e3:9.1f}ms  {name.strip()}")
+
+
+if __name__ == '__main__':
+    profile()
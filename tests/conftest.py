@@ -2,8 +2,18 @@ from unittest import mock
 
 import pytest
 
+from app.tracing import SpanExporter, set_exporter
+
 
 @pytest.fixture(autouse=True)
 def mock_write_log_to_db():
     with mock.patch("app.logconfig.write_data") as mock_write_log_to_db:
         yield mock_write_log_to_db
+
+
+@pytest.fixture(autouse=True)
+def reset_span_exporter():
+    """Spans are discarded, and an exporter set by a test, e.g. by the API's lifespan, is unset after it."""
+    previous = set_exporter(SpanExporter())
+    yield
+    set_exporter(previous)
@@ -98,3 +98,41 @@ class TestSimpleConsolidator:
 
         # Assert that the contexts are sorted by score in descending order
         assert result == [contexts[1], contexts[0]]
+
+    def test_process_fetches_only_kept_texts(self):
+        """With lazy text, only the text of the contexts that fit is fetched, in one call."""
+        contexts = [Context(doc_id='id1', text='', point_id=1, text_length=5, score=0.9),
+                    Context(doc_id='id2', text='', point_id=2, text_length=5, score=0.8),
+                    Context(doc_id='id3', text='', point_id=3, text_length=7, score=0.7)]
+        texts = {1: 'hello', 2: 'world', 3: 'goodbye'}
+        calls = []
+
+        def fetch_texts(contexts):
+            calls.append([c.point_id for c in contexts])
+            for c in contexts:
+                c.text = texts[c.point_id]
+
+        consolidator = SimpleConsolidator({'strategy': 'simple', 'token_limit': 13})
+
+        response = consolidator(contexts, {'fetch_texts': fetch_texts}, [], RAGStage.CONSOLIDATE)
+
+        assert calls == [[1, 2]]
+        assert [c.text for c in response[0]] == ['hello\n', 'world\n']
+
+    def test_process_error_fetches_texts(self):
+        """When consolidation fails with lazy text, the contexts are passed on with their text."""
+        contexts = [Context(doc_id='id1', text='', point_id=1, text_length=50),
+                    Context(doc_id='id2', text='', point_id=2, text_length=70)]
+        texts = {1: 'a' * 50, 2: 'b' * 70}
+
+        def fetch_texts(contexts):
+            for c in contexts:
+                if not c.text:
+                    c.text = texts[c.point_id]
+
+        consolidator = SimpleConsolidator({'strategy': 'simple', 'token_limit': 10})
+
+        response = consolidator(contexts, {'fetch_texts': fetch_texts}, [], RAGStage.CONSOLIDATE)
+
+        assert isinstance(response[2][0][1], AllDocumentsExceedContextWindowError)
+        assert [c.text for c in response[0]] == ['a' * 50, 'b' * 70]
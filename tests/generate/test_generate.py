@@ -1,10 +1,22 @@
+import asyncio
+import concurrent.futures
 import time
 
+import numpy as np
 import pytest
 import stubs
 
-from app.generate.generate import GPT2Generator, LLMTimeoutError
+from app.generate.generate import (
+    GenerationDeadline,
+    GPT2Generator,
+    LLMTimeoutError,
+    StopSequences,
+    _batch_tokeniser,
+    cut_at_stop_sequence,
+    generation_speed,
+)
 from app.pipe import RAGStage
+from app.registry import MODELS, config_key
 from app.retrieve.retrieve import Context, ContextWithMetadata
 from app.schemas import GenerateRequest
 
@@ -36,6 +48,82 @@ def mock_llm_no_response(monkeypatch):
 
     monkeypatch.setattr('app.generate.generate.gpt2_infer', mock_response)
 
+@pytest.fixture
+def mock_llm_stream(monkeypatch):
+    """Mock the query function, sending tokens to the streamer."""
+    def mock_response(*args, **kwargs):
+        streamer = args[5]
+        for token in ['The', ' answer', ' is', ' 42.']:
+            time.sleep(0.01)
+            streamer.on_finalized_text(token)
+        streamer.on_finalized_text('', stream_end=True)
+        return "The answer is 42.", 12
+
+    monkeypatch.setattr('app.generate.generate.gpt2_infer', mock_response)
+
+@pytest.fixture
+def mock_llm_until_deadline(monkeypatch):
+    """Mock the query function, generating a token every 10ms until the deadline stops it."""
+    def mock_response(*args, **kwargs):
+        deadline, tokens = args[7], []
+        while not deadline(None, None):
+            time.sleep(0.01)
+            tokens.append('token')
+        return ' '.join(tokens), len(tokens)
+
+    monkeypatch.setattr('app.generate.generate.gpt2_infer', mock_response)
+
+
+class CharTokeniser:
+    """One token per character."""
+    eos_token_id = 0
+
+    def encode(self, text):
+        return [ord(c) for c in text]
+
+    def decode(self, ids):
+        return ''.join(chr(i) for i in ids if i)
+
+
+def test_generation_deadline():
+    deadline = GenerationDeadline(0.05)
+    assert not deadline(None, None) and not deadline.reached
+
+    time.sleep(0.06)
+    assert deadline(None, None) and deadline.reached
+
+    deadline = GenerationDeadline(10)
+    deadline.cancel()
+    assert deadline(None, None)
+
+
+def test_stop_sequences():
+    """Generation stops once every sequence in the batch has generated a stop sequence or the eos token."""
+    tokeniser = CharTokeniser()
+    prompt = [tokeniser.encode('Q:'), tokeniser.encode('Q:')]
+    criteria = StopSequences(tokeniser, ['\nQ:'], prompt_length=2)
+
+    def step(first, second):
+        return np.array([prompt[0] + first, prompt[1] + second])
+
+    assert not criteria(step(tokeniser.encode('A\nQ'), tokeniser.encode('AB\n')), None)
+    assert not criteria(step(tokeniser.encode('A\nQ:'), tokeniser.encode('AB\nQ')), None)
+    # The first sequence stays stopped, once it has moved past the stop sequence
+    assert criteria(step(tokeniser.encode('A\nQ:B'), tokeniser.encode('AB\nQ') + [0]), None)
+
+    assert cut_at_stop_sequence('A\nQ:B\nC:', ['\nC:', '\nQ:']) == 'A'
+    assert cut_at_stop_sequence('A', ['\nQ:']) == 'A'
+
+
+def test_generation_speed():
+    """Each verification step of speculative decoding adds one token of the model's own."""
+    stats = {'prompt_tokens': 20, 'new_tokens': 30, 'seconds': 2.0, 'steps': 10, 'draft_tokens': 40}
+
+    assert generation_speed(stats) == {'tokens_per_second': 15.0, 'acceptance_rate': 0.5}
+    assert generation_speed({'new_tokens': 30, 'seconds': 2.0}) == {'tokens_per_second': 15.0}
+    assert generation_speed({}) == {}
+
+
 class TestGPT2Generator:
 
     @classmethod
@@ -148,6 +236,241 @@ class TestGPT2Generator:
         assert response['token_count'] == 10
         assert 0 < len(response['text']) < 100
 
+    @pytest.mark.transformers
+    def test_stream_response(self, mock_llm_stream, mock_write_log_to_db, monkeypatch):
+        """Tokens are yielded as they're generated, and the response metrics are captured when the stream ends."""
+
+        contexts = [Context(doc_id='id1', text='42')]
+
+        async def _stream(generator):
+            request = GenerateRequest(user_query="What is the meaning of life?")
+            return [chunk async for chunk in generator.astream_response(request, contexts, event_id='1234')]
+
+        assert asyncio.run(_stream(self.generator)) == ['The', ' answer', ' is', ' 42.']
+        metrics = [call.kwargs['log']['metric'] for call in mock_write_log_to_db.call_args_list]
+        assert 'response_text' in metrics and 'response_token_count' in metrics
+
+        cfg = stubs.gpt2_generation_config()
+        cfg['timeout'] = 0.02
+        monkeypatch.setattr(self.generator, 'config', cfg)
+
+        with pytest.raises(LLMTimeoutError):
+            asyncio.run(_stream(self.generator))
+
+    @pytest.mark.transformers
+    def test_stream_response_stop_sequence(self, mock_llm_stream, monkeypatch):
+        """Streamed text stops before a stop sequence, even if it is split across chunks."""
+
+        cfg = stubs.gpt2_generation_config()
+        cfg['model_config']['stop_sequences'] = [' is 4']
+        monkeypatch.setattr(self.generator, 'config', cfg)
+
+        async def _stream(generator):
+            request = GenerateRequest(user_query="What is the meaning of life?")
+            contexts = [Context(doc_id='id1', text='42')]
+            return [chunk async for chunk in generator.astream_response(request, contexts, event_id='1234')]
+
+        assert ''.join(asyncio.run(_stream(self.generator))) == 'The answer'
+
+    @pytest.mark.transformers
+    def test_generate_partial_response(self, mock_llm_until_deadline, mock_write_log_to_db, monkeypatch):
+        """At the deadline, the text generated so far is returned instead of a timeout."""
+
+        cfg = stubs.gpt2_generation_config()
+        cfg['timeout'] = 0.3
+        cfg['deadline_margin'] = 0.2
+        monkeypatch.setattr(self.generator, 'config', cfg)
+
+        contexts = [Context(doc_id='id1', text='42')]
+        t0 = time.monotonic()
+        response = self.generator.synthesize_response(GenerateRequest(user_query="Hi"), contexts, event_id='1234')
+
+        assert time.monotonic() - t0 < 0.3
+        assert response.startswith('token')
+        metrics = [call.kwargs['log']['metric'] for call in mock_write_log_to_db.call_args_list]
+        assert 'response_truncated' in metrics
+
+    @pytest.mark.transformers
+    def test_response_cache(self, mock_llm_response, mock_write_log_to_db, monkeypatch):
+        """A repeated prompt is answered from the cache, without querying the LLM."""
+        calls = []
+
+        def run_until_timeout(func, *args, **kwargs):
+            calls.append(func)
+            return func(*args[2:])
+
+        monkeypatch.setattr('app.generate.generate.run_until_timeout', run_until_timeout)
+        config = stubs.gpt2_generation_config()
+        config['response_cache'] = {'enabled': True, 'max_entries': 8}
+        generator = GPT2Generator(config)
+        generator.response_cache.clear()
+
+        contexts = [Context(doc_id='id1', text='42')]
+        first = generator.synthesize_response(GenerateRequest(user_query="Hi"), contexts, event_id='1')
+        second = generator.synthesize_response(GenerateRequest(user_query="Hi"), contexts, event_id='2')
+        generator.synthesize_response(GenerateRequest(user_query="Hello"), contexts, event_id='3')
+
+        assert first == second == "The answer is 42."
+        assert len(calls) == 2
+        hits = [call.kwargs['event_id'] for call in mock_write_log_to_db.call_args_list
+                if call.kwargs['log']['metric'] == 'response_cache_hit']
+        assert hits == ['2']
+
+    @pytest.mark.transformers
+    def test_generate_batched(self, monkeypatch):
+        """Concurrent requests are generated together in one batch, and each gets its own response."""
+        batch_sizes = []
+
+        def mock_response(model, tokeniser, input_texts, *args, **kwargs):
+            batch_sizes.append(len(input_texts))
+            return [(f"Answer {i}", 12) for i in range(len(input_texts))]
+
+        monkeypatch.setattr('app.generate.generate.gpt2_infer_batch', mock_response)
+        config = stubs.gpt2_generation_config()
+        config['batching'] = {'enabled': True, 'max_batch_size': 4, 'max_wait_ms': 100}
+        generator = GPT2Generator(config)
+
+        contexts = [Context(doc_id='id1', text='42')]
+        with concurrent.futures.ThreadPoolExecutor(4) as pool:
+            responses = list(pool.map(
+                lambda i: generator.synthesize_response(GenerateRequest(user_query=f"Query {i}"), contexts, ''),
+                range(4),
+            ))
+
+        assert batch_sizes == [4]
+        assert sorted(responses) == ['Answer 0', 'Answer 1', 'Answer 2', 'Answer 3']
+
+    @pytest.mark.transformers
+    def test_model_reload(self, monkeypatch):
+        """A model reloaded in the registry is used by a live generator, and the old one is let go."""
+        used = []
+
+        def mock_response(model, *args, **kwargs):
+            used.append(model)
+            return "The answer is 42.", 12
+
+        monkeypatch.setattr('app.generate.generate.gpt2_infer', mock_response)
+        generator = GPT2Generator(stubs.gpt2_generation_config())
+        generator.query_llm('Hi')
+
+        key = config_key(generator.config['model_config'], 'model', 'device', 'backend', 'onnx_export')
+        reloaded, _ = MODELS.reload('gpt2_model', key)
+        generator.query_llm('Hi')
+
+        assert used[0] is not reloaded and used[1] is reloaded
+        assert generator.model is reloaded
+
+    @pytest.mark.transformers
+    def test_generate_batch_of_one(self, mock_write_log_to_db, monkeypatch):
+        """A request batched alone is generated as a single request, and logs its generation speed."""
+
+        def mock_response(*args, **kwargs):
+            kwargs['stats'].update(prompt_tokens=4, new_tokens=8, seconds=0.5)
+            return "The answer is 42.", 12
+
+        monkeypatch.setattr('app.generate.generate.gpt2_infer', mock_response)
+        monkeypatch.setattr('app.generate.generate.gpt2_infer_batch', None)
+        config = stubs.gpt2_generation_config()
+        config['batching'] = {'enabled': True, 'max_batch_size': 4, 'max_wait_ms': 5}
+        generator = GPT2Generator(config)
+
+        contexts = [Context(doc_id='id1', text='42')]
+        response = generator.synthesize_response(GenerateRequest(user_query="Hi"), contexts, event_id='1234')
+
+        assert response == "The answer is 42."
+        speeds = [call.kwargs['log']['value'] for call in mock_write_log_to_db.call_args_list
+                  if call.kwargs['log']['metric'] == 'response_tokens_per_second']
+        assert speeds == [16.0]
+
+    @pytest.mark.transformers
+    def test_generate_batched_partial_response(self, mock_write_log_to_db, monkeypatch):
+        """A batch cut short by the deadline is reported as truncated, and isn't cached."""
+
+        def mock_response(model, tokeniser, input_texts, device, config, prefix, deadline):
+            tokens = []
+            while not deadline(None, None):
+                time.sleep(0.01)
+                tokens.append('token')
+            return [(' '.join(tokens), len(tokens)) for _ in input_texts]
+
+        monkeypatch.setattr('app.generate.generate.gpt2_infer_batch', mock_response)
+        config = stubs.gpt2_generation_config()
+        config['timeout'] = 0.3
+        config['deadline_margin'] = 0.2
+        config['batching'] = {'enabled': True, 'max_batch_size': 2, 'max_wait_ms': 50}
+        config['response_cache'] = {'enabled': True, 'max_entries': 8}
+        generator = GPT2Generator(config)
+        generator.response_cache.clear()
+
+        contexts = [Context(doc_id='id1', text='42')]
+        with concurrent.futures.ThreadPoolExecutor(2) as pool:
+            responses = list(pool.map(
+                lambda i: generator.synthesize_response(GenerateRequest(user_query=f"Query {i}"), contexts, str(i)),
+                range(2),
+            ))
+
+        assert all(response.startswith('token') for response in responses)
+        truncated = [call.kwargs['event_id'] for call in mock_write_log_to_db.call_args_list
+                     if call.kwargs['log']['metric'] == 'response_truncated']
+        assert sorted(truncated) == ['0', '1']
+        assert len(generator.response_cache) == 0
+
+    @pytest.mark.transformers
+    def test_prefix_cache(self):
+        """Generation from the cached prompt prefix matches generation from scratch. The cache follows the config."""
+
+        config = stubs.gpt2_generation_config()
+        generator = GPT2Generator(config)
+        cached_generator = GPT2Generator({**config, 'prefix_cache': True})
+        prompt = cached_generator._format_prompt("What is the meaning of life?", [Context(doc_id='id1', text='42')])
+
+        assert cached_generator.query_llm(prompt) == generator.query_llm(prompt)
+
+        prefix_ids, _ = cached_generator.prefix_cache.get(cached_generator._static_prefix(), config['model_config'])
+        assert cached_generator.tokenizer.decode(prefix_ids[0]) == "Given a user query, and context documents, generate a response.\nUSER_QUERY:\n"
+
+        model_config = {**config['model_config'], 'max_length': 50}
+        assert cached_generator.prefix_cache.get(cached_generator._static_prefix(), model_config)[0] is not prefix_ids
+
+    @pytest.mark.transformers
+    def test_int8_backend(self):
+        """The quantized backend keeps the `gpt2_infer` contract."""
+
+        config = stubs.gpt2_generation_config()
+        config['model_config']['backend'] = 'int8'
+        config['model_config']['max_length'] = 10
+        generator = GPT2Generator(config)
+
+        response = generator.query_llm("What is the meaning of life?")
+
+        assert response['token_count'] == 10
+        assert 0 < len(response['text']) < 100
+
+    @pytest.mark.transformers
+    def test_speculative_decoding(self):
+        """Draft tokens verified by the model give the same output as the model alone."""
+
+        config = stubs.gpt2_generation_config()
+        config['model_config']['max_new_tokens'] = 20
+        generator = GPT2Generator(config)
+        config = stubs.gpt2_generation_config()
+        config['model_config'].update(max_new_tokens=20, draft_model='distilgpt2')
+        speculative_generator = GPT2Generator(config)
+        prompt = generator._format_prompt("How do I set up a bank feed?", [Context(doc_id='id1', text='42')])
+
+        response = speculative_generator.query_llm(prompt)
+
+        assert response['text'] == generator.query_llm(prompt)['text']
+        assert 0 <= response['acceptance_rate'] <= 1
+        assert response['tokens_per_second'] > 0
+
+    def test_unknown_backend(self):
+        config = stubs.gpt2_generation_config()
+        config['model_config']['backend'] = 'tpu'
+
+        with pytest.raises(ValueError, match='Unknown backend'):
+            GPT2Generator(config)
+
     def test__fallback_response(self):
 
         titles = ['Friends.', 'La Famila.', 'Numbers.']
@@ -164,3 +487,18 @@ class TestGPT2Generator:
 
         assert response['text'] == 'Xbot is down. Here are some references that may help you:0. Friends.: www.friends.com\n1. La Famila.: www.family.com\n2. Numbers.: www.numbers.com'
         assert response_documents['text'] == "Xbot is down. Here are some document excerpts that may help you:[title: 'Friends.', url: 'www.friends.com']\nfriends\n[title: 'La Famila.', url: 'www.family.com']\nfamily\n[title: 'Numbers.', url: 'www.numbers.com']\n42\n"
+
+
+def test_batch_tokeniser_is_a_copy():
+    """Batches are padded on the left by a copy of the tokeniser. The shared one is left as it is."""
+    class Tokeniser:
+        padding_side = 'right'
+        pad_token = None
+        eos_token = '<|endoftext|>'
+
+    tokeniser = Tokeniser()
+    batch_tokeniser = _batch_tokeniser(tokeniser)
+
+    assert (batch_tokeniser.padding_side, batch_tokeniser.pad_token) == ('left', '<|endoftext|>')
+    assert (tokeniser.padding_side, tokeniser.pad_token) == ('right', None)
+    assert _batch_tokeniser(tokeniser) is batch_tokeniser
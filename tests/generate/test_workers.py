@@ -0,0 +1,118 @@
+import os
+import time
+import types
+
+import pytest
+import stubs
+
+from app.generate.generate import GPT2Generator, LLMTimeoutError
+from app.generate.workers import (
+    WORKER_RESTARTS,
+    GenerationWorkerPool,
+    WorkerCrashedError,
+    WorkerDeadlineError,
+    _load_gpt2,
+)
+from app.retrieve.retrieve import Context
+from app.schemas import GenerateRequest
+
+
+def load(model_config):
+    return os.getpid()
+
+
+def infer(pid, prompt, model_config):
+    """Echoes the prompt. Crashes the worker on 'crash', hangs on 'hang', and takes half a second on 'slow'."""
+    if prompt == 'crash':
+        os._exit(1)
+    if prompt == 'hang':
+        time.sleep(60)
+    if prompt == 'slow':
+        time.sleep(0.5)
+    if prompt == 'error':
+        raise ValueError('Bad prompt')
+    if prompt == 'models':
+        from app.registry import MODELS
+        return {'text': sorted(kind for kind, _ in MODELS._entries), 'token_count': 0}
+    return {'text': prompt.upper(), 'token_count': len(prompt), 'pid': pid}
+
+
+@pytest.fixture(scope='module')
+def pool():
+    with GenerationWorkerPool({}, processes=2, grace_seconds=0.1, load=load, infer=infer) as pool:
+        yield pool
+
+
+def test_workers_generate_out_of_process(pool):
+    """Prompts run in the worker processes, which keep their loaded model between prompts."""
+    assert pool.wait_until_ready(timeout=30)
+    futures = [pool.submit(f'prompt {i}', timeout=30) for i in range(8)]
+    responses = [f.result(timeout=30) for f in futures]
+
+    assert [r['text'] for r in responses] == [f'PROMPT {i}' for i in range(8)]
+    assert all(r['pid'] != os.getpid() for r in responses)
+    assert len({r['pid'] for r in responses}) <= 2
+    # Workers load their model only, not the clients of the vector store
+    assert pool.submit('models', timeout=30).result(timeout=30)['text'] == []
+
+
+def test_workers_errors_and_restarts(pool):
+    """Errors are returned to the caller. Workers that crash, or overrun their deadline, are replaced."""
+    with pytest.raises(RuntimeError, match='ValueError: Bad prompt'):
+        pool.submit('error', timeout=30).result(timeout=30)
+
+    with pytest.raises(WorkerCrashedError):
+        pool.submit('crash', timeout=30).result(timeout=30)
+
+    with pytest.raises(WorkerDeadlineError):
+        pool.submit('hang', timeout=0.5).result(timeout=30)
+
+    assert pool.submit('still up', timeout=30).result(timeout=30)['text'] == 'STILL UP'
+
+
+def test_workers_expire_queued_prompts(pool):
+    """A prompt whose deadline passes while it waits for a worker fails, without restarting a worker."""
+    restarts = WORKER_RESTARTS.value(reason='deadline')
+    slow = [pool.submit('slow', timeout=30) for _ in range(2)]
+    queued = pool.submit('queued', timeout=0.1)
+
+    with pytest.raises(LLMTimeoutError):
+        queued.result(timeout=30)
+    assert [f.result(timeout=30)['text'] for f in slow] == ['SLOW'] * 2
+    assert WORKER_RESTARTS.value(reason='deadline') == restarts
+
+
+@pytest.mark.transformers
+def test_generator_worker_crash_is_llm_timeout(pool):
+    """A crashed worker is an LLMTimeoutError to the generator, so it applies the no-LLM fallback."""
+    generator = GPT2Generator(stubs.gpt2_generation_config())
+    generator.workers = pool
+    generator._format_prompt = lambda *_: 'crash'
+
+    with pytest.raises(LLMTimeoutError):
+        generator.synthesize_response(GenerateRequest(user_query='Hi'), [Context(doc_id='id1', text='42')], '')
+
+
+def test_generator_with_workers_loads_no_model(monkeypatch):
+    """With workers, the generator leaves the model to them, until it streams a response. Its warm-up waits for them."""
+    waited = []
+    workers = types.SimpleNamespace(wait_until_ready=lambda: waited.append(True))
+    monkeypatch.setattr('app.generate.generate.GenerationWorkerPool', lambda *args, **kwargs: workers)
+    monkeypatch.setattr('app.generate.generate.get_gpt2model', lambda *_: pytest.fail('Loaded the model in process'))
+    generator = GPT2Generator({**stubs.gpt2_generation_config(), 'workers': {'enabled': True, 'processes': 3}})
+
+    generator.warmup()
+
+    assert generator.model is None
+    assert waited == [True]
+
+
+@pytest.mark.transformers
+def test_load_gpt2_warms_up(monkeypatch):
+    """The default loader generates a few tokens, before the worker reports it is ready."""
+    calls = []
+    monkeypatch.setattr('app.generate.generate.gpt2_infer', lambda *args, **kwargs: calls.append(args[4]) or ('', 0))
+
+    _load_gpt2(stubs.gpt2_generation_config()['model_config'])
+
+    assert [config['max_new_tokens'] for config in calls] == [4]
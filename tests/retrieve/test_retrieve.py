@@ -1,15 +1,25 @@
 import json
 import time
 
+import numpy as np
 import pytest
-from qdrant_client import QdrantClient
+from qdrant_client.http import models
 from stubs import create_collection, qdrant_retriever_config
 
 from app import ROOT_DIR
 from app.pipe import RAGStage
+from app.registry import MODELS, config_key
 from app.retrieve.retrieve import QDRANTRetriever, QueryEmbeddingTimeoutError
 from app.schemas import GenerateRequest
-from app.store.qdrant import QDRANTArgumentsError, search_collection
+from app.store.qdrant import (
+    QDRANTArgumentsError,
+    canonical_filter,
+    compile_filter,
+    embedding_cache_key,
+    get_client,
+    normalize_query,
+    search_collection,
+)
 
 
 @pytest.fixture
@@ -59,7 +69,7 @@ def qdrant_client():
     """Initialize QDRANT client and populate a collection."""
     print("Initializing QDRANT client and populating collection...")
     # Pytest mark qdrant would be used here to indicate that the service was started
-    client = QdrantClient("localhost", port=6333)
+    client = get_client({"host": "localhost", "port": 6333})
 
     test_data_f = ROOT_DIR.parent / "tests" / "test_data.json"
     with open(test_data_f) as file:
@@ -131,6 +141,12 @@ class TestSearch:
             search_collection(client, query_vector, limit, collection_name, search_kwargs, search_filters)
 
 
+def test_normalize_query():
+    assert normalize_query('  How do I\tset up a ＢＡＮＫ feed? ') == 'how do i set up a bank feed?'
+    assert embedding_cache_key('Bank feed', 'all-MiniLM-L6-v2') == embedding_cache_key('bank  feed', 'all-MiniLM-L6-v2')
+    assert embedding_cache_key('Bank feed', 'all-MiniLM-L6-v2') != embedding_cache_key('Bank feed', 'other')
+
+
 class TestQDRANTRetriever:
 
     @classmethod
@@ -189,6 +205,130 @@ class TestQDRANTRetriever:
         assert expected_docs == actual_documents
         assert expected_ids == actual_document_ids
 
+    @pytest.mark.transformers
+    def test_retrieve_embedding_cache(self, mock_retrieve_vectors, monkeypatch):
+        """Queries that are the same once normalized are embedded once. Vectors are cached as float32."""
+        embedded = []
+
+        def mock_embed(encoder, text):
+            embedded.append(text)
+            return [1.0, 2.0, 3.0]
+
+        monkeypatch.setattr('app.retrieve.retrieve.encode_text', mock_embed)
+        config = {**qdrant_retriever_config(), 'embedding_cache': {'enabled': True, 'max_entries': 8}}
+        retriever = QDRANTRetriever(config)
+        retriever.embedding_cache.clear()
+
+        retriever.simple_retrieve(GenerateRequest(user_query='What is the meaning of life?'), event_id='')
+        retriever.simple_retrieve(GenerateRequest(user_query='  what is the MEANING of life? '), event_id='')
+
+        assert embedded == ['What is the meaning of life?']
+        vector = retriever.embedding_cache.get(embedding_cache_key('what is the meaning of life?', config['encoder']))
+        assert vector.dtype == np.float32 and vector.tolist() == [1.0, 2.0, 3.0]
+
+    @pytest.mark.transformers
+    def test_multi_query_retrieve(self, tmp_path, monkeypatch):
+        """Variants are embedded in one call, and searched in one round-trip. Documents found by several are kept once."""
+        vectors = {'pay bills': [1.0, 0.0], 'settle invoices': [0.0, 1.0]}
+        calls = []
+
+        def mock_embed(encoder, texts):
+            calls.append(texts)
+            return [vectors[text] for text in texts]
+
+        monkeypatch.setattr('app.retrieve.retrieve.encode_texts', mock_embed)
+        config = {
+            **qdrant_retriever_config(), 'backend': 'local', 'local_path': str(tmp_path), 'collection_name': 'docs', 'top_k': 2,
+        }
+        client = get_client(config)
+        client.recreate_collection('docs', vectors_config=models.VectorParams(size=2, distance=models.Distance.DOT))
+        client.upsert('docs', points=models.Batch(
+            ids=[0, 1, 2],
+            vectors=[[0.9, 0.0], [0.5, 0.5], [0.0, 0.8]],
+            payloads=[{'doc_id': i, 'text': f'doc {i}'} for i in range(3)],
+        ))
+        retriever = QDRANTRetriever(config)
+
+        contexts = retriever.multi_query_retrieve(GenerateRequest(user_query='pay bills'), ['settle invoices'], event_id='')
+
+        assert calls == [['pay bills', 'settle invoices']]
+        assert [(c.doc_id, c.text) for c in contexts] == [('0', 'doc 0'), ('2', 'doc 2')]
+
+    @pytest.mark.transformers
+    def test_encoder_reload(self):
+        """An encoder reloaded in the registry is used by a live retriever."""
+        retriever = QDRANTRetriever(self.config)
+        encoder = retriever.encoder
+
+        reloaded = MODELS.reload('encoder', config_key(self.config, 'encoder'))
+
+        assert reloaded is not encoder and retriever.encoder is reloaded
+
+    def test_lazy_text(self, tmp_path, monkeypatch):
+        """Searches return the metadata of documents without their text, which is fetched only when asked for."""
+        monkeypatch.setattr('app.retrieve.retrieve.encode_text', lambda encoder, text: [1.0, 0.0])
+        config = {
+            **qdrant_retriever_config(), 'backend': 'local', 'local_path': str(tmp_path), 'collection_name': 'docs',
+            'top_k': 2, 'lazy_text': True,
+        }
+        client = get_client(config)
+        client.recreate_collection('docs', vectors_config=models.VectorParams(size=2, distance=models.Distance.DOT))
+        client.upsert('docs', points=models.Batch(
+            ids=[0, 1],
+            vectors=[[0.9, 0.0], [0.5, 0.5]],
+            payloads=[{'doc_id': i, 'text': f'doc {i}', 'text_length': 5, 'title': f't{i}', 'url': f'u{i}'}
+                      for i in range(2)],
+        ))
+        retriever = QDRANTRetriever(config)
+        data = {'event_id': ''}
+
+        contexts, data, *_ = retriever(GenerateRequest(user_query='q'), data, [], RAGStage.RETRIEVE)
+
+        assert [(c.doc_id, c.text, c.point_id, c.text_length) for c in contexts] == [('0', '', 0, 5), ('1', '', 1, 5)]
+        data['fetch_texts'](contexts[:1])
+        assert [c.text for c in contexts] == ['doc 0', '']
+
+    def test_filters_per_request(self, tmp_path, monkeypatch):
+        """A request's metadata filters its own search only. Payload indexes are only created, as configured, at warm-up."""
+        monkeypatch.setattr('app.retrieve.retrieve.encode_text', lambda encoder, text: [1.0, 0.0])
+        config = {
+            **qdrant_retriever_config(), 'backend': 'local', 'local_path': str(tmp_path), 'collection_name': 'docs',
+            'top_k': 2, 'payload_indexes': {'country': 'keyword'},
+        }
+        client = get_client(config)
+        client.recreate_collection('docs', vectors_config=models.VectorParams(size=2, distance=models.Distance.DOT))
+        client.upsert('docs', points=models.Batch(
+            ids=[0, 1],
+            vectors=[[0.9, 0.0], [0.5, 0.5]],
+            payloads=[{'doc_id': i, 'text': f'doc {i}', 'title': f't{i}', 'country': c} for i, c in enumerate(['AU', 'NZ'])],
+        ))
+        indexed = []
+        monkeypatch.setattr(client.client, 'create_payload_index', lambda *args, **kwargs: indexed.append((args, kwargs)))
+        retriever = QDRANTRetriever(config)
+
+        filtered = retriever.simple_retrieve(GenerateRequest(user_query='q', metadata={'country': 'NZ'}), event_id='')
+        other = retriever.simple_retrieve(GenerateRequest(user_query='q', metadata={'doc_id': 0}), event_id='')
+        unfiltered = retriever.simple_retrieve(GenerateRequest(user_query='q'), event_id='')
+
+        assert [c.doc_id for c in filtered] == ['1']
+        assert [c.doc_id for c in other] == ['0']
+        assert [c.doc_id for c in unfiltered] == ['0', '1']
+        assert 'search_filters' not in retriever.config
+        assert indexed == []
+
+        retriever.warmup()
+
+        assert indexed == [(('docs',), {'field_name': 'country', 'field_schema': models.PayloadSchemaType.KEYWORD})]
+
+    def test_compile_filter(self):
+        """Filters with the same conditions, in any order, compile to the same `Filter`."""
+        a = {'must': [{'key': 'a', 'match': {'value': 1}}, {'key': 'b', 'match': {'value': 2}}]}
+        b = {'must': [{'key': 'b', 'match': {'value': 2}}, {'key': 'a', 'match': {'value': 1}}], 'should': []}
+
+        assert canonical_filter(a) == canonical_filter(b)
+        assert compile_filter(a) is compile_filter(b)
+        assert compile_filter(a).must[0].key == 'a'
+
     @pytest.mark.transformers
     def test_retrieve_timeout(self, mock_embed_slow, mock_retrieve_vectors):
         """When embedding model doesnt respond in time (>0.1 s), raise timeout error.
@@ -0,0 +1,64 @@
+import asyncio
+
+import pytest
+from qdrant_client import AsyncQdrantClient, QdrantClient
+from qdrant_client.http import models
+
+from app.store.client import CLIENT_ERRORS, CLIENT_LATENCY, ManagedClient, qdrant_kwargs
+from app.store.local import LocalIndexError
+from app.store.qdrant import asearch_collection, get_async_client, get_client, search_collection
+
+
+class Client:
+    def __init__(self):
+        self.calls = []
+
+    def search(self, **kwargs):
+        self.calls.append(kwargs)
+        return []
+
+    def count(self, collection_name):
+        raise ConnectionError('Qdrant went away')
+
+
+def test_managed_client_metrics_and_timeouts():
+    """Calls are timed, errors are counted, and searches get the default timeout unless given one."""
+    inner = Client()
+    client = ManagedClient(inner, 'test', search_timeout=3)
+    calls = CLIENT_LATENCY.count(backend='test', method='search')
+
+    client.search(collection_name='docs')
+    client.search(collection_name='docs', timeout=1)
+    with pytest.raises(ConnectionError):
+        client.count('docs')
+
+    assert [c['timeout'] for c in inner.calls] == [3, 1]
+    assert CLIENT_LATENCY.count(backend='test', method='search') == calls + 2
+    assert CLIENT_ERRORS.value(backend='test', method='count', error='ConnectionError') == 1
+
+
+def test_qdrant_clients():
+    """Clients pool keep-alive connections, with the configured transport."""
+    config = {'host': 'localhost', 'port': 6333, 'client': {'prefer_grpc': True, 'pool_size': 4}}
+    kwargs = qdrant_kwargs(config)
+    assert kwargs['prefer_grpc'] is True and kwargs['limits'].max_keepalive_connections == 4
+
+    assert isinstance(get_client(config).client, QdrantClient)
+    assert isinstance(get_async_client(config).client, AsyncQdrantClient)
+    assert get_client(config) is get_client(dict(config))
+
+
+def test_async_client(tmp_path):
+    """The async client of the local index gives the same results as the sync client."""
+    config = {'backend': 'local', 'local_path': str(tmp_path)}
+    client = get_client(config)
+    client.recreate_collection('docs', vectors_config=models.VectorParams(size=2, distance=models.Distance.DOT))
+    client.upsert('docs', points=models.Batch(ids=[0, 1], vectors=[[1.0, 0.0], [0.0, 1.0]], payloads=[{'doc_id': 0}, {'doc_id': 1}]))
+
+    results = asyncio.run(asearch_collection(get_async_client(config), [0.2, 0.8], limit=1, collection_name='docs'))
+
+    assert results == search_collection(client, [0.2, 0.8], limit=1, collection_name='docs')
+    assert results[0].id == 1
+    with pytest.raises(LocalIndexError):
+        asyncio.run(asearch_collection(get_async_client(config), [0.2, 0.8], limit=1, collection_name='missing'))
+    assert CLIENT_ERRORS.value(backend='local', method='search', error='LocalIndexError') >= 1
@@ -0,0 +1,90 @@
+import json
+
+import numpy as np
+import pytest
+from qdrant_client import QdrantClient
+
+from app.store import ingest as ingest_module
+from app.store.ingest import IngestCheckpoint, ingest, read_documents
+
+
+class Encoder:
+    """Encodes text as its length, in batches."""
+
+    def __init__(self):
+        self.batches = []
+
+    def get_sentence_embedding_dimension(self):
+        return 2
+
+    def encode(self, texts, batch_size=32):
+        self.batches.append(len(texts))
+        return np.array([[len(text), 1.0] for text in texts], dtype=np.float32)
+
+
+def documents(n):
+    return [{'doc_id': i, 'text': 'a' * (i + 1)} for i in range(n)]
+
+
+@pytest.mark.parametrize('suffix', ['.json', '.jsonl'])
+def test_read_documents(tmp_path, suffix):
+    """Documents are read one at a time, across reads of the file."""
+    path = tmp_path / f'docs{suffix}'
+    docs = documents(5) + [{'doc_id': 5, 'text': 'with ] and , and "quotes"', 'score': 12345}]
+    if suffix == '.json':
+        path.write_text(json.dumps(docs, indent=2))
+    else:
+        path.write_text('\n'.join(json.dumps(d) for d in docs) + '\n\n')
+
+    assert list(read_documents(path, chunk_size=7)) == docs
+
+
+def test_read_documents_truncated(tmp_path):
+    path = tmp_path / 'docs.json'
+    path.write_text(json.dumps(documents(3))[:-10])
+
+    with pytest.raises(ValueError):
+        list(read_documents(path, chunk_size=7))
+
+
+def test_ingest():
+    client = QdrantClient(':memory:')
+    encoder = Encoder()
+
+    stats = ingest(client, iter(documents(10)), 'docs', encoder, upload_batch_size=4, parallel=2)
+
+    assert stats['documents'] == 10 and stats['skipped'] == 0 and stats['docs_per_second'] > 0
+    assert encoder.batches == [4, 4, 2]
+    assert client.count('docs').count == 10
+    [point] = client.retrieve('docs', [9], with_vectors=True)
+    assert point.payload == {'doc_id': 9, 'text': 'a' * 10, 'text_length': 10}
+
+
+def test_ingest_resumes_from_checkpoint(tmp_path, monkeypatch):
+    """An ingestion that fails is resumed after the last documents stored, without encoding them again."""
+    client = QdrantClient(':memory:')
+    checkpoint = IngestCheckpoint(tmp_path / 'docs.checkpoint', 'docs.json', 'docs')
+    upload = ingest_module._upload
+
+    def failing_upload(client, collection_name, points, max_retries):
+        if points.ids[0] >= 6:
+            raise ConnectionError('Qdrant went away')
+        upload(client, collection_name, points, max_retries)
+
+    monkeypatch.setattr(ingest_module, '_upload', failing_upload)
+    with pytest.raises(ConnectionError):
+        ingest(client, iter(documents(10)), 'docs', Encoder(), upload_batch_size=3, parallel=1, checkpoint=checkpoint)
+    assert checkpoint.load() == 6
+
+    monkeypatch.setattr(ingest_module, '_upload', upload)
+    encoder = Encoder()
+    stats = ingest(client, iter(documents(10)), 'docs', encoder, upload_batch_size=3, checkpoint=checkpoint)
+
+    assert stats['documents'] == 4 and stats['skipped'] == 6
+    assert encoder.batches == [3, 1]
+    assert client.count('docs').count == 10
+    assert not checkpoint.path.exists()
+
+    with pytest.raises(ValueError):
+        checkpoint.save(3)
+        IngestCheckpoint(checkpoint.path, 'other.json', 'docs').load()
@@ -0,0 +1,66 @@
+import numpy as np
+from qdrant_client.http import models
+
+from app.store.ivfpq import IVFPQIndex
+from app.store.local import LocalIndex
+
+
+def clustered(n=3000, dim=16, clusters=30, seed=0):
+    rng = np.random.default_rng(seed)
+    centres = rng.normal(size=(clusters, dim))
+    return (centres[rng.integers(clusters, size=n)] + 0.3 * rng.normal(size=(n, dim))).astype(np.float32)
+
+
+def recall(index, data, queries, k=10, **search_kwargs):
+    found = 0
+    for query in queries:
+        exact = np.argsort(-(data @ query))[:k]
+        ids, _ = index.search(query, k, **search_kwargs)
+        found += len(set(ids.tolist()) & set(exact.tolist()))
+    return found / (k * len(queries))
+
+
+def test_recall_improves_with_nprobe_and_refine():
+    vectors = clustered()
+    queries = clustered(n=20, seed=1)
+    index = IVFPQIndex.build(vectors, nlist=32, m=8)
+
+    assert len(index) == 3000 and index.offsets[-1] == 3000
+    narrow = recall(index, vectors, queries, nprobe=1)
+    wide = recall(index, vectors, queries, nprobe=32)
+    refined = recall(index, vectors, queries, nprobe=32, refine=8, vectors=vectors)
+    assert narrow <= wide <= refined
+    assert refined >= 0.95
+
+
+def test_save_and_load_mmap(tmp_path):
+    vectors = clustered(n=500)
+    index = IVFPQIndex.build(vectors, ids=np.arange(500) + 1000, nlist=8, m=4)
+    index.save(tmp_path / 'index')
+
+    loaded = IVFPQIndex.load(tmp_path / 'index')
+
+    assert isinstance(loaded.codes, np.memmap)
+    for a, b in zip(index.search(vectors[3], 5, nprobe=4), loaded.search(vectors[3], 5, nprobe=4)):
+        np.testing.assert_array_equal(a, b)
+    assert 1003 in loaded.search(vectors[3], 5, nprobe=4)[0]
+
+
+def test_local_index_approximate_search(tmp_path):
+    """Collections with an index are searched approximately, including points added after it was built."""
+    vectors = clustered(n=1000)
+    index = LocalIndex(tmp_path, nprobe=4, refine=4)
+    index.recreate_collection('docs', vectors_config=models.VectorParams(size=16, distance=models.Distance.DOT))
+    index.upsert('docs', points=models.Batch(ids=list(range(1000)), vectors=vectors.tolist(), payloads=[{'doc_id': i} for i in range(1000)]))
+    index.build_ann('docs', nlist=16, m=4)
+
+    query = vectors[42]
+    [top] = index.search('docs', query_vector=query.tolist(), limit=1)
+    assert top.id == int(np.argmax(vectors @ query)) and top.payload == {'doc_id': top.id}
+    assert top.score == float(vectors[top.id] @ query)
+
+    index.upsert('docs', points=[models.PointStruct(id=5000, vector=(query * 2).tolist(), payload={'doc_id': 5000})])
+    assert index.search('docs', query_vector=query.tolist(), limit=1)[0].id == 5000
+    assert index.search('docs', query_vector=query.tolist(), limit=1, search_params={'exact': True})[0].id == 5000
+
+    assert LocalIndex(tmp_path).collection('docs').ann is not None
@@ -0,0 +1,134 @@
+import numpy as np
+import pytest
+from qdrant_client.http import models
+
+from app.store.local import LocalIndex, LocalIndexError
+from app.store.qdrant import get_client, search_collection, search_collection_batch
+
+
+def fill(index, n=50, size=8, distance=models.Distance.DOT):
+    rng = np.random.default_rng(0)
+    vectors = rng.normal(size=(n, size)).astype(np.float32)
+    index.recreate_collection('docs', vectors_config=models.VectorParams(size=size, distance=distance))
+    index.upsert(
+        'docs',
+        points=models.Batch(
+            ids=list(range(n)),
+            vectors=vectors.tolist(),
+            payloads=[{'doc_id': i, 'text': f'doc {i}', 'meta': {'country': ['AU', 'NZ', 'UK'][i % 3]}} for i in range(n)],
+        ),
+    )
+    return vectors
+
+
+def test_search_top_k(tmp_path):
+    """Results are the exact top-k by dot product, best first."""
+    index = LocalIndex(tmp_path)
+    vectors = fill(index)
+    query = vectors[7] + 0.1
+
+    results = index.search('docs', query_vector=query.tolist(), limit=5)
+
+    expected = np.argsort(-(vectors @ query))[:5]
+    assert [r.id for r in results] == expected.tolist()
+    assert results[0].payload == {'doc_id': int(expected[0]), 'text': f'doc {expected[0]}', 'meta': {'country': ['AU', 'NZ', 'UK'][expected[0] % 3]}}
+    assert results[0].score == pytest.approx(float(vectors[expected[0]] @ query), rel=1e-5)
+
+
+def test_search_filters(tmp_path):
+    """must and should filters, as built from the retrieval config, through `get_client` and `search_collection`."""
+    client = get_client({'backend': 'local', 'local_path': str(tmp_path)})
+    vectors = fill(client)
+
+    results = search_collection(
+        client, vectors[0].tolist(), limit=50, collection_name='docs',
+        search_filters={'must': [{'key': 'meta.country', 'match': {'value': 'AU'}}]},
+    )
+    assert len(results) == 17 and all(r.payload['meta']['country'] == 'AU' for r in results)
+
+    [au, nz_or_uk] = search_collection_batch(
+        client, [vectors[0].tolist()] * 2, limit=50, collection_name='docs',
+        search_filters=[
+            {'must': [{'key': 'meta.country', 'match': {'value': 'AU'}}], 'should': [{'key': 'doc_id', 'match': {'value': 3}}]},
+            {'should': [{'key': 'meta.country', 'match': {'value': 'NZ'}}, {'key': 'meta.country', 'match': {'value': 'UK'}}]},
+        ],
+    )
+    assert [r.id for r in au] == [3]
+    assert len(nz_or_uk) == 33
+
+    # Results are in input order, with a limit for each query
+    results = search_collection_batch(client, [vectors[0].tolist(), vectors[1].tolist()], limit=[1, 3], collection_name='docs')
+    assert [len(r) for r in results] == [1, 3]
+    assert [r[0].id for r in results] == [int(np.argmax(vectors @ vectors[0])), int(np.argmax(vectors @ vectors[1]))]
+
+
+def test_upsert_and_reopen(tmp_path):
+    """Points with existing ids are replaced. Collections persist across instances."""
+    index = LocalIndex(tmp_path)
+    fill(index, distance=models.Distance.COSINE)
+    index.upsert('docs', points=[models.PointStruct(id=3, vector=[1.0] + [0.0] * 7, payload={'doc_id': 3, 'text': 'new'})])
+    index.close()
+
+    index = LocalIndex(tmp_path)
+    [result] = index.search('docs', query_vector=[2.0] + [0.0] * 7, limit=1)
+    assert result.id == 3 and result.payload['text'] == 'new' and result.score == pytest.approx(1.0)
+    assert index.count('docs').count == 50
+
+    with pytest.raises(LocalIndexError):
+        index.search('missing', query_vector=[0.0] * 8, limit=1)
+
+
+def test_payload_projection(tmp_path):
+    """Payloads can be limited to some of their keys, as in Qdrant."""
+    index = LocalIndex(tmp_path)
+    index.create_collection('docs', models.VectorParams(size=2, distance=models.Distance.DOT))
+    index.upsert('docs', models.Batch(ids=[0], vectors=[[1.0, 0.0]], payloads=[{'doc_id': 0, 'text': 'a'}]))
+
+    include = index.search('docs', [1.0, 0.0], with_payload=models.PayloadSelectorInclude(include=['doc_id']))
+    exclude = index.search('docs', [1.0, 0.0], with_payload=models.PayloadSelectorExclude(exclude=['doc_id']))
+    keys = index.retrieve('docs', [0], with_payload=['text'])
+
+    assert include[0].payload == {'doc_id': 0}
+    assert exclude[0].payload == {'text': 'a'}
+    assert keys[0].payload == {'text': 'a'}
+
+
+def test_create_payload_index(tmp_path):
+    """Filtered searches use the SQLite index of the payload key, with the same results."""
+    client = get_client({'backend': 'local', 'local_path': str(tmp_path)})
+    vectors = fill(client)
+    client.create_payload_index('docs', field_name='meta.country', field_schema=models.PayloadSchemaType.KEYWORD)
+    db = client.collection('docs')._db
+
+    plan = db.execute(
+        "EXPLAIN QUERY PLAN SELECT row FROM points WHERE json_extract(payload, '$.meta.country') IN (?)", ['AU']
+    ).fetchall()
+    results = search_collection(
+        client, vectors[0].tolist(), limit=50, collection_name='docs',
+        search_filters={'must': [{'key': 'meta.country', 'match': {'value': 'AU'}}]},
+    )
+
+    assert 'USING INDEX' in plan[0][-1]
+    assert len(results) == 17
+
+
+def test_uncommitted_vectors_are_dropped(tmp_path):
+    """Vectors without a committed row, from a failed upsert or a crash, are dropped."""
+    index = LocalIndex(tmp_path)
+    vectors = fill(index)
+    size = (tmp_path / 'docs' / 'vectors.f32').stat().st_size
+
+    with pytest.raises(TypeError):
+        index.upsert('docs', models.Batch(ids=[1000], vectors=[[1.0] * 8], payloads=[{'bad': object()}]))
+    assert len(index.collection('docs')) == len(vectors)
+    assert (tmp_path / 'docs' / 'vectors.f32').stat().st_size == size
+
+    # As if the process died between writing the vectors and committing their rows
+    with open(tmp_path / 'docs' / 'vectors.f32', 'ab') as file:
+        file.write(np.ones((2, 8), dtype=np.float32).tobytes())
+    index.close()
+    reopened = LocalIndex(tmp_path)
+
+    assert len(reopened.collection('docs')) == len(vectors)
+    assert (tmp_path / 'docs' / 'vectors.f32').stat().st_size == size
+    assert reopened.search('docs', vectors[0].tolist(), limit=1)[0].id == int(np.argmax(vectors @ vectors[0]))
@@ -5,8 +5,7 @@ from qdrant_client.http import models
 from qdrant_client.http.models import PointStruct
 
 from app.config import QDRANT_URL, REDACTED_INFORMATION_TOKEN_MAP
-
-client = QdrantClient("localhost", port=6333)
+from app.store.qdrant import get_client
 
 
 def qdrant_retriever_config():
@@ -74,6 +73,8 @@ def create_collection(data: list[dict], collection_name: str) -> None:
     """
     data: List of dict with keys 'id' (int), 'vector' (List[float]), 'payload' (dict)
     """
+    # Built on use, not on import, as worker processes import the test modules that import this one
+    client = get_client(qdrant_retriever_config())
     client.recreate_collection(
         collection_name=collection_name,
         vectors_config=models.VectorParams(size=4, distance=models.Distance.DOT),
@@ -0,0 +1,57 @@
+import time
+
+from app.cache import CACHE_LOOKUPS, BoundedCache, cache_key, cache_stats
+
+
+def test_cache_evicts_least_recently_used():
+    """The cache holds at most `max_entries` entries, and `max_bytes` bytes of values."""
+    cache = BoundedCache('test_lru', max_entries=2, max_bytes=20)
+    cache.put('a', 'aaaa')
+    cache.put('b', 'bbbb')
+    assert cache.get('a') == 'aaaa'
+
+    cache.put('c', 'cccc')
+    assert cache.get('b') is None
+    assert cache.get('a') == 'aaaa' and cache.get('c') == 'cccc'
+
+    cache.put('d', 'd' * 13)  # 15 bytes, as JSON
+    assert len(cache) == 1 and cache_stats()['test_lru'] == {'entries': 1, 'bytes': 15}
+
+    cache.put('e', 'e' * 30)  # Larger than the cache
+    assert cache.get('e') is None and cache.get('d') == 'd' * 13
+    cache.close()
+
+
+def test_cache_ttl():
+    cache = BoundedCache('test_ttl', ttl_seconds=0.05)
+    cache.put('a', {'text': 'A'})
+    assert cache.get('a') == {'text': 'A'}
+
+    time.sleep(0.06)
+    assert cache.get('a') is None
+    assert len(cache) == 0
+    cache.close()
+
+
+def test_cache_disk_tier(tmp_path):
+    """Entries on disk serve misses of a new cache, e.g. after a restart."""
+    path = str(tmp_path / 'cache.db')
+    cache = BoundedCache('test_disk', path=path)
+    cache.put('a', {'text': 'A'})
+    cache.close()
+
+    cache = BoundedCache('test_disk', path=path)
+    hits = CACHE_LOOKUPS.value(cache='test_disk', result='disk_hit')
+    assert cache.get('a') == {'text': 'A'}
+    assert cache.get('a') == {'text': 'A'}
+    assert CACHE_LOOKUPS.value(cache='test_disk', result='disk_hit') == hits + 1
+    assert cache.get('b') is None
+
+    cache.clear()
+    assert BoundedCache('test_disk_reopened', path=path).get('a') is None
+    cache.close()
+
+
+def test_cache_key():
+    assert cache_key('prompt', {'a': 1, 'b': 2}) == cache_key('prompt', {'b': 2, 'a': 1})
+    assert cache_key('prompt', {'a': 1}) != cache_key('prompt', {'a': 2})
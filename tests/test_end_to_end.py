@@ -2,12 +2,11 @@ from unittest.mock import patch
 
 import pytest
 import stubs
-from qdrant_client import QdrantClient
 
 from app.config import REDACTED_INFORMATION_TOKEN_MAP
 from app.runner import rag_runner
 from app.schemas import GenerateRequest
-from app.store.qdrant import get_encoder
+from app.store.qdrant import get_client, get_encoder
 
 
 @pytest.fixture
@@ -91,7 +90,7 @@ class TestRAGProcessor:
 
     @classmethod
     def setup_class(cls):
-        cls.qdrant_client = QdrantClient("localhost", port=6333)
+        cls.qdrant_client = get_client({"host": "localhost", "port": 6333})
         cls.encoder = get_encoder({'encoder':'all-MiniLM-L6-v2'})
 
     @classmethod
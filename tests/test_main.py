@@ -0,0 +1,83 @@
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+from fastapi.testclient import TestClient
+
+from app import main
+from app.pipe import Process, RAGStage, create_links
+
+
+class Generate(Process):
+
+    stage = RAGStage.GENERATE
+
+    def __init__(self, config: dict = {}) -> None:
+        super().__init__(config)
+        self.warm = threading.Event()
+
+    def warmup(self):
+        self.warm.wait(timeout=10)
+
+    def _process(self, text, data, errors, sentinel):
+        return f"{text.user_query} > {self.stage.name!s}", data, errors, self.next_stage
+
+
+@pytest.fixture
+def fresh_app(monkeypatch):
+    for name in ('dag', 'scheduler', 'startup_error'):
+        monkeypatch.setattr(main, name, None)
+    return monkeypatch
+
+
+def _wait_for(client, path, status_code):
+    for _ in range(100):
+        if client.get(path).status_code == status_code:
+            return True
+        time.sleep(0.05)
+    return False
+
+
+def test_ready_once_warm(fresh_app):
+    """The API is live straight away, and ready once the DAG is loaded and warmed up."""
+    process = Generate()
+    fresh_app.setattr(main, 'build_dag', lambda: create_links([process]))
+
+    with TestClient(main.app) as client:
+        assert client.get('/live').status_code == 200
+        assert client.get('/ready').json() == {'status': 'starting'}
+        assert client.post('/xbot/generate', json={'user_query': 'Hi'}).status_code == 503
+
+        process.warm.set()
+        assert _wait_for(client, '/ready', 200)
+        assert client.post('/xbot/generate', json={'user_query': 'Hi'}).json() == {'generated_text': 'Hi > GENERATE'}
+
+
+def test_failed_start_is_not_live(fresh_app):
+    def build_dag():
+        raise OSError('Model not found')
+
+    fresh_app.setattr(main, 'build_dag', build_dag)
+
+    with TestClient(main.app) as client:
+        assert _wait_for(client, '/live', 503)
+        assert client.get('/ready').json() == {'status': 'failed'}
+
+
+def test_import_is_lazy():
+    """Importing the API doesn't import the model libraries. They are blocked, so this holds whether or not
+    they are installed."""
+    code = (
+        "import sys\n"
+        "class Block:\n"
+        "    def find_spec(self, name, path=None, target=None):\n"
+        "        if name.split('.')[0] in {'torch', 'transformers', 'sentence_transformers', 'onnxruntime'}:\n"
+        "            raise ImportError(f'{name} was imported eagerly')\n"
+        "sys.meta_path.insert(0, Block())\n"
+        "import app.main\n"
+    )
+    result = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True)
+
+    assert result.returncode == 0, result.stderr
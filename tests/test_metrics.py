@@ -0,0 +1,57 @@
+import threading
+
+from app.metrics import STAGE_ERRORS, STAGE_LATENCY, MetricsRegistry
+from app.pipe import RAGStage
+from app.runner import _log_stage
+
+
+def test_histogram_buckets_and_quantiles():
+    registry = MetricsRegistry()
+    histogram = registry.histogram("test_latency_seconds", "Test latency.", buckets=(0.01, 0.1, 1.0))
+
+    for ms in [5] * 90 + [50] * 9 + [500]:
+        histogram.observe_ns(ms * 1_000_000, stage="RETRIEVE")
+
+    assert histogram.count(stage="RETRIEVE") == 100
+    assert histogram.quantile(0.5, stage="RETRIEVE") == 0.01
+    assert histogram.quantile(0.99, stage="RETRIEVE") == 0.1
+    assert histogram.quantile(1.0, stage="RETRIEVE") == 1.0
+
+    text = registry.render()
+    assert '# TYPE test_latency_seconds histogram' in text
+    assert 'test_latency_seconds_bucket{stage="RETRIEVE",le="0.1"} 99' in text
+    assert 'test_latency_seconds_bucket{stage="RETRIEVE",le="+Inf"} 100' in text
+    assert 'test_latency_seconds_count{stage="RETRIEVE"} 100' in text
+
+
+def test_counter_across_threads():
+    """Each thread records into its own shard, and nothing is lost when they are summed."""
+    registry = MetricsRegistry()
+    counter = registry.counter("test_total", "Test counter.")
+
+    def _record():
+        for _ in range(10_000):
+            counter.inc(kind="context")
+
+    threads = [threading.Thread(target=_record) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert counter.value(kind="context") == 40_000
+    assert 'test_total{kind="context"} 40000' in registry.render()
+
+
+def test_log_stage_records_metrics():
+    """Stage latency and new errors are recorded by the runner."""
+
+    class _Process:
+        stage = RAGStage.CONSOLIDATE
+
+    count, errors = STAGE_LATENCY.count(stage="CONSOLIDATE"), STAGE_ERRORS.value(stage="CONSOLIDATE")
+    err_counter = _log_stage(_Process(), [(RAGStage.CONSOLIDATE, ValueError())], 0, 2_000_000)
+
+    assert err_counter == 1
+    assert STAGE_LATENCY.count(stage="CONSOLIDATE") == count + 1
+    assert STAGE_ERRORS.value(stage="CONSOLIDATE") == errors + 1
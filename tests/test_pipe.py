@@ -1,4 +1,12 @@
-from app.pipe import Process, RAGStage, create_links
+import asyncio
+import re
+import time
+
+import pytest
+
+from app.pipe import DAG, Process, RAGStage, create_links
+from app.runner import arun_graph, astream_dag, run_dag
+from app.schemas import GenerateRequest
 
 
 class Security(Process):
@@ -135,6 +143,59 @@ def test_pipe_create_links():
     assert sentinel == RAGStage.END
 
 
+def test_compiled_plan_drops_disabled_stubs():
+    """Pass-through stubs are left out of the plan, unless enabled in their config."""
+
+    rewrite, rerank = Rewrite(), Rerank({'enabled': True})
+    rewrite.passthrough = rerank.passthrough = True
+
+    plan = create_links([Security(), rewrite, Retrieve(), rerank, Generate({'enabled': False})])
+
+    assert [p.stage for p in plan] == [RAGStage.SECURITY, RAGStage.RETRIEVE, RAGStage.RERANK]
+    assert plan[0].next_stage == RAGStage.RETRIEVE
+    assert plan[-1].next_stage == RAGStage.END
+    with pytest.raises(AttributeError):
+        plan.processes = ()
+
+
+def test_compiled_plan_jumps_to_sentinel():
+    """The runner goes straight to the stage named by the sentinel, without calling the stages in between."""
+
+    rcache, retrieve = RCache(), Retrieve()
+    rcache._process = lambda text, data, errors, sentinel: (f"{text} > RCACHE", data, errors, RAGStage.GENERATE)
+    retrieve._process = lambda *_: pytest.fail('Skipped stages are not called')
+    plan = create_links([Security(), rcache, retrieve, Consolidate(), Generate(), WCache()])
+
+    text = run_dag('begin', 'event', plan)
+
+    assert text == 'begin > SECURITY > RCACHE > GENERATE > WCACHE'
+    assert plan.next_index(1, RAGStage.GENERATE) == 4
+    assert plan.next_index(4, RAGStage.RCACHE) is None
+
+
+def test_stream_dag():
+    """References are sent before the streamed stage, its chunks as they come, then the whole text."""
+
+    class StreamingGenerate(Generate):
+        async def _astream(self, text, data, errors, sentinel):
+            for chunk in [text, ' > GEN', 'ERATE']:
+                yield chunk
+
+    async def _events(pipeline):
+        return [event async for event in astream_dag('begin', 'event', create_links(pipeline))]
+
+    events = asyncio.run(_events([Security(), StreamingGenerate(), WCache()]))
+
+    assert events == [('references', 'begin > SECURITY'), ('token', 'begin > SECURITY'), ('token', ' > GEN'),
+                      ('token', 'ERATE'), ('done', 'begin > SECURITY > GENERATE > WCACHE')]
+
+    # Non-streaming processes stream their whole output at once
+    events = asyncio.run(_events([Security(), Generate()]))
+
+    assert [event for event, _ in events] == ['references', 'token', 'done']
+    assert events[-1] == ('done', 'begin > SECURITY > GENERATE')
+
+
 def test_pipe_cache_hit():
     """Dynamically set the next stage when cache hit"""
 
@@ -163,3 +224,160 @@ def test_pipe_cache_hit():
     assert err == []
     assert data == {}
     assert sentinel == RAGStage.END
+
+
+def test_pipe_async_cache_hit():
+    """Sync processes run unchanged through the async interface, and stages can still be skipped."""
+
+    security = Security()
+    rcache = RCache()
+    retrieve = Retrieve()
+    generate = Generate()
+
+    def _p(text, data, errors, sentinel):
+        return text, data, errors, RAGStage.GENERATE
+
+    rcache._process = _p
+    pipeline = [security, rcache, retrieve, generate]
+    create_links(pipeline)
+
+    async def _run(text, data, err, sentinel):
+        for process in pipeline:
+            text, data, err, sentinel = await process.acall(text, data, err, sentinel)
+        return text, data, err, sentinel
+
+    text, data, err, sentinel = asyncio.run(_run('begin', {}, [], RAGStage.SECURITY))
+
+    assert text == 'begin > SECURITY > GENERATE'
+    assert err == []
+    assert sentinel == RAGStage.END
+
+
+def test_pipe_batch_call():
+    """Requests in a batch are processed together, and skipped stages pass through per request."""
+
+    retrieve = Retrieve()
+    generate = Generate()
+    batch_sizes = []
+
+    def _process_batch(batch):
+        batch_sizes.append(len(batch))
+        return [retrieve._process(*item) for item in batch]
+
+    retrieve._process_batch = _process_batch
+    pipeline = [retrieve, generate]
+    create_links(pipeline)
+
+    batch = [('a', {}, [], RAGStage.RETRIEVE), ('b', {}, [], RAGStage.GENERATE), ('c', {}, [], RAGStage.RETRIEVE)]
+    for process in pipeline:
+        batch = process.batch_call(batch)
+
+    assert [text for text, *_ in batch] == ['a > RETRIEVE > GENERATE', 'b > GENERATE', 'c > RETRIEVE > GENERATE']
+    assert all(sentinel == RAGStage.END for *_, sentinel in batch)
+    assert batch_sizes == [2]
+
+
+class SlowProcess(Process):
+    """Appends its stage name to the text after a delay. Jumps to `jump_to` if set."""
+
+    def __init__(self, stage, delay=0.0, jump_to=None) -> None:
+        self.stage = stage
+        super().__init__({})
+        self.delay = delay
+        self.jump_to = jump_to
+
+    def _process(self, text, data, errors, sentinel):
+        raise NotImplementedError
+
+    async def _aprocess(self, text, data, errors, sentinel):
+        await asyncio.sleep(self.delay)
+        data = {**data, self.stage.name: True}
+        return f"{text} > {self.stage.name!s}", data, errors, self.jump_to or self.next_stage
+
+
+def test_graph_fan_out_and_join():
+    """Independent branches run concurrently, and their data is joined."""
+
+    graph = DAG(
+        [SlowProcess(RAGStage.SECURITY), SlowProcess(RAGStage.RCACHE, 0.2), SlowProcess(RAGStage.RETRIEVE, 0.2),
+         SlowProcess(RAGStage.GENERATE)],
+        depends_on={RAGStage.RCACHE: [RAGStage.SECURITY],
+                    RAGStage.RETRIEVE: [RAGStage.SECURITY],
+                    RAGStage.GENERATE: [RAGStage.RETRIEVE, RAGStage.RCACHE]},
+    )
+    captured = {}
+    generate = graph.processes[RAGStage.GENERATE]
+    _aprocess = generate._aprocess
+
+    async def _capture(text, data, errors, sentinel):
+        captured.update(data)
+        return await _aprocess(text, data, errors, sentinel)
+
+    generate._aprocess = _capture
+
+    t0 = time.time()
+    text = asyncio.run(arun_graph(GenerateRequest(user_query='begin'), 'event', graph))
+
+    assert time.time() - t0 < 0.35
+    assert text.endswith('> SECURITY > RETRIEVE > GENERATE')
+    assert captured['RCACHE'] and captured['RETRIEVE'] and captured['event_id'] == 'event'
+
+
+def test_graph_cache_hit_cancels_retrieval(monkeypatch):
+    """The first branch to jump ahead wins, and the slower branch is cancelled. It isn't counted as time saved."""
+    logs = []
+    monkeypatch.setattr('app.runner.logger.info', logs.append)
+
+    graph = DAG(
+        [SlowProcess(RAGStage.SECURITY), SlowProcess(RAGStage.RCACHE, 0.05, jump_to=RAGStage.GENERATE),
+         SlowProcess(RAGStage.RETRIEVE, 1.0), SlowProcess(RAGStage.CONSOLIDATE), SlowProcess(RAGStage.GENERATE)],
+        depends_on={RAGStage.RCACHE: [RAGStage.SECURITY],
+                    RAGStage.RETRIEVE: [RAGStage.SECURITY],
+                    RAGStage.GENERATE: [RAGStage.CONSOLIDATE]},
+    )
+
+    t0 = time.time()
+    text = asyncio.run(arun_graph(GenerateRequest(user_query='begin'), 'event', graph))
+
+    assert time.time() - t0 < 0.5
+    assert text.endswith('> SECURITY > RCACHE > GENERATE')
+    saved = float(re.search(r'saved (\S+) seconds', logs[-1]).group(1))
+    assert saved < 0.04
+
+
+def test_graph_sentinel_outside_graph_ends_run():
+    """A process that names a stage missing from the DAG ends the run, cancelling the other branches."""
+
+    graph = DAG(
+        [SlowProcess(RAGStage.SECURITY), SlowProcess(RAGStage.RCACHE, 0.05, jump_to=RAGStage.WCACHE),
+         SlowProcess(RAGStage.RETRIEVE, 1.0), SlowProcess(RAGStage.GENERATE)],
+        depends_on={RAGStage.RCACHE: [RAGStage.SECURITY],
+                    RAGStage.RETRIEVE: [RAGStage.SECURITY],
+                    RAGStage.GENERATE: [RAGStage.RETRIEVE]},
+    )
+
+    t0 = time.time()
+    text = asyncio.run(arun_graph(GenerateRequest(user_query='begin'), 'event', graph))
+
+    assert time.time() - t0 < 0.5
+    assert text.endswith('> SECURITY > RCACHE')
+
+
+def test_graph_leaves_processes_unlinked():
+    """A DAG keeps its own successors. Processes shared with a linear plan keep theirs."""
+
+    security, retrieve, generate = SlowProcess(RAGStage.SECURITY), SlowProcess(RAGStage.RETRIEVE), SlowProcess(RAGStage.GENERATE)
+    create_links([security, generate, retrieve])
+    graph = DAG([security, retrieve, generate],
+                depends_on={RAGStage.RETRIEVE: [RAGStage.SECURITY], RAGStage.GENERATE: [RAGStage.RETRIEVE]})
+
+    assert graph.next_stages == {RAGStage.SECURITY: RAGStage.RETRIEVE, RAGStage.RETRIEVE: RAGStage.GENERATE,
+                                 RAGStage.GENERATE: RAGStage.END}
+    assert [p.next_stage for p in (security, generate, retrieve)] == [RAGStage.GENERATE, RAGStage.RETRIEVE, RAGStage.END]
+    text = asyncio.run(arun_graph(GenerateRequest(user_query='begin'), 'event', graph))
+    assert text.endswith('> SECURITY > RETRIEVE > GENERATE')
+
+
+def test_graph_cycle():
+    with pytest.raises(ValueError, match='cycle'):
+        DAG([Security(), Retrieve()], depends_on={RAGStage.SECURITY: [RAGStage.RETRIEVE]})
@@ -0,0 +1,66 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from app.registry import ModelRegistry, config_key
+
+
+def test_registry_loads_once():
+    """Concurrent callers share one load per key. Other keys load separately."""
+    registry = ModelRegistry()
+    loads = []
+
+    def _load(name):
+        loads.append(name)
+        time.sleep(0.05)
+        return object()
+
+    key = config_key({'model': 'gpt2', 'device': 'cpu', 'max_length': 10}, 'model', 'device')
+    with ThreadPoolExecutor(8) as pool:
+        models = list(pool.map(lambda _: registry.get('gpt2_model', key, lambda: _load('gpt2')), range(8)))
+
+    assert loads == ['gpt2']
+    assert all(m is models[0] for m in models)
+    assert key == config_key({'device': 'cpu', 'model': 'gpt2'}, 'model', 'device')
+
+    registry.get('gpt2_model', config_key({'model': 'distilgpt2'}, 'model', 'device'), lambda: _load('distilgpt2'))
+    assert loads == ['gpt2', 'distilgpt2']
+
+
+def test_registry_evict_and_reload():
+    registry = ModelRegistry()
+    counter = iter(range(100))
+    first = registry.get('encoder', 'minilm', lambda: next(counter))
+    registry.get('client', 'localhost', lambda: 'client')
+
+    assert registry.reload('encoder', 'minilm') == first + 1
+    assert registry.get('encoder', 'minilm', lambda: pytest.fail('Already loaded')) == first + 1
+
+    assert registry.evict('encoder') == [('encoder', 'minilm')]
+    assert ('encoder', 'minilm') not in registry and ('client', 'localhost') in registry
+    assert registry.get('encoder', 'minilm', lambda: next(counter)) == first + 2
+
+    registry.evict()
+    assert registry.keys() == []
+    with pytest.raises(KeyError):
+        registry.reload('encoder', 'minilm')
+
+
+def test_registry_slow_load_does_not_block_other_keys():
+    registry = ModelRegistry()
+    loading = threading.Event()
+
+    def _slow():
+        loading.set()
+        time.sleep(0.5)
+        return 'slow'
+
+    thread = threading.Thread(target=registry.get, args=('model', 'slow', _slow))
+    thread.start()
+    loading.wait()
+    t0 = time.time()
+    assert registry.get('model', 'fast', lambda: 'fast') == 'fast'
+    assert time.time() - t0 < 0.25
+    thread.join()
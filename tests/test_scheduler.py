@@ -0,0 +1,120 @@
+import asyncio
+
+import pytest
+
+from app.pipe import Process, RAGStage, create_links
+from app.scheduler import MicroBatchScheduler
+from app.schemas import GenerateRequest
+
+
+class Retrieve(Process):
+
+    stage = RAGStage.RETRIEVE
+
+    def __init__(self, config: dict = {}) -> None:
+        super().__init__(config)
+        self.batch_sizes = []
+
+    def _process(self, text, data, errors, sentinel):
+        if text.user_query == 'raise':
+            raise ValueError('Bad request')
+        return f"{text.user_query} > {self.stage.name!s}", data, errors, self.next_stage
+
+    def _process_batch(self, batch):
+        self.batch_sizes.append(len(batch))
+        if any(text.user_query == 'raise' for text, *_ in batch):
+            raise ValueError('Bad request in batch')
+        return [self._process(*item) for item in batch]
+
+
+class Generate(Process):
+
+    stage = RAGStage.GENERATE
+
+    def __init__(self, config: dict = {}) -> None: super().__init__(config)
+
+    def _process(self, text, data, errors, sentinel):
+        return f"{text} > {self.stage.name!s}", data, errors, self.next_stage
+
+
+async def _submit_all(scheduler, queries):
+    requests = [scheduler.submit(GenerateRequest(user_query=q), f'event-{i}') for i, q in enumerate(queries)]
+    results = await asyncio.gather(*requests, return_exceptions=True)
+    await scheduler.close()
+    return results
+
+
+def test_scheduler_batches_concurrent_requests():
+    """Concurrent requests share a batch, and each caller gets back their own output."""
+
+    retrieve, generate = Retrieve(), Generate()
+    pipeline = [retrieve, generate]
+    create_links(pipeline)
+    scheduler = MicroBatchScheduler(pipeline, {'max_batch_size': 4, 'max_wait_ms': 50})
+
+    results = asyncio.run(_submit_all(scheduler, ['a', 'b', 'c', 'd', 'e']))
+
+    assert [text for text, *_ in results] == [f'{q} > RETRIEVE > GENERATE' for q in 'abcde']
+    assert [data['event_id'] for _, data, *_ in results] == [f'event-{i}' for i in range(5)]
+    assert all(sentinel == RAGStage.END for *_, sentinel in results)
+    assert retrieve.batch_sizes == [4, 1]
+
+
+def test_scheduler_isolates_failing_request():
+    """A request that raises, fails only its own caller."""
+
+    retrieve, generate = Retrieve(), Generate()
+    pipeline = [retrieve, generate]
+    create_links(pipeline)
+    scheduler = MicroBatchScheduler(pipeline, {'max_batch_size': 3, 'max_wait_ms': 50})
+
+    results = asyncio.run(_submit_all(scheduler, ['a', 'raise', 'c']))
+
+    assert results[0][0] == 'a > RETRIEVE > GENERATE'
+    assert isinstance(results[1], ValueError)
+    assert results[2][0] == 'c > RETRIEVE > GENERATE'
+
+
+
+def test_scheduler_restarts_collector():
+    """If the collector stops, the next request restarts it, and requests already queued are still answered."""
+
+    retrieve, generate = Retrieve(), Generate()
+    pipeline = [retrieve, generate]
+    create_links(pipeline)
+    scheduler = MicroBatchScheduler(pipeline, {'max_batch_size': 4, 'max_wait_ms': 50})
+
+    async def _run():
+        queued = asyncio.create_task(scheduler.submit(GenerateRequest(user_query='a'), 'event-0'))
+        await asyncio.sleep(0)
+        assert scheduler._queue.qsize() == 1
+        scheduler._worker.cancel()
+        restarted = scheduler.submit(GenerateRequest(user_query='b'), 'event-1')
+        return await asyncio.wait_for(asyncio.gather(queued, restarted), 5)
+
+    results = asyncio.run(_run())
+
+    assert [text for text, *_ in results] == ['a > RETRIEVE > GENERATE', 'b > RETRIEVE > GENERATE']
+    assert retrieve.batch_sizes == [2]
+
+
+def test_scheduler_fails_collected_requests_when_stopped():
+    """Requests taken off the queue, but not yet dispatched, fail when the collector stops."""
+
+    pipeline = [Retrieve(), Generate()]
+    create_links(pipeline)
+    scheduler = MicroBatchScheduler(pipeline, {'max_batch_size': 4, 'max_wait_ms': 1000})
+
+    async def _run():
+        collected = asyncio.create_task(scheduler.submit(GenerateRequest(user_query='a'), 'event-0'))
+        await asyncio.sleep(0.05)
+        await scheduler.close()
+        return await asyncio.wait_for(asyncio.gather(collected, return_exceptions=True), 5)
+
+    results = asyncio.run(_run())
+
+    assert isinstance(results[0], RuntimeError)
+
+
+if __name__ == '__main__':
+    pytest.main(["-s", __file__])
@@ -0,0 +1,103 @@
+import json
+import time
+
+import pytest
+
+from app.pipe import Process, RAGStage, create_links
+from app.runner import run_dag, run_dag_batch
+from app.schemas import GenerateRequest
+from app.tracing import InMemoryExporter, JSONLExporter, set_exporter, span, trace
+from app.utils import run_until_timeout
+
+
+@pytest.fixture
+def exporter():
+    exporter = InMemoryExporter()
+    previous = set_exporter(exporter)
+    yield exporter
+    set_exporter(previous)
+
+
+class Retrieve(Process):
+
+    stage = RAGStage.RETRIEVE
+
+    def __init__(self, config: dict = {}) -> None: super().__init__(config)
+
+    def _process(self, text, data, errors, sentinel):
+        def _encode():
+            with span("encode_text"):
+                time.sleep(0.01)
+            return text
+
+        text = run_until_timeout(_encode, 1.0, TimeoutError, resource="embedding")
+        return text, data, errors, self.next_stage
+
+
+class Generate(Process):
+
+    stage = RAGStage.GENERATE
+
+    def __init__(self, config: dict = {}) -> None: super().__init__(config)
+
+    def _process(self, text, data, errors, sentinel):
+        with span("model.generate", max_length=10):
+            pass
+        return text, data, errors, self.next_stage
+
+
+def test_trace_per_event_with_stage_and_child_spans(exporter):
+    """A run produces a trace for its event, a span per process, and child spans for the work inside them."""
+    pipeline = [Retrieve(), Generate()]
+    create_links(pipeline)
+
+    run_dag(GenerateRequest(user_query='begin'), 'event-1', pipeline)
+
+    spans = {s.name: s for s in exporter.spans}
+    assert all(s.trace_id == 'event-1' for s in exporter.spans)
+    assert spans['RETRIEVE'].parent_id == spans['request'].span_id
+    assert spans['GENERATE'].parent_id == spans['request'].span_id
+    # Traced across the thread pool
+    assert spans['encode_text'].parent_id == spans['RETRIEVE'].span_id
+    assert spans['encode_text'].duration_ns >= 10_000_000
+    assert spans['model.generate'].attributes == {'max_length': 10}
+
+
+def test_trace_per_event_in_batch(exporter):
+    """A batch is traced once, and each of its events has a trace of its own, linked to the batch's."""
+    pipeline = [Retrieve(), Generate()]
+    create_links(pipeline)
+
+    run_dag_batch([(GenerateRequest(user_query='a'), 'event-1'), (GenerateRequest(user_query='b'), 'event-2')], pipeline)
+
+    roots = {s.trace_id: s for s in exporter.spans if s.name == 'request'}
+    batch = next(s for s in exporter.spans if s.name == 'batch')
+    assert sorted(roots) == ['event-1', 'event-2']
+    assert all(root.attributes['batch_trace_id'] == batch.trace_id for root in roots.values())
+    assert batch.attributes['event_ids'] == ['event-1', 'event-2']
+    assert {s.name for s in exporter.spans if s.parent_id == batch.span_id} == {'RETRIEVE', 'GENERATE'}
+
+
+def test_span_outside_trace_is_not_recorded(exporter):
+    with span("encode_text") as s:
+        assert s is None
+    assert exporter.spans == []
+
+
+def test_span_records_error(exporter):
+    with pytest.raises(ValueError), trace('event-2'), span('search_collection'):
+        raise ValueError('Qdrant is down')
+
+    assert exporter.spans[0].error == 'ValueError: Qdrant is down'
+
+
+def test_jsonl_exporter(tmp_path):
+    path = tmp_path / 'traces.jsonl'
+    previous = set_exporter(JSONLExporter(str(path)))
+    with trace('event-3'), span('write_data'):
+        pass
+    set_exporter(previous).flush()
+
+    lines = [json.loads(line) for line in path.read_text().splitlines()]
+    assert [line['name'] for line in lines] == ['write_data', 'request']
+    assert lines[0]['parent_id'] == lines[1]['span_id']
@@ -1,8 +1,17 @@
+import asyncio
+import threading
 import time
 
 import pytest
 
-from app.utils import run_until_timeout
+from app.utils import (
+    DynamicBatcher,
+    arun_until_timeout,
+    configure_executors,
+    executor_stats,
+    get_executor,
+    run_until_timeout,
+)
 
 
 def function_fast():
@@ -23,3 +32,60 @@ def test_run_with_timeout_no_timeout():
 def test_run_with_timeout_with_timeout():
     with pytest.raises(CustomTimeoutException, match=r".*took too long to respond"):
         run_until_timeout(function_slow, timeout=1, timeout_error_type=CustomTimeoutException)
+
+def test_arun_with_timeout():
+    result = asyncio.run(arun_until_timeout(function_fast, timeout=2, timeout_error_type=CustomTimeoutException))
+    assert result == "Finished quickly"
+
+    with pytest.raises(CustomTimeoutException, match=r".*took too long to respond"):
+        asyncio.run(arun_until_timeout(function_slow, timeout=1, timeout_error_type=CustomTimeoutException))
+
+def test_run_with_timeout_returns_at_deadline():
+    """The caller gets the timeout error at the deadline, not when the late work finishes."""
+    t0 = time.time()
+    with pytest.raises(CustomTimeoutException):
+        run_until_timeout(function_slow, timeout=0.5, timeout_error_type=CustomTimeoutException, resource="llm")
+
+    assert time.time() - t0 < 1.0
+    assert executor_stats()["llm"]["timed_out"] >= 1
+
+def test_run_with_timeout_queue_limit():
+    """Work is rejected when the pool is full, and the pool's saturation is reported."""
+    configure_executors({"test": {"max_workers": 1, "max_queue": 0}})
+    started = threading.Event()
+    busy = get_executor("test").submit(lambda: started.set() or time.sleep(0.5))
+    started.wait()
+
+    with pytest.raises(CustomTimeoutException, match=r".*could not be scheduled"):
+        run_until_timeout(function_fast, timeout=2, timeout_error_type=CustomTimeoutException, resource="test")
+
+    stats = executor_stats()["test"]
+    assert stats["saturation"] == 1.0 and stats["rejected"] == 1
+    busy.result()
+
+def test_dynamic_batcher():
+    """Items submitted concurrently are processed together, and each caller gets its own result."""
+    batches = []
+
+    def _double(items):
+        batches.append(items)
+        return [item * 2 for item in items]
+
+    batcher = DynamicBatcher("test", _double, max_batch_size=4, max_wait_ms=50)
+    futures = [batcher.submit(i) for i in range(6)]
+
+    assert [f.result(timeout=1) for f in futures] == [0, 2, 4, 6, 8, 10]
+    assert batches == [[0, 1, 2, 3], [4, 5]]
+
+    failing = DynamicBatcher("test-failing", lambda items: 1 / 0)
+    with pytest.raises(ZeroDivisionError):
+        failing.submit(1).result(timeout=1)
+
+    # A result per item, or the whole batch fails, rather than leaving callers waiting
+    short = DynamicBatcher("test-short", lambda items: items[:-1], max_batch_size=2, max_wait_ms=50)
+    futures = [short.submit(i) for i in range(2)]
+    for future in futures:
+        with pytest.raises(ValueError, match='1 results for 2 items'):
+            future.result(timeout=1)
+    with pytest.raises(ValueError, match='0 results for 1 items'):
+        short.submit(3).result(timeout=1)